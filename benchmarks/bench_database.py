@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+time of the Database queries on the columnar index, compared to the previous
+implementation that kept a set of filepaths for every tag value
+
+the dataset is bids-like, with anatomical, bold, events and field map files for each
+subject. the files are created empty in a temporary directory
+
+usage: python benchmarks/bench_database.py [n_subjects ...]
+"""
+
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pipeline.database import Database, _resolve
+from pipeline.spec import FileSchema, tagnames
+
+
+class DictOfSetsDatabase:
+    def __init__(self, database):
+        self.tags_by_filepaths = database.tags_by_filepaths
+        self.filepaths_by_tags = dict()
+        for filepath, tags_obj in self.tags_by_filepaths.items():
+            for tagname in tagnames:
+                tagval = getattr(tags_obj, tagname, None)
+                self.set_file_tag(filepath, tagname, tagval)
+
+    def set_file_tag(self, filepath, tagname, tagval):
+        if tagval is None:
+            return
+        if tagname not in self.filepaths_by_tags:
+            self.filepaths_by_tags[tagname] = dict()
+        tagvaldict = self.filepaths_by_tags[tagname]
+        if tagval not in tagvaldict:
+            tagvaldict[tagval] = set()
+        tagvaldict[tagval].add(filepath)
+
+    def get(self, **filters):
+        res = None
+        for tagname, tagval in filters.items():
+            tagname = _resolve(tagname)
+            if tagname in self.filepaths_by_tags and tagval in self.filepaths_by_tags[tagname]:
+                cur_set = self.filepaths_by_tags[tagname][tagval]
+                if res is not None:
+                    res &= cur_set
+                else:
+                    res = cur_set.copy()
+            else:
+                res = None
+                break
+        if res is None:
+            return set()
+        return res
+
+    def filter(self, filepaths, **filters):
+        res = set(filepaths)
+        for tagname, tagval in filters.items():
+            tagname = _resolve(tagname)
+            cur_set = self.filepaths_by_tags[tagname][tagval]
+            res &= cur_set
+        return res
+
+    def get_tagval_set(self, tagname, filepaths=None):
+        if not isinstance(tagname, str):
+            return
+        tagname = _resolve(tagname)
+        if tagname not in self.filepaths_by_tags:
+            return
+        if filepaths is not None:
+            if not isinstance(filepaths, set):
+                filepaths = set(filepaths)
+            return set(
+                tagval
+                for tagval, tagvalfilepaths in self.filepaths_by_tags[tagname].items()
+                if not filepaths.isdisjoint(tagvalfilepaths)
+            )
+        else:
+            return set(self.filepaths_by_tags[tagname].keys())
+
+    def get_multi_tagval_set(self, tagnames, filepaths=None, prune=True):
+        def prunefun(tn):
+            tagval_set = self.get_tagval_set(tn, filepaths=filepaths)
+            return tagval_set is not None and len(tagval_set) > 1
+
+        if prune:
+            tagnames = [tn for tn in tagnames if prunefun(tn)]
+        resolvedtagnames = [_resolve(tn) for tn in tagnames]
+
+        if filepaths is None:
+            filepaths = self.tags_by_filepaths.keys()
+
+        return (
+            tagnames,
+            set(
+                tuple(
+                    getattr(self.tags_by_filepaths[filepath], tn, None) for tn in resolvedtagnames
+                )
+                for filepath in filepaths
+                if filepath in self.tags_by_filepaths
+            ),
+        )
+
+
+def make_database(base, n_subjects):
+    for s in range(n_subjects):
+        prefix = f"sub-{s:05d}"
+        directory = base / prefix
+        for datatype in ["anat", "func", "fmap"]:
+            (directory / datatype).mkdir(parents=True)
+        (directory / "anat" / f"{prefix}_T1w.nii.gz").touch()
+        for task in ["rest", "faces", "gambling", "motor"]:
+            for run in range(1, 7):
+                stem = f"{prefix}_task-{task}_run-{run}"
+                (directory / "func" / f"{stem}_bold.nii.gz").touch()
+                (directory / "func" / f"{stem}_events.tsv").touch()
+        for direction in ["AP", "PA"]:
+            (directory / "fmap" / f"{prefix}_dir-{direction}_epi.nii.gz").touch()
+
+    schema = FileSchema()
+    files = [
+        schema.load(dict(path=str(base / path), tags=tags))
+        for path, tags in [
+            (
+                "sub-{subject}/anat/sub-{subject}_T1w.nii.gz",
+                dict(datatype="anat", suffix="T1w"),
+            ),
+            (
+                "sub-{subject}/func/sub-{subject}_task-{task}_run-{run}_bold.nii.gz",
+                dict(datatype="func", suffix="bold", repetition_time=2.0),
+            ),
+            (
+                "sub-{subject}/func/sub-{subject}_task-{task}_run-{run}_events.tsv",
+                dict(datatype="func", suffix="events", extension="tsv"),
+            ),
+            (
+                "sub-{subject}/fmap/sub-{subject}_dir-{direction}_epi.nii.gz",
+                dict(datatype="fmap", suffix="epi"),
+            ),
+        ]
+    ]
+    return Database(files=files)
+
+
+def measure(func, *args, **kwargs):
+    """
+    :return: result and time per call in milliseconds
+    """
+    result = func(*args, **kwargs)
+    n = 0
+    start = time.perf_counter()
+    while n == 0 or time.perf_counter() - start < 0.2:
+        func(*args, **kwargs)
+        n += 1
+    return result, (time.perf_counter() - start) / n * 1e3
+
+
+def main():
+    n_subjects_list = [int(arg) for arg in sys.argv[1:]] or [100, 2000]
+
+    for n_subjects in n_subjects_list:
+        with TemporaryDirectory() as tmpdir:
+            database = make_database(Path(tmpdir), n_subjects)
+        previous = DictOfSetsDatabase(database)
+
+        subjectfiles = database.get(subject="00000")
+        boldfiles = database.get(datatype="func", suffix="bold")
+        entities = ["subject", "task", "run", "direction"]
+        queries = [
+            ("get(subject)", "get", [], dict(subject="00000")),
+            ("get(datatype, suffix)", "get", [], dict(datatype="func", suffix="bold")),
+            ("filter(subject files)", "filter", [subjectfiles], dict(datatype="func")),
+            ("filter(bold files)", "filter", [boldfiles], dict(task="rest", run="1")),
+            ("get_tagval_set", "get_tagval_set", ["subject"], dict()),
+            ("get_tagval_set(bold files)", "get_tagval_set", ["task", boldfiles], dict()),
+            ("get_multi_tagval_set", "get_multi_tagval_set", [entities], dict()),
+            (
+                "get_multi_tagval_set(bold files)",
+                "get_multi_tagval_set",
+                [entities, boldfiles],
+                dict(),
+            ),
+            (
+                "get_multi_tagval_set(subject files)",
+                "get_multi_tagval_set",
+                [entities, subjectfiles],
+                dict(),
+            ),
+        ]
+
+        print(f"{n_subjects} subjects, {len(database.filepaths)} files")
+        print(f"{'':36} {'indexed':>10} {'before*':>10}")
+        for label, methodname, args, kwargs in queries:
+            result, indexed_ms = measure(getattr(database, methodname), *args, **kwargs)
+            expected, before_ms = measure(getattr(previous, methodname), *args, **kwargs)
+            assert result == expected
+            print(f"{label:36} {indexed_ms:8.3f}ms {before_ms:8.3f}ms")
+    print("* previous implementation, with the same results")
+
+
+if __name__ == "__main__":
+    main()
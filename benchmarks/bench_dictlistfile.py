@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+time to add entries to a DictListFile and compact them into the report file, compared
+to the linear search for an entry with the same entities that put did before
+
+usage: python benchmarks/bench_dictlistfile.py [n_entries ...]
+"""
+
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pipeline.io.dictlistfile import DictListFile, keykeys
+
+
+def rewrite_put(dictlist, indict):
+    for i, curdict in enumerate(dictlist):
+        matches = all(
+            key in indict and indict[key] == value
+            for key, value in curdict.items()
+            if key in keykeys
+        )
+        if matches:
+            dictlist[i] = indict
+            return
+    dictlist.append(indict)
+
+
+def make_indicts(n_entries):
+    return [
+        dict(subject=f"{i // 4:05d}", task="rest", run=str(i % 4), desc="tsnr", value=i)
+        for i in range(n_entries)
+    ]
+
+
+def main():
+    n_entries_list = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+
+    print(f"{'entries':>8} {'add':>9} {'update':>9} {'before*':>9}")
+    for n_entries in n_entries_list:
+        indicts = make_indicts(n_entries)
+        with TemporaryDirectory() as tmpdir:
+            dictlistfile = DictListFile(Path(tmpdir) / "reportvals.js", "report('", "');")
+
+            start = time.perf_counter()
+            with dictlistfile:
+                dictlistfile.put_many(indicts)
+            dictlistfile.compact()
+            add_s = time.perf_counter() - start
+
+            start = time.perf_counter()  # update every entry of an existing file
+            with dictlistfile:
+                dictlistfile.put_many([dict(indict, value=-1) for indict in indicts])
+            dictlistfile.compact()
+            update_s = time.perf_counter() - start
+
+        before = "-"
+        if n_entries <= 10000:  # quadratic
+            dictlist = []
+            start = time.perf_counter()
+            for indict in indicts:
+                rewrite_put(dictlist, indict)
+            before = f"{time.perf_counter() - start:8.2f}s"
+        print(f"{n_entries:8d} {add_s:8.2f}s {update_s:8.2f}s {before:>9}")
+    print("* linear search only, without reading and writing the file")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+time to build the workflow for the spec of a working directory, with the workflow
+templates built in one or more processes
+
+each run starts from an empty copy of the working directory that only has the spec,
+so that the time includes building the templates for the first time, and not only
+building the subject workflows from the templates
+
+usage: python benchmarks/bench_init_workflow.py workdir [n_procs ...]
+"""
+
+import sys
+import time
+import shutil
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pipeline.workflow import init_workflow
+
+
+def main():
+    workdir = Path(sys.argv[1])
+    n_procs_list = [int(arg) for arg in sys.argv[2:]] or [1, 4]
+
+    print(f"{'n_procs':>8} {'time':>8} {'subjects':>9} {'nodes':>8}")
+    for n_procs in n_procs_list:
+        with TemporaryDirectory() as tmpdir:
+            shutil.copyfile(workdir / "spec.json", Path(tmpdir) / "spec.json")
+
+            start = time.perf_counter()
+            workflow = init_workflow(tmpdir, n_procs=n_procs)
+            duration = time.perf_counter() - start
+
+            n_subjects = len(workflow.get_node("subjectlevel")._graph)
+            n_nodes = len(workflow._get_all_nodes())
+            print(f"{n_procs:8d} {duration:7.2f}s {n_subjects:9d} {n_nodes:8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+save and load time of the cache codecs, compared to the lzma pickles that were used
+before the codecs were added
+
+the object is a workflow of nipype nodes, like the cached workflows and execgraphs,
+together with some arrays, like the cached bold headers and profile data
+
+usage: python benchmarks/bench_picklecodecs.py [n_nodes]
+"""
+
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+
+from pipeline.utils import picklecodecs, savepickle, loadpickle
+
+
+def make_obj(n_nodes):
+    workflow = pe.Workflow(name="bench")
+    prev = None
+    for i in range(n_nodes):
+        node = pe.Node(niu.IdentityInterface(fields=["a", "b"]), name=f"node{i}")
+        node.inputs.b = f"/path/to/sub-{i % 97:03d}/func/bold.nii.gz"
+        if prev is None:
+            workflow.add_nodes([node])
+        else:
+            workflow.connect(prev, "a", node, "a")
+        prev = node
+    arrays = [np.random.default_rng(i).normal(size=2 ** 17) for i in range(8)]
+    return dict(workflow=workflow, arrays=arrays)
+
+
+def main():
+    n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    obj = make_obj(n_nodes)
+
+    print(f"{'codec':8} {'save':>8} {'load':>8} {'size':>10}")
+    with TemporaryDirectory() as tmpdir:
+        for codec in picklecodecs:
+            if not codec.is_available():
+                continue
+            codec = codec()
+
+            start = time.perf_counter()
+            path = savepickle(Path(tmpdir) / codec.name, obj, codec=codec)
+            save_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            loadpickle(path)
+            load_s = time.perf_counter() - start
+
+            size_mib = path.stat().st_size / 2 ** 20
+            label = f"{codec.name}*" if codec.name == "xz" else codec.name
+            print(f"{label:8} {save_s:7.2f}s {load_s:7.2f}s {size_mib:7.1f}MiB")
+    print("* before, all cached objects were lzma pickles")
+
+
+if __name__ == "__main__":
+    main()
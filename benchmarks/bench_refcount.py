@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+time of the reference counting that decides which node directories can be deleted
+with keep some or none, compared to the previous implementation that scanned all
+referenced files for every finished job
+
+the jobs form chains, where each job references its own outputs and the outputs of
+the previous job in the chain. after each job, the previous job is popped and its
+directory is checked, like in _remove_node_dirs. the paths do not exist, so that only
+the index is timed, and not the listing of the output directories
+
+usage: python benchmarks/bench_refcount.py [n_jobs ...]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from pipeline.plugins.refcount import ReferenceCounter, realpath
+
+
+def iterpath(path):
+    for parent in reversed(path.parents):
+        if len(parent.name) > 0:
+            yield parent.name
+    yield path.name
+
+
+class PreviousReferenceCounter:
+    def __init__(self):
+        self.files = {}
+        self.sets = []
+
+    def addpath(self, path, jobid):  # resolves the path itself
+        curfiles = self.files
+        for elem in iterpath(Path(path).resolve()):
+            if elem not in curfiles:
+                curfiles[elem] = {}
+            curfiles = curfiles[elem]
+        if 0 not in curfiles or not isinstance(curfiles[0], set):
+            curfiles[0] = set()
+            self.sets.append(curfiles[0])
+        curfiles[0].add(jobid)
+
+    def pop(self, jobid):
+        for s in self.sets:
+            if jobid in s:
+                s.remove(jobid)
+
+    def can_delete(self, path):
+        curfiles = self.files
+        for elem in iterpath(Path(path)):
+            if elem not in curfiles:
+                return True
+            curfiles = curfiles[elem]
+        filesstack = [curfiles]
+        while len(filesstack) > 0:
+            files = filesstack.pop()
+            for k, v in files.items():
+                if k == 0:
+                    if len(v) > 0:
+                        return False
+                else:
+                    filesstack.append(v)
+        return True
+
+
+def run(rc, n_jobs, resolve=realpath, chain_length=20, n_files=3):
+    """
+    :param resolve: function to resolve the paths with, like put does
+    :return: list of the results of can_delete
+    """
+
+    def nodedir(jobid):
+        chain, step = divmod(jobid, chain_length)
+        return f"/work/nipype/sub-{chain:05d}_wf/step{step:02d}"
+
+    results = []
+    for jobid in range(n_jobs):
+        for i in range(n_files):
+            rc.addpath(resolve(f"{nodedir(jobid)}/out{i}.nii.gz"), jobid)
+        if jobid % chain_length > 0:  # inputs from the previous job
+            for i in range(n_files):
+                rc.addpath(resolve(f"{nodedir(jobid - 1)}/out{i}.nii.gz"), jobid)
+            rc.pop(jobid - 1)
+            results.append(rc.can_delete(nodedir(jobid - 1)))
+        results.append(rc.can_delete(nodedir(jobid)))
+    return results
+
+
+def main():
+    n_jobs_list = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+
+    print(f"{'jobs':>8} {'indexed':>9} {'before*':>9}")
+    for n_jobs in n_jobs_list:
+        start = time.perf_counter()
+        results = run(ReferenceCounter(), n_jobs)
+        indexed_s = time.perf_counter() - start
+
+        before = "-"
+        if n_jobs <= 10000:  # quadratic
+            start = time.perf_counter()
+            assert run(PreviousReferenceCounter(), n_jobs, resolve=str) == results
+            before = f"{time.perf_counter() - start:8.2f}s"
+        print(f"{n_jobs:8d} {indexed_s:8.2f}s {before:>9}")
+    print("* previous implementation, with the same results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+simulated makespan of an execgraph with the job orders of the MultiProc plugin
+
+the execgraph resembles the pipeline, with an anatomical registration and bold
+preprocessing, analyses and models per subject, and a model across subjects. the true
+runtimes differ from the runtime model in the scheduler, like they do for real data, and
+the recorded runtimes are noisy measurements of them like those in profile.jsonl
+
+the jobs are started like in _send_procs_to_workers, where the sorted ready jobs are
+started as long as they fit into the free processors
+
+usage: python benchmarks/bench_scheduler.py [n_subjects] [n_procs]
+"""
+
+import sys
+import heapq
+
+import numpy as np
+import networkx as nx
+
+from pipeline.plugins.scheduler import critical_path_lengths
+
+true_runtimes = {  # interface, name, runtime in seconds
+    ("Registration", "anat_norm_wf"): 900.0,
+    ("MCFLIRT", "mcflirt"): 300.0,
+    ("ICA_AROMA", "ica_aroma_wf"): 2400.0,
+    ("PlotEpi", "plot_epi"): 20.0,
+    ("ImageGLM", "image_glm"): 60.0,
+    ("ReHo", "reho"): 1500.0,  # not in the runtime model
+    ("SafeFLAMEO", "subjectlevel_flameo"): 120.0,
+    ("SafeFLAMEO", "grouplevel_flameo"): 600.0,
+}
+
+
+class Node:
+    def __init__(self, interfacename, name, subject):
+        self.interface = type(interfacename, (), dict())()
+        self.name = name
+        self.subject = subject
+        self.n_procs = 1
+
+    def __repr__(self):
+        return f"{self.name}.{self.subject}"
+
+
+def make_execgraph(n_subjects, rng):
+    graph = nx.DiGraph()
+    subjectlevel = []
+    for subject in range(n_subjects):
+        n_boldfiles = rng.integers(1, 5)
+        anat = Node("Registration", "anat_norm_wf", subject)
+        model = Node("SafeFLAMEO", "subjectlevel_flameo", subject)
+        for _ in range(n_boldfiles):
+            mcflirt = Node("MCFLIRT", "mcflirt", subject)
+            aroma = Node("ICA_AROMA", "ica_aroma_wf", subject)
+            glm = Node("ImageGLM", "image_glm", subject)
+            plot = Node("PlotEpi", "plot_epi", subject)
+            reho = Node("ReHo", "reho", subject)
+            graph.add_edges_from(
+                [
+                    (mcflirt, aroma),
+                    (anat, aroma),
+                    (aroma, glm),
+                    (aroma, reho),
+                    (mcflirt, plot),
+                    (glm, model),
+                ]
+            )
+        subjectlevel.append(model)
+    grouplevel = Node("SafeFLAMEO", "grouplevel_flameo", None)
+    graph.add_edges_from((model, grouplevel) for model in subjectlevel)
+    return graph
+
+
+def simulate(graph, durations, priority, n_procs):
+    """
+    :return: time until all jobs are done
+    """
+    n_waiting = {node: graph.in_degree(node) for node in graph}
+    ready = [node for node, n in n_waiting.items() if n == 0]
+    running = []  # heap of finish time and job
+    free_procs = n_procs
+    time = 0.0
+    order = {node: i for i, node in enumerate(graph)}
+    while ready or running:
+        ready.sort(key=priority)
+        for node in list(ready):
+            if node.n_procs <= free_procs:
+                free_procs -= node.n_procs
+                ready.remove(node)
+                heapq.heappush(running, (time + durations[node], order[node], node))
+        time, _, node = heapq.heappop(running)
+        free_procs += node.n_procs
+        for successor in graph.successors(node):
+            n_waiting[successor] -= 1
+            if n_waiting[successor] == 0:
+                ready.append(successor)
+    return time
+
+
+def main():
+    n_subjects = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n_procs = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    rng = np.random.default_rng(0)
+    graph = make_execgraph(n_subjects, rng)
+    tsort = {node: i for i, node in enumerate(nx.topological_sort(graph))}
+    durations = {
+        node: true_runtimes[(type(node.interface).__name__, node.name)] * rng.lognormal(0, 0.3)
+        for node in graph
+    }
+    runtimes = {  # mean of a few noisy measurements
+        key: float(np.mean(runtime * rng.lognormal(0, 0.3, size=5)))
+        for key, runtime in true_runtimes.items()
+    }
+
+    static = critical_path_lengths(graph)
+    recorded = critical_path_lengths(graph, runtimes=runtimes)
+    priorities = [
+        ("tsort", lambda node: tsort[node]),
+        ("critical-path, runtime model", lambda node: (-static[node], tsort[node])),
+        ("critical-path, recorded runtimes", lambda node: (-recorded[node], tsort[node])),
+    ]
+
+    longest = dict()  # with the true runtimes
+    for node in reversed(list(nx.topological_sort(graph))):
+        downstream = max((longest[s] for s in graph.successors(node)), default=0.0)
+        longest[node] = durations[node] + downstream
+    bound = max(sum(durations.values()) / n_procs, max(longest.values()))
+    print(f"{n_subjects} subjects, {len(graph)} jobs, {n_procs} processors")
+    print(f"{'lower bound':34} {bound / 3600:6.2f}h")
+    for name, priority in priorities:
+        makespan = simulate(graph, durations, priority, n_procs)
+        print(f"{name:34} {makespan / 3600:6.2f}h")
+
+
+if __name__ == "__main__":
+    main()
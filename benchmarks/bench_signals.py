@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+time and peak memory of img_to_signals, compared to the previous implementation that
+read the whole series with get_fdata and took the mean of each label per volume
+
+the series has the size of a bold image in template space, and the atlas has a few
+hundred labels. peak memory is measured with tracemalloc, which includes the numpy
+arrays but not the memory-mapped data
+
+usage: python benchmarks/bench_signals.py [n_volumes] [n_labels]
+"""
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import mean
+
+from pipeline.io.signals import img_to_signals, load_label_indicator
+
+
+def dense_img_to_signals(in_file, atlas_file, min_n_voxels=50):
+    in_data = nib.load(in_file).get_fdata()
+    labels = np.asanyarray(nib.load(atlas_file).dataobj).astype(np.int32)
+    nlabel = labels.max()
+
+    indices, counts = np.unique(labels, return_counts=True)
+    indices = indices[counts >= min_n_voxels]
+    indices = np.setdiff1d(indices, [0])
+
+    result = np.full((in_data.shape[3], nlabel), np.nan)
+    for i, img in enumerate(np.moveaxis(in_data, 3, 0)):
+        result[i, indices - 1] = mean(img, labels=labels, index=indices)
+    return result
+
+
+def measure(func, *args, **kwargs):
+    load_label_indicator.cache_clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def main():
+    n_volumes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_labels = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+
+    rng = np.random.default_rng(0)
+    shape = (97, 115, 97)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    brain = np.zeros(shape, dtype=bool)
+    brain[15:-15, 15:-15, 15:-15] = True
+    labels = np.where(brain, rng.integers(1, n_labels + 1, size=shape), 0).astype(np.int16)
+    data = rng.normal(100, 10, size=(*shape, n_volumes)).astype(np.float32)
+
+    with TemporaryDirectory() as tmpdir:
+        atlas_file = str(Path(tmpdir) / "atlas.nii.gz")
+        nib.save(nib.Nifti1Image(labels, affine), atlas_file)
+
+        print(f"{shape} x {n_volumes} volumes, {n_labels} labels")
+        print(f"{'':30} {'time':>8} {'peak':>10}")
+        for ext in ["nii", "nii.gz"]:
+            in_file = str(Path(tmpdir) / f"bold.{ext}")
+            nib.save(nib.Nifti1Image(data, affine), in_file)
+
+            expected, duration, peak = measure(dense_img_to_signals, in_file, atlas_file)
+            print(f"{'dense* ' + ext:30} {duration:7.2f}s {peak / 2 ** 20:7.0f}MiB")
+            for chunk_size in [None, 50]:
+                result, duration, peak = measure(
+                    img_to_signals, in_file, atlas_file, chunk_size=chunk_size
+                )
+                assert np.allclose(result, expected, equal_nan=True)
+                label = f"sparse {ext} chunk_size={chunk_size}"
+                print(f"{label:30} {duration:7.2f}s {peak / 2 ** 20:7.0f}MiB")
+    print("* before")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,15 @@
 
 """
 
+from array import array
 from hashlib import sha1
 import json
 from functools import lru_cache
 import logging
 
-from calamities.pattern import tag_glob, tag_parse, get_entities_in_path
+import numpy as np
+
+from calamities.pattern import tag_parse, get_entities_in_path
 
 from .spec import (
     TagsSchema,
@@ -20,6 +23,7 @@ from .spec import (
     tagnames,
     QualitycheckExcludeEntrySchema,
 )
+from .discovery import discover
 from .utils import first
 
 
@@ -29,9 +33,76 @@ def _resolve(tn):
     return tn
 
 
+class TagColumn:
+    """
+    values of one tag for all files as categorical codes, with -1 for files that
+    don't have the tag
+    """
+
+    def __init__(self):
+        self.tagvals = list()  # code -> tagval
+        self.codes = dict()  # tagval -> code
+
+        self.pending_fileids = array("q")
+        self.pending_codes = array("q")
+
+        self.codearray = np.zeros((0,), dtype=np.int32)
+        self.order = None
+        self.bounds = None
+
+        self.tagvaldict = None  # tagval -> set of filepaths, built on demand
+
+    def set(self, fileid, tagval):
+        code = self.codes.get(tagval)
+        if code is None:
+            code = len(self.tagvals)
+            self.codes[tagval] = code
+            self.tagvals.append(tagval)
+        self.pending_fileids.append(fileid)
+        self.pending_codes.append(code)
+        self.order, self.bounds = None, None
+        self.tagvaldict = None
+
+    def array(self, n):
+        """
+        :param n: number of files in the database
+        :return: code of each file
+        """
+        if len(self.codearray) < n:
+            codearray = np.full((n,), -1, dtype=np.int32)
+            codearray[: len(self.codearray)] = self.codearray
+            self.codearray = codearray
+        if len(self.pending_fileids) > 0:
+            fileids = np.frombuffer(self.pending_fileids, dtype=np.int64)
+            self.codearray[fileids] = np.frombuffer(self.pending_codes, dtype=np.int64)
+            self.pending_fileids, self.pending_codes = array("q"), array("q")
+        return self.codearray
+
+    def posting(self, code, n):
+        """
+        :return: sorted file ids of the files with the tag value
+        """
+        if self.order is None:
+            codearray = self.array(n)
+            self.order = np.argsort(codearray, kind="stable")
+            self.bounds = np.searchsorted(
+                codearray[self.order], np.arange(len(self.tagvals) + 1), side="left"
+            )
+        return self.order[self.bounds[code] : self.bounds[code + 1]]
+
+
 class Database:
-    def __init__(self, files=[]):
-        self.filepaths_by_tags = dict()
+    """
+    files are numbered in the order they are added. every tag is stored as a TagColumn,
+    so that queries are array operations on file ids
+    """
+
+    def __init__(self, files=[], workdir=None):
+        self.workdir = workdir  # for the directory snapshot
+        self.filepaths = list()  # fileid -> filepath
+        self.fileids = dict()  # filepath -> fileid
+        self.columns = dict()  # tagname -> TagColumn
+
         self.tags_by_filepaths = dict()
 
         self.fileobj_by_filepaths = dict()
@@ -40,8 +111,7 @@ class Database:
         self.filepaths_by_tmplstr = dict()
 
         self.tags_schema = TagsSchema()
-        for file_obj in files:
-            self.add_file_obj(file_obj)
+        self.add_file_objs(files)
 
     def __hash__(self):
         return hash(tuple(self.tags_by_filepaths.keys()))
@@ -52,10 +122,16 @@ class Database:
             hash.update(filepath.encode())
         return hash.hexdigest()
 
+    def add_file_objs(self, file_objs):
+        tagglobress = discover([file_obj.path for file_obj in file_objs], workdir=self.workdir)
+        for file_obj, tagglobres in zip(file_objs, tagglobress):
+            self._add_tagglobres(file_obj, tagglobres)
+
     def add_file_obj(self, file_obj):
-        othertagdict = self.tags_schema.dump(file_obj.tags)
+        self.add_file_objs([file_obj])
 
-        tagglobres = list(tag_glob(file_obj.path))
+    def _add_tagglobres(self, file_obj, tagglobres):
+        othertagdict = self.tags_schema.dump(file_obj.tags)
 
         if len(tagglobres) == 0:
             logging.getLogger("pipeline").warning(
@@ -79,44 +155,80 @@ class Database:
             self.tmplstr_by_filepaths[filepath] = tmplstr
             self.filepaths_by_tmplstr[tmplstr].append(filepath)
 
+            fileid = self._add_filepath(filepath)
             for tagname in tagnames:
                 tagval = getattr(tags_obj, tagname, None)
-                self.set_file_tag(filepath, tagname, tagval)
+                if tagval is not None:
+                    self._get_column(tagname).set(fileid, tagval)
+
+    def _add_filepath(self, filepath):
+        fileid = self.fileids.get(filepath)
+        if fileid is None:
+            fileid = len(self.filepaths)
+            self.fileids[filepath] = fileid
+            self.filepaths.append(filepath)
+        return fileid
+
+    def _get_column(self, tagname):
+        column = self.columns.get(tagname)
+        if column is None:
+            column = TagColumn()
+            self.columns[tagname] = column
+        return column
 
     def set_file_tag(self, filepath, tagname, tagval):
         if tagval is None:
             return
-        if tagname not in self.filepaths_by_tags:
-            self.filepaths_by_tags[tagname] = dict()
-        tagvaldict = self.filepaths_by_tags[tagname]
-        if tagval not in tagvaldict:
-            tagvaldict[tagval] = set()
-        tagvaldict[tagval].add(filepath)
-
-    def get(self, **filters):
-        res = None
+        fileid = self._add_filepath(filepath)
+        self._get_column(tagname).set(fileid, tagval)
+
+    def _get_fileids(self, filepaths):
+        fileids = list(map(self.fileids.get, filepaths))
+        if None in fileids:  # not in the database
+            fileids = [fileid for fileid in fileids if fileid is not None]
+        return np.array(fileids, dtype=np.int64)
+
+    def _get_filepaths(self, fileids):
+        return list(map(self.filepaths.__getitem__, fileids.tolist()))
+
+    def _filter_fileids(self, fileids, tagname, tagval):
+        column = self.columns[tagname]
+        code = column.codes[tagval]
+        return fileids[column.array(len(self.filepaths))[fileids] == code]
+
+    def _get_fileids_by_tags(self, **filters):
+        n = len(self.filepaths)
+        postings = list()
         for tagname, tagval in filters.items():
             tagname = _resolve(tagname)
-            if tagname in self.filepaths_by_tags and tagval in self.filepaths_by_tags[tagname]:
-                cur_set = self.filepaths_by_tags[tagname][tagval]
-                if res is not None:
-                    res &= cur_set
-                else:
-                    res = cur_set.copy()
-            else:
-                res = None
-                break
-        if res is None:
+            column = self.columns.get(tagname)
+            if column is None or tagval not in column.codes:
+                return None
+            postings.append((column, column.codes[tagval]))
+        if len(postings) == 0:
+            return None
+
+        # start from the tag value with the fewest files
+        postings.sort(key=lambda posting: len(posting[0].posting(posting[1], n)))
+        column, code = postings[0]
+        fileids = column.posting(code, n)
+        for column, code in postings[1:]:
+            fileids = fileids[column.array(n)[fileids] == code]
+        return fileids
+
+    def get(self, **filters):
+        fileids = self._get_fileids_by_tags(**filters)
+        if fileids is None:
             return set()
-        return res
+        return set(self._get_filepaths(fileids))
 
     def filter(self, filepaths, **filters):
-        res = set(filepaths)
+        if len(filters) == 0:
+            return set(filepaths)
+        fileids = self._get_fileids(filepaths)
         for tagname, tagval in filters.items():
-            tagname = _resolve(tagname)
-            cur_set = self.filepaths_by_tags[tagname][tagval]
-            res &= cur_set
-        return res
+            fileids = self._filter_fileids(fileids, _resolve(tagname), tagval)
+        return set(self._get_filepaths(fileids))
 
     def matches(self, filepath, **filters):
         for tagname, querytagval in filters.items():
@@ -131,7 +243,9 @@ class Database:
             return
         if tagsobj.datatype != "func" or tagsobj.suffix != "bold":
             return
-        res = self.get(**filters)
+        res = self._get_fileids_by_tags(**filters)
+        if res is None:
+            return
         for entity in bold_entities:
             if entity == "direction" and "direction" not in get_entities_in_path(
                 self.tmplstr_by_filepaths[filepath]
@@ -141,15 +255,13 @@ class Database:
             tagval = getattr(tagsobj, entity)
             if tagval is None:
                 continue
-            cur_set = res & self.filepaths_by_tags[entity][tagval]
-            if len(cur_set) > 0:
-                res = cur_set
-            if len(cur_set) == 1:
+            cur = self._filter_fileids(res, entity, tagval)
+            if len(cur) > 0:
+                res = cur
+            if len(cur) == 1:
                 break
-        if len(res) == 1:
-            return (res.pop(),)
-        elif len(res) > 1:
-            return tuple(res)
+        if len(res) > 0:
+            return tuple(self._get_filepaths(res))
 
     def get_tagval(self, filepath, tagname):
         if isinstance(filepath, (list, tuple)):
@@ -159,15 +271,22 @@ class Database:
             return getattr(tagsobj, _resolve(tagname), None)
 
     def get_tagvaldict(self, entity):
-        return self.filepaths_by_tags.get(_resolve(entity))
+        column = self.columns.get(_resolve(entity))
+        if column is None:
+            return
+        if column.tagvaldict is None:
+            n = len(self.filepaths)
+            column.tagvaldict = {
+                tagval: set(self._get_filepaths(column.posting(code, n)))
+                for code, tagval in enumerate(column.tagvals)
+            }
+        return column.tagvaldict
 
     def get_all_with_tag(self, entity):
-        tagvaldict = self.filepaths_by_tags.get(_resolve(entity))
-        if tagvaldict is None:
+        column = self.columns.get(_resolve(entity))
+        if column is None:
             return
-        for tagval, filepaths in tagvaldict.items():
-            if tagval is not None:
-                yield from filepaths
+        yield from self._get_filepaths(np.flatnonzero(column.array(len(self.filepaths)) >= 0))
 
     def get_tags(self, filepath):
         return self.tags_by_filepaths.get(filepath)
@@ -179,41 +298,74 @@ class Database:
         if not isinstance(tagname, str):
             return
         tagname = _resolve(tagname)
-        if tagname not in self.filepaths_by_tags:
+        column = self.columns.get(tagname)
+        if column is None:
             return
         if filepaths is not None:
-            if not isinstance(filepaths, set):
-                filepaths = set(filepaths)
-            return set(
-                tagval
-                for tagval, tagvalfilepaths in self.filepaths_by_tags[tagname].items()
-                if not filepaths.isdisjoint(tagvalfilepaths)
-            )
+            # stop early once all tag values were seen, which for tags with few values
+            # is much sooner than converting all filepaths to file ids
+            codearray = memoryview(column.array(len(self.filepaths)))
+            codes = set()
+            for fileid in map(self.fileids.get, filepaths):
+                if fileid is None:
+                    continue
+                code = codearray[fileid]
+                if code >= 0:
+                    codes.add(code)
+                    if len(codes) == len(column.tagvals):
+                        break
+            return set(column.tagvals[code] for code in codes)
         else:
-            return set(self.filepaths_by_tags[tagname].keys())
+            return set(column.tagvals)
 
     def get_multi_tagval_set(self, tagnames, filepaths=None, prune=True):
+        n = len(self.filepaths)
+        if filepaths is None:
+            fileids = np.arange(n)
+        else:
+            fileids = self._get_fileids(filepaths)
+
+        codearrays = dict()  # tagname -> code of each file, or None if no file has the tag
+
+        def get_codearray(tn):
+            if tn not in codearrays:
+                column = self.columns.get(_resolve(tn))
+                codearrays[tn] = column.array(n)[fileids] if column is not None else None
+            return codearrays[tn]
+
         def prunefun(tn):
-            tagval_set = self.get_tagval_set(tn, filepaths=filepaths)
-            return tagval_set is not None and len(tagval_set) > 1
+            if not isinstance(tn, str) or get_codearray(tn) is None:
+                return False
+            if filepaths is None:
+                return len(self.columns[_resolve(tn)].tagvals) > 1
+            codes = np.unique(get_codearray(tn))
+            return np.count_nonzero(codes >= 0) > 1
 
         if prune:
             tagnames = [tn for tn in tagnames if prunefun(tn)]
-        resolvedtagnames = [_resolve(tn) for tn in tagnames]
+        if len(tagnames) == 0:
+            return tagnames, set([()]) if len(fileids) > 0 else set()
+
+        columns = [self.columns.get(_resolve(tn)) for tn in tagnames]
+        codematrix = np.full((len(fileids), len(tagnames)), -1, dtype=np.int64)
+        for i, tn in enumerate(tagnames):
+            if get_codearray(tn) is not None:
+                codematrix[:, i] = get_codearray(tn)
+
+        # combine the codes of each file into one integer if it fits
+        radices = [len(column.tagvals) + 1 if column is not None else 1 for column in columns]
+        if np.prod(radices, dtype=float) < 2 ** 62:
+            keys = np.ravel_multi_index(tuple((codematrix + 1).T), radices)
+            _, index = np.unique(keys, return_index=True)
+            codematrix = codematrix[index]
+        else:
+            codematrix = np.unique(codematrix, axis=0)
 
-        if filepaths is None:
-            filepaths = self.tags_by_filepaths.keys()
-
-        return (
-            tagnames,
-            set(
-                tuple(
-                    getattr(self.tags_by_filepaths[filepath], tn, None) for tn in resolvedtagnames
-                )
-                for filepath in filepaths
-                if filepath in self.tags_by_filepaths
-            ),
-        )
+        tagvalarrays = list()
+        for column, codes in zip(columns, codematrix.T.tolist()):
+            tagvals = [*column.tagvals, None] if column is not None else [None]
+            tagvalarrays.append(list(map(tagvals.__getitem__, codes)))  # -1 is None
+        return tagnames, set(zip(*tagvalarrays))
 
     def get_tmplstr(self, filepaths):
         if isinstance(filepaths, str):
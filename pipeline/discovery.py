@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+find the files for many tag glob patterns in one walk of the file system
+
+"""
+
+import os
+from os import path as op
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from calamities.pattern import tag_glob, tag_parse, has_magic, get_entities_in_path
+from calamities.pattern.glob import _translate  # same matching as tag_glob
+
+from .utils import cacheobj, uncacheobj
+
+logger = logging.getLogger("pipeline")
+
+racy_ns = 2 * 10 ** 9  # listings of directories modified this recently are not kept
+
+
+def listdir(dirpath):
+    """
+    list a directory like tag_glob does, with a trailing slash for directories and
+    without hidden entries
+    """
+    names = list()
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    name = entry.name
+                    if entry.is_dir():
+                        name = op.join(name, "")
+                    if name[0] != ".":
+                        names.append(name)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return tuple(names)
+
+
+class DirectorySnapshot:
+    """
+    listings of directories keyed by their modification time. adding, removing or
+    renaming an entry updates the modification time of the directory, so a listing
+    can be reused as long as the time is unchanged
+
+    :param listings: dict mapping directory path to a tuple of mtime_ns and names
+    """
+
+    def __init__(self, listings=None):
+        self.listings = dict()
+        if listings is not None:
+            self.listings.update(listings)
+
+    def listdir(self, dirpath):
+        """
+        :return: names in the directory, and whether the listing was reused
+        """
+        try:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return tuple(), False
+
+        listing = self.listings.get(dirpath)
+        if listing is not None and listing[0] == mtime_ns:
+            return listing[1], True
+
+        start_ns = time.time_ns()
+        names = listdir(dirpath)
+        if mtime_ns < start_ns - racy_ns:  # otherwise the directory may change unnoticed
+            self.listings[dirpath] = (mtime_ns, names)
+        else:
+            self.listings.pop(dirpath, None)
+        return names, False
+
+
+class ComponentMatcher:
+    """
+    match names against one component of a pattern. tag_glob compiles a regular
+    expression for every directory, with the values of the tags of the parent
+    directories as literals. here these tags are matched as free groups by an
+    expression that is compiled once, and their values are compared afterwards
+
+    :param component: the component of the pattern
+    :param parenttagnames: the tags that were matched in the parent directories
+    """
+
+    def __init__(self, component, parenttagnames):
+        self.component = component
+        self.parenttagnames = [
+            tagname for tagname in get_entities_in_path(component) if tagname in parenttagnames
+        ]
+
+        def unfilter(matchobj):
+            tagname = matchobj.group("tag_name")
+            if tagname in self.parenttagnames:
+                return f"{{{tagname}}}"
+            return matchobj.group(0)
+
+        self.free = _translate(tag_parse.sub(unfilter, component), None, dict())
+        self.exact = dict()
+
+    def match_exact(self, name, parenttagdict):
+        key = tuple(parenttagdict.values())
+        if key not in self.exact:
+            self.exact[key] = _translate(self.component, None, parenttagdict)
+        matchobj = self.exact[key](name)
+        if matchobj is not None:
+            return matchobj.groupdict()
+
+    def match(self, name, tagdict):
+        """
+        :return: the tag dict of the match, without the tags of the parent directories,
+            or None
+        """
+        parenttagdict = {tagname: tagdict[tagname] for tagname in self.parenttagnames}
+        if any("/" in tagval for tagval in parenttagdict.values()):
+            return self.match_exact(name, parenttagdict)
+
+        matchobj = self.free(name)
+        if matchobj is None:
+            return  # the free groups match at least what the literals match
+        groupdict = matchobj.groupdict()
+        if any(groupdict[tagname] != tagval for tagname, tagval in parenttagdict.items()):
+            return self.match_exact(name, parenttagdict)  # another split may match
+        for tagname in self.parenttagnames:
+            del groupdict[tagname]
+        return groupdict
+
+
+def _split(pathname):
+    """
+    split a pattern like tag_glob does
+
+    :return: the directory to start at, and the components to match below it, or
+        None for relative patterns
+    """
+    components = list()
+    while True:
+        dirname, basename = op.split(pathname)
+        if not dirname:
+            return None
+        components.insert(0, basename)
+        if dirname == pathname or not has_magic(dirname):
+            return dirname, components
+        pathname = dirname
+
+
+def discover(pathnames, workdir=None, max_workers=16):
+    """
+    the results are the same as from calling tag_glob for each pattern, but the patterns
+    are matched together level by level, so that every directory is only listed once,
+    and the directories of each level are listed in parallel
+
+    :param pathnames: list of tag glob patterns
+    :param workdir: directory for the snapshot file, or None to not use a snapshot
+    :return: list with the tuples of file path and tag dict for each pattern
+    """
+    snapshot = None
+    if workdir is not None:
+        snapshot = uncacheobj(workdir, "dirsnapshot", None)
+    if not isinstance(snapshot, DirectorySnapshot):
+        snapshot = DirectorySnapshot()
+    n_snapshot = len(snapshot.listings)
+
+    results = [list() for _ in pathnames]
+
+    matchers = dict()
+
+    def get_matcher(component, tagdict):
+        key = (component, *tagdict.keys())
+        if key not in matchers:
+            matchers[key] = ComponentMatcher(component, tagdict.keys())
+        return matchers[key]
+
+    states = list()  # pattern index, components, level, directory path and tag dict
+    for i, pathname in enumerate(pathnames):
+        split = _split(pathname)
+        if split is None:
+            results[i].extend(tag_glob(pathname))
+            continue
+        dirname, components = split
+        states.append((i, components, 0, dirname, dict()))
+
+    listings = dict()
+    n_reused = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(states) > 0:
+            dirpaths = [
+                dirpath
+                for dirpath in dict.fromkeys(state[3] for state in states)
+                if dirpath not in listings
+            ]
+            for dirpath, (names, is_reused) in zip(
+                dirpaths, executor.map(snapshot.listdir, dirpaths)
+            ):
+                listings[dirpath] = names
+                n_reused += is_reused
+
+            newstates = list()
+            for i, components, level, dirpath, tagdict in states:
+                matcher = get_matcher(components[level], tagdict)
+                is_last = level == len(components) - 1
+                for name in listings[dirpath]:
+                    if not is_last and not name.endswith("/"):
+                        continue  # only directories can have matches below them
+                    groupdict = matcher.match(name, tagdict)
+                    if groupdict is None:
+                        continue
+                    path = op.join(dirpath, name)
+                    pathtagdict = {**groupdict, **tagdict}
+                    if is_last:
+                        results[i].append((path, pathtagdict))
+                    else:
+                        newstates.append((i, components, level + 1, path, pathtagdict))
+            states = newstates
+
+    logger.debug(f"Listed {len(listings) - n_reused} directories, reused {n_reused} listings")
+
+    if workdir is not None:
+        listings = {
+            dirpath: snapshot.listings[dirpath]
+            for dirpath in listings
+            if dirpath in snapshot.listings
+        }
+        if n_reused < n_snapshot or n_reused < len(listings):  # entries removed or added
+            cacheobj(workdir, "dirsnapshot", DirectorySnapshot(listings))
+
+    return results
@@ -3,17 +3,25 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
 import logging
-from itertools import islice
 from os import path as op
+from pathlib import Path
+from copy import deepcopy
+import hashlib
+import heapq
+import pickle
 
 import numpy as np
 import networkx as nx
 
 import nipype.pipeline.engine as pe
+from nipype.interfaces import utility as niu
+from nipype.utils.misc import str2bool
 
 from .interface import LoadResult
-from .utils import cacheobj, uncacheobj, first, hexdigest
-from .io import init_indexed_js_object_file, IndexedFile
+from .interface.cache import load_result_outputs
+from .utils import cacheobj, uncacheobj, prunecache, findpickle, loadpickle, first, hexdigest
+from .io import init_indexed_js_object_file, IndexedFile, ProfileStore
+from .plugins.scheduler import estimate_runtime
 
 max_chunk_size = 50  # subjects
 
@@ -25,14 +33,319 @@ class DontRunRunner:
         pass
 
 
-def init_execgraph(workdir, workflow, n_chunks=None, subject_chunks=None):
+class ExecgraphChunks:
+    """
+    execgraph split where each chunk is stored in its own file, so that a chunk is only
+    read from disk when it is accessed. the last chunk is the grouplevel execgraph
+    """
+
+    def __init__(self, workdir, typestr, uuid, n_chunks):
+        self.workdir = workdir
+        self.typestr = typestr
+        self.uuid = uuid
+        self.n_chunks = n_chunks
+        self.boundaries = [dict() for _ in range(n_chunks)]  # result files used by grouplevel
+
+    def _chunktypestr(self, index):
+        if index == self.n_chunks:
+            return f"{self.typestr}.grouplevel"
+        return f"{self.typestr}.chunk_{index + 1:03d}"
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Execgraph chunk index {index} out of range")
+        return index
+
+    def __len__(self):
+        return self.n_chunks + 1
+
+    def __getitem__(self, index):
+        typestr = self._chunktypestr(self._index(index))
+        execgraph = uncacheobj(self.workdir, typestr, self.uuid, typedisplaystr="execgraph chunk")
+        if execgraph is None:
+            raise ValueError(f'Missing execgraph chunk "{typestr}" in "{self.workdir}"')
+        if self._index(index) == self.n_chunks:
+            self._set_cached_outputs(execgraph)
+        return execgraph
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def put(self, index, execgraph):
+        typestr = self._chunktypestr(self._index(index))
+        cacheobj(self.workdir, typestr, execgraph, uuid=self.uuid)
+
+    def put_results(self, index):
+        """
+        collect the outputs that the grouplevel chunk needs from a subjectlevel chunk
+        into a single file after the chunk has run
+        """
+        index = self._index(index)
+        results = dict()
+        for resultfilepath, attrs in self.boundaries[index].items():
+            if not op.isfile(resultfilepath):
+                continue  # node has failed, so grouplevel will fail as well
+            results[resultfilepath] = load_result_outputs(resultfilepath, attrs)
+        typestr = f"{self._chunktypestr(index)}.results"
+        cacheobj(self.workdir, typestr, results, uuid=self.uuid)
+
+    def _set_cached_outputs(self, execgraph):
+        results = dict()
+        for index in range(self.n_chunks):
+            typestr = f"{self._chunktypestr(index)}.results"
+            path = findpickle(Path(self.workdir) / f"{typestr}.{str(self.uuid)[:8]}")
+            if path is not None:
+                results.update(loadpickle(path))
+        n_cached = 0
+        for node in execgraph.nodes():
+            if not isinstance(node.interface, LoadResult):
+                continue
+            cachedoutputs = results.get(node.interface.resultfilepath)
+            if cachedoutputs is not None:
+                node.interface.set_cached_outputs(cachedoutputs)
+                n_cached += 1
+        logging.getLogger("pipeline").info(
+            f"Using collected subjectlevel results for {n_cached} grouplevel inputs"
+        )
+
+
+def estimate_subject_costs(workdir, subjectworkflows):
+    """
+    estimated runtime of each subject, using the recorded runtimes of previous runs
+    where they are available
+
+    :param subjectworkflows: dict mapping subject workflow names to sets of execgraph nodes
+    :return: dict mapping subject workflow names to estimated runtimes in seconds
+    """
+    runtimes = ProfileStore(workdir).runtimes()
+    return {
+        name: sum(estimate_runtime(node, runtimes) for node in nodes)
+        for name, nodes in subjectworkflows.items()
+    }
+
+
+def balanced_chunks(costs, n_chunks):
+    """
+    longest processing time first bin-packing, where each subject goes to the chunk
+    with the lowest total cost so far
+
+    :param costs: dict mapping keys to costs
+    :return: list of lists of keys, in the original order of the keys within each chunk
+    """
+    order = {key: i for i, key in enumerate(costs)}
+    heap = [(0.0, i) for i in range(n_chunks)]
+    chunks = [[] for _ in range(n_chunks)]
+    for key in sorted(costs, key=lambda key: (-costs[key], order[key])):
+        load, i = heapq.heappop(heap)
+        chunks[i].append(key)
+        heapq.heappush(heap, (load + costs[key], i))
+    return [sorted(chunk, key=order.get) for chunk in chunks if len(chunk) > 0]
+
+
+def _subject_key(workflow, subjectworkflow):
+    """
+    content hash of everything that goes into the expansion of a subject workflow,
+    which includes the subject's files and the analysis settings. the resource usage
+    that is recorded in the profile store is only applied to the nodes when they are
+    run, so it does not change the hash
+    """
+    m = hashlib.sha1()
+    m.update(
+        pickle.dumps(
+            (workflow.name, workflow.base_dir, workflow.config, subjectworkflow),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    )
+    return m.hexdigest()
+
+
+def _expand(workflow, nodes):
+    """
+    expand some of the top level nodes of a workflow as if the whole workflow was expanded
+    """
+    partial = pe.Workflow(name=workflow.name, base_dir=workflow.base_dir)
+    partial.config = deepcopy(workflow.config)
+    partial.config["execution"]["create_report"] = False  # would overwrite the full report
+    partial.add_nodes(list(nodes))
+    return partial.run(plugin=DontRunRunner())
+
+
+def _is_removed_on_expansion(node):
+    return (
+        isinstance(node.interface, niu.IdentityInterface)
+        and not hasattr(node, "joinsource")
+        and node.iterables is None
+    )
+
+
+def _resolve_output(workflow, parameter, hierarchy):
+    """
+    follow a workflow output through the identity nodes that are removed on expansion
+
+    :param workflow: workflow that the parameter refers to
+    :param parameter: dotted path to a node output inside the workflow
+    :param hierarchy: list of the names of the workflow and its parents
+    :return: fullname of the node in the execgraph that provides the output, and its field
+    """
+    *names, field = parameter.split(".")
+    for name in names[:-1]:
+        workflow = workflow.get_node(name)
+        hierarchy = [*hierarchy, name]
+    node = workflow.get_node(names[-1])
+    if node is None or isinstance(node, pe.Workflow):
+        raise ValueError(f'Cannot find node for "{parameter}"')
+
+    if not _is_removed_on_expansion(node):
+        return ".".join([*hierarchy, node.name]), field
+
+    for u, _, d in workflow._graph.in_edges(node, data=True):
+        for src, dst in d["connect"]:
+            if dst != field:
+                continue
+            if isinstance(src, tuple):
+                raise ValueError(f'Cannot splice connect function for "{parameter}"')
+            if isinstance(u, pe.Workflow):
+                return _resolve_output(u, src, [*hierarchy, u.name])
+            return _resolve_output(workflow, f"{u.name}.{src}", hierarchy)
+
+    raise ValueError(f'Output "{parameter}" is not connected inside its workflow')
+
+
+def _resolve_input(workflow, parameter, hierarchy):
+    *names, field = parameter.split(".")
+    node = workflow.get_node(".".join(names))
+    if node is None or isinstance(node, pe.Workflow) or _is_removed_on_expansion(node):
+        raise ValueError(f'Cannot splice input "{parameter}"')
+    return ".".join([*hierarchy, *names]), field
+
+
+def _expand_incrementally(workdir, workflow):
+    """
+    expand subject workflows separately, re-using cached expansions of unchanged subjects,
+    and splice them together with the grouplevel nodes
+    """
+    logger = logging.getLogger("pipeline")
+
+    subjectlevelworkflow = workflow.get_node("subjectlevel")
+    if subjectlevelworkflow is None:
+        raise ValueError("Missing subjectlevel workflow")
+    toplevelnodes = list(workflow._graph.nodes())
+    othernodes = [node for node in toplevelnodes if node is not subjectlevelworkflow]
+    for node in othernodes:
+        if not isinstance(node, pe.Workflow):
+            raise ValueError(f'Unexpected top level node "{node.name}"')
+    subjectworkflows = list(subjectlevelworkflow._graph.nodes())
+    if subjectlevelworkflow._graph.number_of_edges() > 0:
+        raise ValueError("Subject workflows are connected to each other")
+
+    # connections from the subjects to the grouplevel
+    connections = []
+    for u, v, d in workflow._graph.edges(data=True):
+        if u is not subjectlevelworkflow or v is subjectlevelworkflow:
+            raise ValueError(f'Unexpected connection from "{u.name}" to "{v.name}"')
+        for src, dst in d["connect"]:
+            if isinstance(src, tuple):
+                raise ValueError(f'Cannot splice connect function for "{src[0]}"')
+            connections.append(
+                (
+                    *_resolve_output(u, src, [workflow.name, u.name]),
+                    *_resolve_input(v, dst, [workflow.name, v.name]),
+                )
+            )
+
+    cachedir = Path(workdir) / "execgraph.subjects"
+    cachedir.mkdir(exist_ok=True)
+
+    execgraphs = []
+    subjectkeys = dict()
+    usedsubjectkeys = list()
+    for subjectworkflow in subjectworkflows:
+        subjectkey = _subject_key(workflow, subjectworkflow)
+        usedsubjectkeys.append(subjectkey)
+        subjectexecgraph = uncacheobj(cachedir, "execgraph", subjectkey)
+        if subjectexecgraph is None:
+            subjectkeys[subjectworkflow.name] = subjectkey
+        else:
+            execgraphs.append(subjectexecgraph)
+    logger.info(
+        f"Re-using {len(execgraphs)} cached subject execgraphs, "
+        f"expanding {len(subjectkeys)} subject workflows"
+    )
+
+    if len(subjectkeys) > 0:
+        partialsubjectlevelworkflow = pe.Workflow(name=subjectlevelworkflow.name)
+        partialsubjectlevelworkflow.add_nodes(
+            [w for w in subjectworkflows if w.name in subjectkeys]
+        )
+        newexecgraph = _expand(workflow, [partialsubjectlevelworkflow])
+        subjectnodes = dict()
+        for node in newexecgraph.nodes():
+            subjectworkflowname = node._hierarchy.split(".")[2]
+            if subjectworkflowname not in subjectnodes:
+                subjectnodes[subjectworkflowname] = set()
+            subjectnodes[subjectworkflowname].add(node)
+        for subjectworkflowname, subjectkey in subjectkeys.items():
+            subjectexecgraph = newexecgraph.subgraph(
+                subjectnodes.get(subjectworkflowname, set())
+            ).copy()
+            subjectexecgraph.uuid = subjectkey
+            cacheobj(cachedir, "execgraph", subjectexecgraph, uuid=subjectkey)
+            execgraphs.append(subjectexecgraph)
+
+    n_removed = prunecache(cachedir, "execgraph", usedsubjectkeys)  # from previous specs
+    if n_removed > 0:
+        logger.info(f"Removed {n_removed} stale cached subject execgraphs")
+
+    if len(othernodes) > 0:
+        execgraphs.append(_expand(workflow, othernodes))
+
+    execgraph = nx.compose_all(execgraphs) if len(execgraphs) > 1 else execgraphs[0]
+
+    # splice
+    nodes_by_fullname = {node.fullname: node for node in execgraph.nodes()}
+    set_needed_outputs = str2bool(workflow.config["execution"]["remove_unnecessary_outputs"])
+    for srcname, srcfield, dstname, dstfield in connections:
+        if srcname not in nodes_by_fullname or dstname not in nodes_by_fullname:
+            raise ValueError(f'Cannot find "{srcname}" or "{dstname}" in execgraph')
+        u = nodes_by_fullname[srcname]
+        v = nodes_by_fullname[dstname]
+        d = execgraph.get_edge_data(u, v)
+        if d is None:
+            execgraph.add_edge(u, v, connect=[(srcfield, dstfield)])
+        else:
+            d["connect"].append((srcfield, dstfield))
+        # same as what nipype does in Workflow._set_needed_outputs and _configure_exec_nodes
+        if set_needed_outputs and srcfield not in u.needed_outputs:
+            u.needed_outputs = sorted([*u.needed_outputs, srcfield])
+        v.input_source[dstfield] = (op.join(u.output_dir(), f"result_{u.name}.pklz"), srcfield)
+
+    for index, node in enumerate(execgraph.nodes()):
+        node.index = index
+
+    return execgraph
+
+
+def expand_workflow(workdir, workflow):
+    try:
+        return _expand_incrementally(workdir, workflow)
+    except ValueError as e:
+        logging.getLogger("pipeline").warning(
+            f"Expanding whole workflow, because it cannot be expanded per subject: {e}"
+        )
+        return workflow.run(plugin=DontRunRunner())
+
+
+def init_execgraph(workdir, workflow, n_chunks=None, subject_chunks=None, chunk_strategy="equal"):
     logger = logging.getLogger("pipeline")
 
     uuid = workflow.uuid
     execgraph = uncacheobj(workdir, "execgraph", uuid)
     if execgraph is None:
         # create execgraph
-        execgraph = workflow.run(plugin=DontRunRunner())
+        execgraph = expand_workflow(workdir, workflow)
         execgraph.uuid = uuid
         uuidstr = str(uuid)[:8]
         logger.info(f"New execgraph: {uuidstr}")
@@ -69,21 +382,42 @@ def init_execgraph(workdir, workflow, n_chunks=None, subject_chunks=None):
         if subject_chunks:
             n_chunks = len(subjectworkflows)
 
+        is_balanced = chunk_strategy == "balanced" and not subject_chunks
+
         typestr = f"execgraph.{n_chunks:02d}_chunks"
+        if is_balanced:
+            typestr = f"execgraph.{n_chunks:02d}_balanced_chunks"
         execgraphs = uncacheobj(workdir, typestr, uuid, typedisplaystr="execgraph split")
         if execgraphs is not None:
+            if isinstance(execgraphs, ExecgraphChunks):
+                execgraphs.workdir = workdir
             return execgraphs
 
         logger.info(f"New execgraph split with {n_chunks} chunks")
 
-        execgraphs = []
-        chunks = np.array_split(np.arange(len(subjectworkflows)), n_chunks)
-        partitioniter = iter(subjectworkflows.values())
-        for chunk in chunks:
-            nodes = set.union(
-                *islice(partitioniter, len(chunk))
-            )  # take len(chunk) subjects and create union
-            execgraphs.append(execgraph.subgraph(nodes).copy())
+        subjectworkflownames = list(subjectworkflows.keys())
+        if is_balanced:
+            costs = estimate_subject_costs(workdir, subjectworkflows)
+            chunks = balanced_chunks(costs, n_chunks)
+            n_chunks = len(chunks)
+            chunkcosts = [sum(costs[name] for name in chunk) / 3600 for chunk in chunks]
+            logger.info(
+                f"Estimated chunk runtimes are between {min(chunkcosts):.1f} "
+                f"and {max(chunkcosts):.1f} hours"
+            )
+        else:
+            chunks = [
+                [subjectworkflownames[i] for i in chunk]
+                for chunk in np.array_split(np.arange(len(subjectworkflownames)), n_chunks)
+            ]
+
+        # write each chunk as soon as it is created, so that only one is in memory
+        execgraphs = ExecgraphChunks(workdir, typestr, uuid, n_chunks)
+        for i, chunk in enumerate(chunks):
+            nodes = set.union(*(subjectworkflows[name] for name in chunk))
+            execgraphs.put(i, execgraph.subgraph(nodes).copy())
+
+        chunkindices = {name: i for i, chunk in enumerate(chunks) for name in chunk}
 
         subjectlevelnodes = set.union(*subjectworkflows.values())
         for (u, v, c) in nx.edge_boundary(execgraph, subjectlevelnodes, data=True):
@@ -91,13 +425,15 @@ def init_execgraph(workdir, workflow, n_chunks=None, subject_chunks=None):
             uhex = hexdigest(u.fullname)
             newu = pe.Node(LoadResult(u, attrs), name=f"loadresult_{uhex}")
             newu.config = u.config
+            boundary = execgraphs.boundaries[chunkindices[u._hierarchy.split(".")[2]]]
+            resultfilepath = newu.interface.resultfilepath
+            boundary[resultfilepath] = sorted({*boundary.get(resultfilepath, []), *attrs})
             execgraph.remove_node(u)
             execgraph.add_edge(newu, v, attr_dict=c)
         execgraph.remove_nodes_from(subjectlevelnodes)
 
-        execgraphs.append(execgraph)
-        assert len(execgraphs) == n_chunks + 1
-        cacheobj(workdir, typestr, execgraphs, uuid=uuid)
+        execgraphs.put(n_chunks, execgraph)
+        cacheobj(workdir, typestr, execgraphs, uuid=uuid)  # manifest goes last
 
         return execgraphs
     else:
@@ -9,7 +9,8 @@ from .connectivity import ConnectivityMeasure
 from .dof import MakeDofVolume
 from .filter import LogicalAnd, Filter, FilterList
 from .fsl import SafeFLAMEO
-from .merge import SafeMerge, SafeMaskMerge
+from .glm import MatrixGLM, ImageGLM
+from .merge import SafeMerge, SafeMaskMerge, MergeMatrices
 from .model import GroupModel, InterceptOnlyModel, SafeMultipleRegressDesign
 from .motion import MotionCutoff
 from .report import BoldFileReportMetadata, PlotEpi, PlotRegistration
@@ -37,8 +38,11 @@ __all__ = [
     Filter,
     FilterList,
     SafeFLAMEO,
+    MatrixGLM,
+    ImageGLM,
     SafeMerge,
     SafeMaskMerge,
+    MergeMatrices,
     MotionCutoff,
     BoldFileReportMetadata,
     PlotEpi,
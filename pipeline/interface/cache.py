@@ -13,6 +13,21 @@ from nipype.interfaces.base import (
 from nipype.interfaces.io import add_traits
 
 
+def load_result_outputs(resultfilepath, attrs):
+    """
+    :return: dict mapping each of the attrs to its value in the result file of a node
+    """
+    assert op.isfile(resultfilepath)
+
+    result = load_resultfile(resultfilepath)
+    try:
+        cachedoutputs = result.outputs.get()
+    except TypeError:  # This is a Bunch
+        cachedoutputs = result.__dict__
+
+    return {attr: cachedoutputs[attr] for attr in attrs}
+
+
 class LoadResult(SimpleInterface):
     """ interface to construct a group design """
 
@@ -24,6 +39,21 @@ class LoadResult(SimpleInterface):
         cwd = node.output_dir()
         self._resultfilepath = op.join(cwd, "result_%s.pklz" % node.name)
         self._attrs = attrs
+        self._cachedoutputs = None
+
+    @property
+    def resultfilepath(self):
+        return self._resultfilepath
+
+    @property
+    def attrs(self):
+        return self._attrs
+
+    def set_cached_outputs(self, cachedoutputs):
+        """
+        use outputs that were read in bulk instead of reading the result file
+        """
+        self._cachedoutputs = cachedoutputs
 
     def _add_output_traits(self, base):
         return add_traits(base, self._attrs)
@@ -31,13 +61,9 @@ class LoadResult(SimpleInterface):
     def _run_interface(self, runtime):
         outputs = self.output_spec().get()
 
-        assert op.isfile(self._resultfilepath)
-
-        result = load_resultfile(self._resultfilepath)
-        try:
-            cachedoutputs = result.outputs.get()
-        except TypeError:  # This is a Bunch
-            cachedoutputs = result.__dict__
+        cachedoutputs = self._cachedoutputs
+        if cachedoutputs is None:
+            cachedoutputs = load_result_outputs(self._resultfilepath, self._attrs)
 
         for attr in self._attrs:
             outputs[attr] = cachedoutputs[attr]
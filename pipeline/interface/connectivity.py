@@ -18,6 +18,7 @@ from nipype.interfaces.base import (
     TraitedSpec,
     BaseInterfaceInputSpec,
     traits,
+    isdefined,
 )
 
 from ..io import img_to_signals
@@ -34,13 +35,23 @@ class ConnectivityMeasureInputSpec(BaseInterfaceInputSpec):
 
     background_label = traits.Int(desc="", default=0,)
     min_n_voxels = traits.Int(desc="", default=50,)
+    chunk_size = traits.Range(
+        low=1, desc="number of volumes to read at a time, or all volumes if undefined",
+    )
+
+    output_format = traits.Enum(
+        "txt", "npy", usedefault=True, desc="write numpy text files or binary .npy files"
+    )
+    output_float32 = traits.Bool(
+        False, usedefault=True, desc="store binary outputs as float32 instead of float64"
+    )
 
 
 class ConnectivityMeasureOutputSpec(TraitedSpec):
-    time_series = traits.File(desc="Numpy text file with the timeseries matrix")
-    covariance = traits.File(desc="Numpy text file with the connectivity matrix")
-    correlation = traits.File(desc="Numpy text file with the connectivity matrix")
-    partial_correlation = traits.File(desc="Numpy text file with the connectivity matrix")
+    time_series = traits.File(desc="Numpy text or .npy file with the timeseries matrix")
+    covariance = traits.File(desc="Numpy text or .npy file with the connectivity matrix")
+    correlation = traits.File(desc="Numpy text or .npy file with the connectivity matrix")
+    partial_correlation = traits.File(desc="Numpy text or .npy file with the connectivity matrix")
 
 
 class ConnectivityMeasure(BaseInterface):
@@ -48,12 +59,17 @@ class ConnectivityMeasure(BaseInterface):
     output_spec = ConnectivityMeasureOutputSpec
 
     def _run_interface(self, runtime):
+        chunk_size = None
+        if isdefined(self.inputs.chunk_size):
+            chunk_size = self.inputs.chunk_size
+
         self._time_series = img_to_signals(
             self.inputs.in_file,
             self.inputs.atlas_file,
             mask_file=self.inputs.mask_file,
             background_label=self.inputs.background_label,
             min_n_voxels=self.inputs.min_n_voxels,
+            chunk_size=chunk_size,
         )
 
         df = pd.DataFrame(self._time_series)
@@ -68,23 +84,23 @@ class ConnectivityMeasure(BaseInterface):
 
         return runtime
 
+    def _save_matrix(self, name, matrix):
+        output_format = self.inputs.output_format
+        out_file = op.abspath(f"{name}.{output_format}")
+        if output_format == "npy":
+            dtype = np.float32 if self.inputs.output_float32 else np.float64
+            np.save(out_file, np.asarray(matrix, dtype=dtype))
+        else:
+            np.savetxt(out_file, matrix, fmt="%.10f")
+        return out_file
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
 
-        time_series_file = op.abspath("timeseries.txt")
-        np.savetxt(time_series_file, self._time_series, fmt="%.10f")
-
-        covariance_file = op.abspath("timeseries.txt")
-        np.savetxt(covariance_file, self._cov_mat, fmt="%.10f")
-
-        correlation_file = op.abspath("timeseries.txt")
-        np.savetxt(correlation_file, self._corr_mat, fmt="%.10f")
-
-        partial_correlation_file = op.abspath("partial_correlation.txt")
-        np.savetxt(partial_correlation_file, self._pcorr_mat, fmt="%.10f")
-
-        outputs["time_series"] = time_series_file
-        outputs["covariance"] = covariance_file
-        outputs["correlation"] = correlation_file
-        outputs["partial_correlation"] = partial_correlation_file
+        outputs["time_series"] = self._save_matrix("time_series", self._time_series)
+        outputs["covariance"] = self._save_matrix("covariance", self._cov_mat)
+        outputs["correlation"] = self._save_matrix("correlation", self._corr_mat)
+        outputs["partial_correlation"] = self._save_matrix(
+            "partial_correlation", self._pcorr_mat
+        )
         return outputs
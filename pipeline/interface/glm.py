@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+Vectorized group-level linear models that fit all voxels or edges at once
+"""
+
+import os
+from os import path as op
+
+import numpy as np
+import nibabel as nib
+from scipy import stats
+
+from nilearn.image import new_img_like
+
+from nipype.interfaces.base import (
+    BaseInterface,
+    TraitedSpec,
+    BaseInterfaceInputSpec,
+    traits,
+    isdefined,
+)
+
+from ..utils import loadmatrix, first
+
+batch_size = 2 ** 16  # maximum number of edges or voxels per solve
+batch_gb = 0.5  # memory target for the float64 working arrays of one solve
+
+
+def get_batch_size(n_inputs, n_regressors):
+    """
+    :return: number of edges or voxels per solve so that the working arrays, which
+        grow with the number of inputs, fit into batch_gb
+    """
+    n_values = 8 * n_inputs + 6 * n_regressors ** 2  # data, weights, residuals and products
+    return int(min(batch_size, max(1, batch_gb * 2 ** 30 // (8 * n_values))))
+
+
+def t_to_z(t, dof):
+    """
+    convert t to z values with the same tail probability, keeping precision in the tails
+    """
+    z = stats.norm.isf(stats.t.sf(np.abs(t), dof))
+    return np.sign(t) * z
+
+
+def f_to_z(f, dof1, dof2):
+    return stats.norm.isf(stats.f.sf(f, dof1, dof2))
+
+
+def make_design(regressors, contrasts):
+    """
+    make design and contrast matrices from GroupModel or InterceptOnlyModel outputs
+
+    :param regressors: dict of regressor name to list of values
+    :param contrasts: list of [name, "T", regressor names, weights] or [name, "F", t contrasts]
+    :return: design matrix, list of (name, type, contrast matrix)
+    """
+    regressornames = list(regressors.keys())
+    design = np.column_stack(
+        [np.asarray(regressors[name], dtype=np.float64) for name in regressornames]
+    )
+
+    def _tcontrast_vector(names, weights):
+        vector = np.zeros(len(regressornames))
+        for name, weight in zip(names, weights):
+            vector[regressornames.index(name)] = weight
+        return vector
+
+    contrastmats = []
+    for contrast in contrasts:
+        name, contrasttype = contrast[:2]
+        if contrasttype == "T":
+            names, weights = contrast[2:4]
+            contrastmats.append((name, "T", _tcontrast_vector(names, weights)[np.newaxis, :]))
+        elif contrasttype == "F":
+            tcontrasts = contrast[2]
+            contrastmat = np.vstack(
+                [_tcontrast_vector(*tcontrast[2:4]) for tcontrast in tcontrasts]
+            )
+            contrastmats.append((name, "F", contrastmat))
+        else:
+            raise ValueError(f'Unknown contrast type "{contrasttype}"')
+
+    return design, contrastmats
+
+
+def ols(design, contrastmats, data):
+    """
+    ordinary least squares fit of one design to many columns of data
+
+    :param design: array of shape (n_observations, n_regressors)
+    :param contrastmats: list of (name, type, contrast matrix)
+    :param data: array of shape (n_observations, n_columns)
+    :return: dof, list of (cope, varcope, zstat) per contrast with arrays of shape (n_columns,),
+        where cope and varcope are None for F contrasts
+    """
+    pinvdesign = np.linalg.pinv(design)
+    dof = design.shape[0] - np.linalg.matrix_rank(design)
+    covbeta = pinvdesign @ pinvdesign.T  # (X'X)^-1
+
+    beta = pinvdesign @ data
+    residuals = data - design @ beta
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigmasq = np.sum(residuals ** 2, axis=0) / dof
+
+    results = []
+    for _, contrasttype, contrastmat in contrastmats:
+        cope = contrastmat @ beta
+        contrastcov = contrastmat @ covbeta @ contrastmat.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if contrasttype == "T":
+                varcope = sigmasq * contrastcov[0, 0]
+                zstat = t_to_z(cope[0] / np.sqrt(varcope), dof)
+                results.append((cope[0], varcope, zstat))
+            else:
+                rank = np.linalg.matrix_rank(contrastmat)
+                f = np.sum(cope * (np.linalg.pinv(contrastcov) @ cope), axis=0)
+                f /= rank * sigmasq
+                results.append((None, None, f_to_z(f, rank, dof)))
+
+    return dof, results
+
+
+def _square(values, n_rows, diagonal=np.nan):
+    mat = np.full((n_rows, n_rows), diagonal)
+    edges = np.triu_indices(n_rows, k=1)
+    mat[edges] = values
+    mat.T[edges] = values
+    return mat
+
+
+class MatrixGLMInputSpec(BaseInterfaceInputSpec):
+    merged_file = traits.File(
+        desc=".npy file of shape (n_inputs, n_edges) from MergeMatrices",
+        exists=True,
+        mandatory=True,
+    )
+    regressors = traits.Any(mandatory=True)
+    contrasts = traits.Any(mandatory=True)
+    output_format = traits.Enum(
+        "txt", "npy", usedefault=True, desc="write numpy text files or binary .npy files"
+    )
+    inverse_fisher_z = traits.Bool(
+        False,
+        usedefault=True,
+        desc="also write the copes as correlation matrices, when aggregating within subjects",
+    )
+
+
+class MatrixGLMOutputSpec(TraitedSpec):
+    correlations = traits.List(traits.Any())
+    copes = traits.List(traits.Any())
+    var_copes = traits.List(traits.Any())
+    zstats = traits.List(traits.Any())
+    tdof = traits.List(traits.Any())
+
+
+class MatrixGLM(BaseInterface):
+    """
+    fit a group model to all edges of merged connectivity matrices at once
+
+    edges that are missing for any input are set to nan
+    """
+
+    input_spec = MatrixGLMInputSpec
+    output_spec = MatrixGLMOutputSpec
+
+    def _run_interface(self, runtime):
+        design, contrastmats = make_design(self.inputs.regressors, self.inputs.contrasts)
+
+        merged = loadmatrix(self.inputs.merged_file, mmap_mode="r")
+        n_inputs, n_edges = merged.shape
+        assert n_inputs == design.shape[0]
+        n_rows = int(round((1 + np.sqrt(1 + 8 * n_edges)) / 2))
+
+        outarrs = [
+            [np.full(n_edges, np.nan) for _ in range(3)] for _ in range(len(contrastmats))
+        ]
+
+        dof = None
+        n_batch = get_batch_size(*design.shape)
+        for start in range(0, n_edges, n_batch):
+            data = np.asarray(merged[:, start : start + n_batch], dtype=np.float64)
+            isfinite = np.all(np.isfinite(data), axis=0)
+            dof, results = ols(design, contrastmats, data[:, isfinite])
+            indices = start + np.flatnonzero(isfinite)
+            for outarr, result in zip(outarrs, results):
+                for arr, values in zip(outarr, result):
+                    if values is not None:
+                        arr[indices] = values
+
+        self._results = {
+            "correlations": [],
+            "copes": [],
+            "var_copes": [],
+            "zstats": [],
+            "tdof": [],
+        }
+        for i, ((name, contrasttype, _), outarr) in enumerate(zip(contrastmats, outarrs)):
+            cope, varcope, zstat = outarr
+            if contrasttype == "T":
+                self._results["copes"].append(self._save_matrix(f"cope{i+1}", cope, n_rows))
+                self._results["var_copes"].append(
+                    self._save_matrix(f"varcope{i+1}", varcope, n_rows)
+                )
+                correlation = None
+                if self.inputs.inverse_fisher_z:
+                    correlation = self._save_matrix(f"correlation{i+1}", np.tanh(cope), n_rows)
+                self._results["correlations"].append(correlation)
+            else:
+                self._results["correlations"].append(None)
+                self._results["copes"].append(None)
+                self._results["var_copes"].append(None)
+            self._results["zstats"].append(self._save_matrix(f"zstat{i+1}", zstat, n_rows))
+            self._results["tdof"].append(
+                self._save_matrix(f"tdof_t{i+1}", np.full(n_edges, dof), n_rows)
+            )
+
+        return runtime
+
+    def _save_matrix(self, name, values, n_rows):
+        output_format = self.inputs.output_format
+        out_file = op.abspath(f"{name}.{output_format}")
+        mat = _square(values, n_rows)
+        if output_format == "npy":
+            np.save(out_file, mat)
+        else:
+            np.savetxt(out_file, mat, fmt="%.10f")
+        return out_file
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs.update(self._results)
+        return outputs
+
+
+def wls(design, contrastmats, data, variances, mixed_effects=False, max_iterations=100, tol=1e-8):
+    """
+    weighted least squares fit with a separate set of weights for each column,
+    as for fixed effects analysis with known first-level variances
+
+    with mixed_effects, the between-input variance is estimated for each column
+    like in FLAME1, by maximizing the marginal likelihood of the variance with the
+    regression coefficients integrated out, which is the restricted maximum likelihood.
+    FLAMEO does this with a line search on the log of the variance, while here all
+    columns take Fisher scoring steps at once, starting from the closed-form method of
+    moments (DerSimonian-Laird) estimate. the variance is added to the first-level
+    variances before the fit
+
+    :param design: array of shape (n_observations, n_regressors)
+    :param contrastmats: list of (name, type, contrast matrix)
+    :param data: array of shape (n_observations, n_columns)
+    :param variances: array of shape (n_observations, n_columns)
+    :param max_iterations: maximum number of Fisher scoring steps
+    :param tol: stop when no variance estimate changes by more than this fraction of
+        the mean first-level variance
+    :return: list of (cope, varcope, stat) per contrast with arrays of shape (n_columns,),
+        where stat is t for T contrasts and F for F contrasts
+    """
+
+    def _fit(weights):
+        xtwx = np.einsum("ni,nv,nj->vij", design, weights, design)
+        covbeta = np.linalg.inv(xtwx)
+        beta = np.einsum("vij,nj,nv->vi", covbeta, design, weights * data)
+        return beta, covbeta
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = 1.0 / variances
+        beta, covbeta = _fit(weights)
+
+        if mixed_effects:
+            n_observations, n_regressors = design.shape
+            residuals = data - design @ beta.T
+            q = np.sum(weights * residuals ** 2, axis=0)
+            xtw2x = np.einsum("ni,nv,nj->vij", design, weights ** 2, design)
+            trace = np.einsum("vij,vji->v", covbeta, xtw2x)
+            tausq = (q - (n_observations - n_regressors)) / (np.sum(weights, axis=0) - trace)
+            tausq = np.maximum(np.nan_to_num(tausq), 0.0)
+
+            scale = np.mean(variances, axis=0)
+            for _ in range(max_iterations):
+                weights = 1.0 / (variances + tausq)
+                beta, covbeta = _fit(weights)
+                residuals = data - design @ beta.T
+                # with the projection p = w - w x covbeta x' w, the score is
+                # (y' p p y - tr(p)) / 2 and the expected information is tr(p p) / 2
+                xtw2x = np.einsum("ni,nv,nj->vij", design, weights ** 2, design)
+                xtw3x = np.einsum("ni,nv,nj->vij", design, weights ** 3, design)
+                covxtw2x = covbeta @ xtw2x
+                trp = np.sum(weights, axis=0) - np.einsum("vii->v", covxtw2x)
+                trpp = (
+                    np.sum(weights ** 2, axis=0)
+                    - 2 * np.einsum("vij,vji->v", covbeta, xtw3x)
+                    + np.einsum("vij,vji->v", covxtw2x, covxtw2x)
+                )
+                ypy = np.sum((weights * residuals) ** 2, axis=0)
+                step = np.where(trpp > 0, np.nan_to_num((ypy - trp) / trpp), 0.0)
+                newtausq = np.maximum(tausq + step, 0.0)
+                is_converged = np.all(np.abs(newtausq - tausq) <= tol * scale)
+                tausq = newtausq
+                if is_converged:
+                    break
+
+            weights = 1.0 / (variances + tausq)
+            beta, covbeta = _fit(weights)
+
+        results = []
+        for _, contrasttype, contrastmat in contrastmats:
+            cope = beta @ contrastmat.T  # (n_columns, rank)
+            contrastcov = np.einsum("ki,vij,lj->vkl", contrastmat, covbeta, contrastmat)
+            if contrasttype == "T":
+                varcope = contrastcov[:, 0, 0]
+                results.append((cope[:, 0], varcope, cope[:, 0] / np.sqrt(varcope)))
+            else:  # pinv, as the rows of an f contrast may be linearly dependent
+                rank = np.linalg.matrix_rank(contrastmat)
+                f = np.einsum("vk,vkl,vl->v", cope, np.linalg.pinv(contrastcov), cope) / rank
+                results.append((None, None, f))
+
+    return results
+
+
+class ImageGLMInputSpec(BaseInterfaceInputSpec):
+    cope_files = traits.List(traits.File(exists=True), mandatory=True)
+    var_cope_files = traits.List(traits.File(exists=True))
+    dof_files = traits.List(traits.File(exists=True))
+    mask_files = traits.List(traits.File(exists=True))
+    regressors = traits.Any(mandatory=True)
+    contrasts = traits.Any(mandatory=True)
+    run_mode = traits.Enum(
+        "fe", "me", usedefault=True, desc="fixed effects or FLAME1 mixed effects"
+    )
+
+
+class ImageGLMOutputSpec(TraitedSpec):
+    copes = traits.List(traits.File(exists=True))
+    var_copes = traits.List(traits.File(exists=True))
+    zstats = traits.List(traits.File(exists=True))
+    tdof = traits.List(traits.File(exists=True))
+    zfstats = traits.List(traits.File(exists=True))
+    mask_file = traits.Either(traits.File(exists=True), traits.Bool())
+
+
+class ImageGLM(BaseInterface):
+    """
+    in-process alternative to SafeFLAMEO for fixed effects and intercept-only designs
+
+    input images are read one at a time into on-disk arrays of masked voxels,
+    which are then fitted in batches of voxels. the on-disk arrays are deleted
+    afterwards. outputs are named like the outputs of FLAMEO and are zero outside
+    the mask
+
+    without var_cope_files, an ordinary least squares fit is used. for mixed effects,
+    the between-input variance is estimated like in FLAME1, see wls, so the results
+    correspond to FLAMEO with run_mode flame1 up to the tolerance of the optimization
+    """
+
+    input_spec = ImageGLMInputSpec
+    output_spec = ImageGLMOutputSpec
+
+    def _masked_array(self, name, in_files, mask):
+        scratch_file = op.abspath(f"{name}.npy")
+        self._scratch_files.append(scratch_file)
+        arr = np.lib.format.open_memmap(
+            scratch_file,
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(in_files), np.count_nonzero(mask)),
+        )
+        for i, in_file in enumerate(in_files):
+            in_img = nib.load(in_file)
+            arr[i, :] = np.asanyarray(in_img.dataobj).reshape(mask.shape)[mask]
+        return arr
+
+    def _run_interface(self, runtime):
+        self._scratch_files = list()
+        try:
+            return self._fit(runtime)
+        finally:
+            for scratch_file in self._scratch_files:
+                if op.isfile(scratch_file):
+                    os.remove(scratch_file)
+
+    def _fit(self, runtime):
+        design, contrastmats = make_design(self.inputs.regressors, self.inputs.contrasts)
+
+        ref_img = nib.load(first(self.inputs.cope_files))
+        shape = ref_img.shape[:3]
+
+        mask = np.ones(shape, dtype=bool)
+        if isdefined(self.inputs.mask_files):
+            for mask_file in self.inputs.mask_files:
+                mask_img = nib.load(mask_file)
+                mask &= np.asanyarray(mask_img.dataobj).reshape(shape).astype(bool)
+
+        copes = self._masked_array("copes", self.inputs.cope_files, mask)
+        assert copes.shape[0] == design.shape[0]
+
+        var_cope_files = []
+        if isdefined(self.inputs.var_cope_files):
+            var_cope_files = self.inputs.var_cope_files
+        has_varcopes = len(var_cope_files) > 0
+        if has_varcopes:
+            varcopes = self._masked_array("varcopes", var_cope_files, mask)
+            mask_values = np.all(varcopes > 0, axis=0)
+        else:
+            mask_values = np.ones(copes.shape[1], dtype=bool)
+        mask_values &= np.all(np.isfinite(copes), axis=0)
+
+        if self.inputs.run_mode == "fe" and has_varcopes:
+            dof_files = self.inputs.dof_files if isdefined(self.inputs.dof_files) else []
+            assert len(dof_files) == copes.shape[0], "Fixed effects requires dof_files"
+            dofs = self._masked_array("dofs", dof_files, mask)
+        else:
+            dofs = None
+
+        n_voxels = copes.shape[1]
+        outarrs = [[np.zeros(n_voxels) for _ in range(4)] for _ in range(len(contrastmats))]
+
+        n_batch = get_batch_size(*design.shape)
+        for start in range(0, n_voxels, n_batch):
+            isvalid = mask_values[start : start + n_batch]
+            indices = start + np.flatnonzero(isvalid)
+            data = np.asarray(copes[:, indices], dtype=np.float64)
+
+            if has_varcopes:
+                variances = np.asarray(varcopes[:, indices], dtype=np.float64)
+                results = wls(
+                    design,
+                    contrastmats,
+                    data,
+                    variances,
+                    mixed_effects=self.inputs.run_mode == "me",
+                )
+            else:
+                _, results = ols(design, contrastmats, data)
+
+            if dofs is not None:
+                dof = np.sum(dofs[:, indices], axis=0, dtype=np.float64)
+            else:
+                dof = np.full(indices.size, design.shape[0] - np.linalg.matrix_rank(design))
+
+            for (_, contrasttype, contrastmat), outarr, result in zip(
+                contrastmats, outarrs, results
+            ):
+                cope, varcope, stat = result
+                if not has_varcopes:
+                    zstat = stat  # ordinary least squares already returns z values
+                elif contrasttype == "T":
+                    zstat = t_to_z(stat, dof)
+                else:
+                    zstat = f_to_z(stat, np.linalg.matrix_rank(contrastmat), dof)
+                for arr, values in zip(outarr, (cope, varcope, zstat, dof)):
+                    if values is not None:
+                        arr[indices] = np.nan_to_num(values)
+
+        def _save_img(name, values):
+            outarr = np.zeros(shape, dtype=np.float32)
+            outarr[mask] = values
+            out_file = op.abspath(f"{name}.nii.gz")
+            nib.save(new_img_like(ref_img, outarr), out_file)
+            return out_file
+
+        self._results = {key: [] for key in ["copes", "var_copes", "zstats", "tdof", "zfstats"]}
+        tindex, findex = 0, 0
+        for (_, contrasttype, _), (cope, varcope, zstat, dof) in zip(contrastmats, outarrs):
+            if contrasttype == "T":
+                tindex += 1
+                self._results["copes"].append(_save_img(f"cope{tindex}", cope))
+                self._results["var_copes"].append(_save_img(f"varcope{tindex}", varcope))
+                self._results["zstats"].append(_save_img(f"zstat{tindex}", zstat))
+                self._results["tdof"].append(_save_img(f"tdof_t{tindex}", dof))
+            else:
+                findex += 1
+                self._results["zfstats"].append(_save_img(f"zfstat{findex}", zstat))
+
+        fullmask = np.zeros(shape, dtype=np.uint8)
+        fullmask[mask] = mask_values
+        self._results["mask_file"] = op.abspath("mask.nii.gz")
+        nib.save(new_img_like(ref_img, fullmask), self._results["mask_file"])
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs.update(self._results)
+        return outputs
@@ -18,7 +18,7 @@ from nipype.interfaces.base import (
     isdefined,
 )
 
-from ..utils import niftidim, first
+from ..utils import niftidim, first, loadmatrix
 
 dimensions = ["x", "y", "z", "t"]
 
@@ -28,6 +28,64 @@ class SafeMergeInputSpec(BaseInterfaceInputSpec):
         traits.File(desc="Image file(s) to resample", exists=True), mandatory=True
     )
     dimension = traits.Enum(*dimensions, desc="dimension along which to merge", mandatory=True)
+    streaming = traits.Bool(
+        False,
+        usedefault=True,
+        desc="write each input directly to an uncompressed output file in its native dtype",
+    )
+
+
+def _merged_dtype(in_imgs):
+    dtypes = []
+    for in_img in in_imgs:
+        dtype = in_img.get_data_dtype()
+        slope = getattr(in_img.dataobj, "slope", 1.0)
+        inter = getattr(in_img.dataobj, "inter", 0.0)
+        if slope != 1.0 or inter != 0.0:  # scaled data is read as float64
+            dtype = np.float64
+        dtypes.append(dtype)
+    return np.result_type(*dtypes)
+
+
+def _streaming_merge(in_imgs, idim, outshape, out_file):
+    """
+    preallocate an uncompressed nifti file and copy one input at a time
+    into a memory map of it, so that only one input is held in memory
+    """
+    dtype = _merged_dtype(in_imgs)
+
+    header = nib.Nifti1Header()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(outshape)
+    affine = first(in_imgs).affine
+    header.set_sform(affine, code="aligned")
+    header.set_qform(affine, code="unknown")
+    header.set_data_offset(352)  # minimal offset for a single file without extensions
+
+    offset = header.get_data_offset()
+    nbytes = int(np.prod(outshape)) * dtype.itemsize
+    with open(out_file, "wb") as fp:
+        header.write_to(fp)
+        fp.truncate(offset + nbytes)
+
+    outarr = np.memmap(
+        out_file, dtype=dtype, mode="r+", offset=offset, shape=tuple(outshape), order="F"
+    )
+
+    i = 0
+    for in_img in in_imgs:
+        in_data = np.asanyarray(in_img.dataobj)
+        while len(in_data.shape) < len(outshape):
+            in_data = np.expand_dims(in_data, len(in_data.shape))
+        size = in_data.shape[idim]
+        index = [slice(None)] * len(outshape)
+        index[idim] = slice(i, i + size)
+        outarr[tuple(index)] = in_data
+        i += size
+        del in_data
+
+    outarr.flush()
+    del outarr
 
 
 class SafeMergeOutputSpec(TraitedSpec):
@@ -59,6 +117,11 @@ class SafeMerge(BaseInterface):
 
         outshape[idim] = sum(sizes)
 
+        if self.inputs.streaming:
+            self._merged_file = op.abspath("merged.nii")
+            _streaming_merge(in_imgs, idim, outshape, self._merged_file)
+            return runtime
+
         movd_shape = [outshape[idim], *outshape[:idim], *outshape[idim + 1 :]]
         movd_outarr = np.zeros(movd_shape, dtype=np.float64)
 
@@ -74,7 +137,7 @@ class SafeMerge(BaseInterface):
 
         outimg = new_img_like(first(in_imgs), outarr)
 
-        self._merged_file = op.abspath(f"merged.nii.gz")
+        self._merged_file = op.abspath("merged.nii.gz")
         nib.save(outimg, self._merged_file)
 
         return runtime
@@ -118,7 +181,7 @@ class SafeMaskMerge(BaseInterface):
 
         outimg = new_img_like(first(in_imgs), outarr)
 
-        self._merged_file = op.abspath(f"merged.nii.gz")
+        self._merged_file = op.abspath("merged.nii.gz")
         nib.save(outimg, self._merged_file)
 
         return runtime
@@ -131,3 +194,64 @@ class SafeMaskMerge(BaseInterface):
         else:
             outputs["merged_file"] = False
         return outputs
+
+
+class MergeMatricesInputSpec(BaseInterfaceInputSpec):
+    in_files = traits.List(
+        traits.File(desc="Square matrix file(s) to merge", exists=True), mandatory=True
+    )
+    fisher_z = traits.Bool(
+        False, usedefault=True, desc="apply the fisher z-transform to correlation values"
+    )
+    float32 = traits.Bool(False, usedefault=True, desc="store merged values as float32")
+
+
+class MergeMatrices(BaseInterface):
+    """
+    stack the upper triangles of square matrices into a memory-mappable
+    .npy file of shape (n_inputs, n_edges)
+    """
+
+    input_spec = MergeMatricesInputSpec
+    output_spec = SafeMergeOutputSpec
+
+    def _run_interface(self, runtime):
+        self._merged_file = None
+
+        if not isdefined(self.inputs.in_files) or len(self.inputs.in_files) == 0:
+            return runtime
+
+        n_rows = loadmatrix(first(self.inputs.in_files), mmap_mode="r").shape[0]
+        edges = np.triu_indices(n_rows, k=1)
+
+        dtype = np.float32 if self.inputs.float32 else np.float64
+
+        self._merged_file = op.abspath("merged.npy")
+        outarr = np.lib.format.open_memmap(
+            self._merged_file,
+            mode="w+",
+            dtype=dtype,
+            shape=(len(self.inputs.in_files), edges[0].size),
+        )
+
+        for i, in_file in enumerate(self.inputs.in_files):
+            in_mat = loadmatrix(in_file, mmap_mode="r")
+            assert in_mat.shape == (n_rows, n_rows)
+            values = np.asarray(in_mat[edges], dtype=np.float64)
+            if self.inputs.fisher_z:
+                values = np.arctanh(np.clip(values, -1.0 + 1e-7, 1.0 - 1e-7))
+            outarr[i, :] = values
+
+        outarr.flush()
+        del outarr
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+
+        if self._merged_file is not None:
+            outputs["merged_file"] = self._merged_file
+        else:
+            outputs["merged_file"] = False
+        return outputs
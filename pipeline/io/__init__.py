@@ -9,6 +9,7 @@ from .condition import (
 from .dictlistfile import DictListFile
 from .direction import get_axcodes_set, canonicalize_pedir_str
 from .indexedfile import init_indexed_js_object_file, init_indexed_js_list_file, IndexedFile
+from .profile import ProfileStore, profile_key, apply_predictions
 from .repetition_time import get_repetition_time
 from .resulthooks import PreprocessedImgCopyOutResultHook, ReportValsResultHook, get_resulthooks
 from .signals import img_to_signals
@@ -23,6 +24,9 @@ __all__ = [
     init_indexed_js_object_file,
     init_indexed_js_list_file,
     IndexedFile,
+    ProfileStore,
+    profile_key,
+    apply_predictions,
     get_repetition_time,
     PreprocessedImgCopyOutResultHook,
     ReportValsResultHook,
@@ -2,8 +2,11 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+import os
 from pathlib import Path
 import logging
+import socket
+import time
 import json
 
 import pandas as pd
@@ -16,15 +19,47 @@ from ..spec import bold_entities
 
 logger = logging.getLogger("pipeline")
 
+keykeys = (*bold_entities, "desc")  # entries with the same values for these are updated
+
+lastseqs = dict()  # log directory -> last sequence number written by this process
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 
 class DictListFile:
-    def __init__(self, filename, header=None, footer=None):
+    """
+    list of dicts that is stored as a javascript file for the reports
+
+    writers append their updates to a log file of their own, so that they never wait for
+    each other. the updates are merged into the javascript file by compact, which runs
+    every compact_interval seconds and at the end of a run
+
+    updates are ordered by a sequence number that is one higher than the highest number
+    that was compacted when they were written, so that an update is always ordered after
+    the updates that were already compacted, even if the clocks of different hosts do
+    not agree. updates with the same sequence number are ordered by time, like the
+    lock order of a full rewrite of the file
+    """
+
+    def __init__(self, filename, header=None, footer=None, compact_interval=10.0):
         self.filename = Path(filename)
         self.filename.parent.mkdir(parents=True, exist_ok=True)
 
         lockfilename = f"{filename}.lock"
         self.lock = fasteners.InterProcessLock(str(lockfilename))
 
+        self.logdirectory = Path(f"{filename}.log")
+        self.statefilename = self.logdirectory / "offsets.json"
+        self.compact_interval = compact_interval
+
         if isinstance(header, str):
             header = header.encode()
         self.header = header
@@ -33,45 +68,176 @@ class DictListFile:
             footer = footer.encode()
         self.footer = footer
 
+        self.records = None
         self.dictlist = None
+        self.index = None
         self.is_dirty = None
 
+    @property
+    def logfilename(self):
+        return self.logdirectory / f"{socket.gethostname()}.{os.getpid()}.jsonl"
+
     def __enter__(self):
-        self.lock.acquire()
-
-        self.dictlist = []
-        self.is_dirty = False
-        if self.filename.is_file():
-            with open(str(self.filename), "rb") as fp:
-                bytesfromfile = fp.read()
-            try:
-                if self.header is not None:
-                    bytesfromfile = bytesfromfile[len(self.header) :]
-                if self.footer is not None:
-                    bytesfromfile = bytesfromfile[: -len(self.footer)]
-                jsonstr = bytesfromfile.decode()
-                jsonstr = jsonstr.replace("\\\n", "")
-                self.dictlist = json.loads(jsonstr)
-            except json.decoder.JSONDecodeError as e:
-                logging.getLogger("pipeline").warning("JSONDecodeError %s", e)
+        self.records = []
 
     def __exit__(self, *args):
-        if self.is_dirty:
-            with open(str(self.filename), "w") as fp:
-                fp.write(self.header.decode())
-                jsonstr = json.dumps(self.dictlist, indent=4, ensure_ascii=False)
-                for line in jsonstr.splitlines():
-                    fp.write(line)
-                    fp.write("\\\n")
-                fp.write(self.footer.decode())
+        records, self.records = self.records, None
+        if len(records) > 0:
+            key = str(self.logdirectory)
+            seq = max(lastseqs.get(key, 0), self._read_state()["seq"] + 1)
+            for record in records:
+                record["seq"] = seq
+            lastseqs[key] = seq
+
+            self.logdirectory.mkdir(parents=True, exist_ok=True)
+            with open(str(self.logfilename), "a") as fp:  # only this process writes here
+                fp.write("".join(f"{json.dumps(record)}\n" for record in records))
+        if self.is_compaction_due():
+            self.compact(blocking=False)
+
+    def put(self, indict):
+        assert self.records is not None
+        self.records.append(dict(time=time.time(), dict=indict))
+
+    def put_many(self, indicts):
+        assert self.records is not None
+        now = time.time()
+        self.records.extend(dict(time=now, dict=indict) for indict in indicts)
+
+    def is_compaction_due(self):
         try:
-            self.lock.release()
-        except RuntimeError:
+            return time.time() - self.filename.stat().st_mtime > self.compact_interval
+        except FileNotFoundError:
+            return True
+
+    def _read_state(self):
+        """
+        :return: dict with the offsets up to which each log file was compacted, and the
+            highest sequence number that was compacted
+        """
+        state = dict()
+        try:
+            with open(str(self.statefilename), "r") as fp:
+                state = json.load(fp)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
             pass
-        self.dictlist = None
+        if "offsets" not in state:  # only offsets were stored before
+            state = dict(offsets=state)
+        state.setdefault("seq", 0)
+        return state
+
+    def compact(self, blocking=True, table=False):
+        """
+        merge the logged updates into the javascript file. afterwards, the log file of
+        this process is truncated, and the log files of processes on this host that
+        have exited are removed, as they were read completely
+
+        :param blocking: wait for a concurrent compaction to finish, or else skip
+        :param table: also write a text table of the entries
+        :return: False if the compaction was skipped
+        """
+        if not self.lock.acquire(blocking=blocking):
+            return False
+        try:
+            state = self._read_state()
+            offsets = state["offsets"]
+
+            records = []
+            consumed = []  # log files that were read completely
+            for logfilename in sorted(self.logdirectory.glob("*.jsonl")):
+                offset = offsets.get(logfilename.name, 0)
+                with open(str(logfilename), "rb") as fp:
+                    fp.seek(offset)
+                    bytesfromfile = fp.read()
+                end = bytesfromfile.rfind(b"\n") + 1  # skip a partially written last line
+                for line in bytesfromfile[:end].splitlines():
+                    records.append(json.loads(line))
+                offsets[logfilename.name] = offset + end
+                if end == len(bytesfromfile):
+                    consumed.append(logfilename)
+            records.sort(key=lambda record: (record.get("seq", 0), record["time"]))
+            for record in records:
+                state["seq"] = max(state["seq"], record.get("seq", 0))
+
+            self.dictlist = self._read()
+            self.index = {self._key(curdict): i for i, curdict in enumerate(self.dictlist)}
+            self.is_dirty = False
+            for record in records:
+                self._upsert(record["dict"])
+            if self.is_dirty or not self.filename.is_file():
+                self._write()
+            else:
+                self.filename.touch()  # reset the compaction interval
+
+            is_state_dirty = len(records) > 0
+            truncate, remove = [], []
+            hostname = socket.gethostname()
+            for logfilename in consumed:
+                loghostname, pid = logfilename.stem.rsplit(".", 1)
+                if loghostname != hostname:
+                    continue  # may still be written to
+                if logfilename == self.logfilename:  # only this process writes here
+                    if offsets[logfilename.name] > 0:
+                        truncate.append(logfilename)
+                        offsets[logfilename.name] = 0
+                elif not is_process_alive(int(pid)):
+                    remove.append(logfilename)
+                    del offsets[logfilename.name]
+            is_state_dirty |= len(truncate) + len(remove) > 0
+
+            # write the state first, so that the records are at most read again
+            if is_state_dirty:
+                self._write_atomic(self.statefilename, json.dumps(state))
+            for logfilename in truncate:
+                os.truncate(str(logfilename), 0)
+            for logfilename in remove:
+                logfilename.unlink()
+
+            if table:
+                self.to_table()
+        finally:
+            self.dictlist = None
+            self.index = None
+            self.lock.release()
+        return True
+
+    def _read(self):
+        if not self.filename.is_file():
+            return []
+        with open(str(self.filename), "rb") as fp:
+            bytesfromfile = fp.read()
+        try:
+            if self.header is not None:
+                bytesfromfile = bytesfromfile[len(self.header) :]
+            if self.footer is not None:
+                bytesfromfile = bytesfromfile[: -len(self.footer)]
+            jsonstr = bytesfromfile.decode()
+            jsonstr = jsonstr.replace("\\\n", "")
+            return json.loads(jsonstr)
+        except json.decoder.JSONDecodeError as e:
+            logging.getLogger("pipeline").warning("JSONDecodeError %s", e)
+            return []
+
+    def _write(self):
+        lines = [self.header.decode()]
+        jsonstr = json.dumps(self.dictlist, indent=4, ensure_ascii=False)
+        for line in jsonstr.splitlines():
+            lines.append(line)
+            lines.append("\\\n")
+        lines.append(self.footer.decode())
+        self._write_atomic(self.filename, "".join(lines))
+
+    def _write_atomic(self, filename, content):
+        tmpfilename = filename.parent / f".{filename.name}.{os.getpid()}.tmp"
+        with open(str(tmpfilename), "w") as fp:
+            fp.write(content)
+        os.replace(str(tmpfilename), str(filename))
 
     def to_table(self):
-        dictlist = [{str(k): str(v) for k, v in indict.items()} for indict in self.dictlist]
+        dictlist = self.dictlist
+        if dictlist is None:
+            dictlist = self._read()
+        dictlist = [{str(k): str(v) for k, v in indict.items()} for indict in dictlist]
         dataframe = pd.DataFrame.from_records(dictlist)
         dataframe = dataframe.replace({np.nan: ""})
 
@@ -89,27 +255,22 @@ class DictListFile:
             fp.write(table_str)
             fp.write("\n")
 
-    def put(self, indict):
-        assert self.dictlist is not None
-
-        keykeys = set((*bold_entities, "desc"))
-        matches = False
-
-        for i, curdict in enumerate(self.dictlist):
-            matches = True
-            equals = True
-            for key, value in curdict.items():
-                valmatches = key in indict and indict[key] == curdict[key]
-                if key in keykeys:
-                    matches = matches and valmatches
-                equals = equals and valmatches
-            if equals:
-                return
-            if matches:
-                break
-        self.is_dirty = True
-        if matches:
-            self.dictlist[i] = indict
-            logger.info(f"Updating {self.filename} entry {curdict} with {indict}")
-        else:
+    @staticmethod
+    def _key(indict):
+        return tuple((key, indict[key]) for key in keykeys if key in indict)
+
+    def _upsert(self, indict):
+        key = self._key(indict)
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.dictlist)
             self.dictlist.append(indict)
+            self.is_dirty = True
+            return
+
+        curdict = self.dictlist[i]
+        if all(key in indict and indict[key] == value for key, value in curdict.items()):
+            return
+        self.dictlist[i] = indict
+        self.is_dirty = True
+        logger.info(f"Updating {self.filename} entry {curdict} with {indict}")
@@ -7,10 +7,15 @@
 """
 
 from functools import lru_cache
+import os
 import logging
+import threading
+from multiprocessing.util import Finalize
 from pathlib import Path
 
-from ..utils import loadpicklelzma, savepicklelzma
+import fasteners
+
+from ..utils import findpickle, loadpickle, savepickle
 
 
 def _quote(val, maxlen, append_comma):
@@ -31,15 +36,102 @@ class FileIndex:
         self.lastkey = lastkey
 
 
+class SlotWriter:
+    """
+    buffer writes to fixed-width slots of a file
+
+    pending writes are flushed after flush_interval seconds or when flush_count writes
+    are pending. every slot is written with pwrite under the inter-process lock of the
+    file, so that writers on other hosts that share the file over nfs do not overwrite
+    each other. the file is opened again if it was replaced or re-initialized
+    """
+
+    def __init__(self, filename, lock_file, flush_interval=1.0, flush_count=256):
+        self.filename = filename
+        self.file_lock = fasteners.InterProcessLock(lock_file)
+
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+
+        self.pending = dict()  # offset -> padded bytes
+        self.lock = threading.Lock()
+        self.timer = None
+
+        self.fd = None
+        self.st_ino = None
+        self.st_size = None
+
+    def put(self, offset, padded):
+        with self.lock:
+            self.pending[offset] = padded  # only the last value for a slot is written
+            n_pending = len(self.pending)
+            if n_pending < self.flush_count and (self.timer is None or not self.timer.is_alive()):
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if n_pending >= self.flush_count:
+            self.flush()
+
+    def _open(self):
+        stat = os.stat(self.filename)
+        if self.fd is not None and (stat.st_ino, stat.st_size) == (self.st_ino, self.st_size):
+            return
+        self._close_fd()
+        self.fd = os.open(self.filename, os.O_WRONLY)
+        stat = os.fstat(self.fd)
+        self.st_ino, self.st_size = stat.st_ino, stat.st_size
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd, self.st_ino, self.st_size = None, None, None
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+            if len(pending) == 0:
+                return
+            try:
+                with self.file_lock:
+                    self._open()
+                    for offset, padded in pending.items():
+                        if offset + len(padded) > self.st_size:
+                            continue  # the file was re-initialized with fewer slots
+                        os.pwrite(self.fd, padded, offset)
+            except OSError as e:
+                logging.getLogger("pipeline").warning(
+                    f'Could not write to IndexedFile "{self.filename}": %s', e
+                )
+                self._close_fd()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self._close_fd()
+
+
 class IndexedFile:
-    def __init__(self, filename):
+    """
+    file with fixed-width value slots that can be updated in place
+
+    updates are buffered by a SlotWriter
+    """
+
+    def __init__(self, filename, flush_interval=1.0, flush_count=256):
         self.filename = filename
         assert Path(filename).is_file()
         self.lock_file = f"{filename}.lock"
-        index_file = f"{filename}.index.pickle.xz"
-        self.file_index = _load_index_file(index_file)
+        self.file_index = load_index_file(f"{filename}.index")
         assert isinstance(self.file_index, FileIndex)
 
+        self.writer = SlotWriter(filename, self.lock_file, flush_interval, flush_count)
+
+        # the callback only references the writer, so that the finalizer does not keep
+        # this object alive. it also runs in worker processes
+        Finalize(self, self.writer.close, exitpriority=10)
+
     def set(self, key, value):
         if key not in self.file_index.indexdict:
             logging.getLogger("pipeline").warning(
@@ -51,15 +143,32 @@ class IndexedFile:
         append_comma = self.file_index.append_comma
         if append_comma is True and key == self.file_index.lastkey:
             append_comma = False
-        with open(self.filename, "r+b") as fp:
-            fp.seek(self.file_index.indexdict[key])
-            padded = _quote(value, self.file_index.maxlen, append_comma).encode()
-            fp.write(padded)
+        padded = _quote(value, self.file_index.maxlen, append_comma).encode()
+        self.writer.put(self.file_index.indexdict[key], padded)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+def load_index_file(stem):
+    """
+    the index is cached by modification time and size, so that an index that was
+    written again by init_indexed_js_object_file or init_indexed_js_list_file, in this
+    or in another process, is loaded again
+    """
+    index_file = findpickle(stem)
+    if index_file is None:
+        return
+    stat = index_file.stat()
+    return _load_index_file(str(index_file), stat.st_mtime_ns, stat.st_size)
 
 
 @lru_cache(maxsize=128)
-def _load_index_file(filename):
-    return loadpicklelzma(filename)
+def _load_index_file(path, mtime_ns, size):
+    return loadpickle(path)
 
 
 def init_indexed_js_object_file(filename, functionname, keynames, maxlen, defaultvalue=""):
@@ -80,9 +189,9 @@ def init_indexed_js_object_file(filename, functionname, keynames, maxlen, defaul
             fp.write(placeholder)
             fp.write(" \\\n".encode())
         fp.write("}');\n".encode())
-    index_file = f"{filename}.index.pickle.xz"
     index = FileIndex(indexdict, maxlen, append_comma, lastkey=lastkey)
-    savepicklelzma(index_file, index)
+    savepickle(f"{filename}.index", index)
+    _load_index_file.cache_clear()  # the modification time may not have changed
 
 
 def init_indexed_js_list_file(
@@ -108,6 +217,6 @@ def init_indexed_js_list_file(
             fp.write(f" \\\n".encode())
             fp.write("  }".encode())
         fp.write(" \\\n]');\n".encode())
-    index_file = f"{filename}.index.pickle.xz"
     index = FileIndex(indexdict, maxlen, append_comma)
-    savepicklelzma(index_file, index)
+    savepickle(f"{filename}.index", index)
+    _load_index_file.cache_clear()  # the modification time may not have changed
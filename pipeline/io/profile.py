@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+persistent store of node resource usage that is recorded during execution
+
+"""
+
+from pathlib import Path
+from math import ceil
+import json
+
+import pandas as pd
+
+import fasteners
+from tabulate import tabulate
+
+
+def profile_key(node):
+    """
+    key that is shared by all nodes of the same kind, including mapnode subnodes
+    and nodes that are numbered in the workflow definition
+    """
+    name = node.name.lstrip("_").rstrip("0123456789")
+    return type(node.interface).__name__, name
+
+
+def apply_predictions(nodes, predictions):
+    """
+    set the resource usage of the nodes from the predictions of a profile store. this is
+    done after the workflow is expanded, so that the predictions do not end up in cached
+    workflows or execgraphs. the estimates that the nodes had before are kept, so that
+    applying the predictions again does not compound them
+
+    :return: number of nodes that have a prediction
+    """
+    n_nodes = 0
+    for node in nodes:
+        if not hasattr(node, "estimate_gb"):  # keep the estimate from the input size
+            node.estimate_gb = node._mem_gb
+        if not hasattr(node, "estimate_n_procs"):
+            node.estimate_n_procs = node.n_procs
+        # set private attributes, because the n_procs setter changes the node inputs
+        node._mem_gb = node.estimate_gb
+        node._n_procs = node.estimate_n_procs
+        prediction = predictions.get(profile_key(node))
+        if prediction is None:
+            continue
+        mem_gb_ratio, n_procs = prediction
+        # only ever raise the estimates, as the recorded usage may be from smaller
+        # inputs, and the number of threads of the interface is not changed here
+        node._mem_gb = max(node.estimate_gb, node.estimate_gb * mem_gb_ratio)
+        node._n_procs = max(node.estimate_n_procs, n_procs)
+        n_nodes += 1
+    return n_nodes
+
+
+class ProfileStore:
+    def __init__(self, workdir):
+        self.filename = Path(workdir) / "profile.jsonl"
+
+        lockfilename = f"{self.filename}.lock"
+        self.lock = fasteners.InterProcessLock(str(lockfilename))
+
+    def put_many(self, records):
+        if len(records) == 0:
+            return
+        with self.lock:
+            with open(str(self.filename), "a") as fp:
+                for record in records:
+                    fp.write(json.dumps(record))
+                    fp.write("\n")
+
+    def load(self):
+        if not self.filename.is_file():
+            return pd.DataFrame()
+        with self.lock:
+            return pd.read_json(str(self.filename), lines=True)
+
+    def summary(self):
+        dataframe = self.load()
+        if dataframe.empty:
+            return dataframe
+        dataframe["threads"] = dataframe["cpu_s"] / dataframe["wall_s"].clip(lower=1e-3)
+        return (
+            dataframe.groupby(["interface", "name"])
+            .agg(
+                count=("peak_gb", "size"),
+                input_gb=("input_gb", "mean"),
+                mem_gb=("mem_gb", "max"),
+                peak_gb_mean=("peak_gb", "mean"),
+                peak_gb_max=("peak_gb", "max"),
+                wall_s_mean=("wall_s", "mean"),
+                wall_s_max=("wall_s", "max"),
+                cpu_s_mean=("cpu_s", "mean"),
+                threads_max=("threads", "max"),
+            )
+            .sort_values("peak_gb_max", ascending=False)
+        )
+
+    def summary_table(self):
+        summary = self.summary()
+        if summary.empty:
+            return f'No profile records in "{self.filename}"'
+        return tabulate(summary.reset_index(), headers="keys", showindex=False, floatfmt=".2f")
+
+    def predict(self, min_count=3, quantile=0.95, headroom=1.2):
+        """
+        peak memory usage is predicted relative to the estimate that the node had when
+        the workflow was built. that estimate is derived from the size of the input
+        image, so the predictions carry over to inputs of a different size
+
+        :param min_count: minimum number of records needed for a prediction
+        :param quantile: quantile of the recorded usage to base the prediction on
+        :param headroom: factor to multiply the predicted memory with
+        :return: dict mapping profile_key to a tuple of the ratio of peak memory usage
+            to the estimate and the number of threads used
+        """
+        dataframe = self.load()
+        if dataframe.empty:
+            return dict()
+        dataframe["threads"] = dataframe["cpu_s"] / dataframe["wall_s"].clip(lower=1e-3)
+        if "estimate_gb" not in dataframe.columns:  # records from before the estimate
+            dataframe["estimate_gb"] = dataframe["mem_gb"]
+        dataframe["estimate_gb"] = dataframe["estimate_gb"].fillna(dataframe["mem_gb"])
+        dataframe["ratio"] = dataframe["peak_gb"] / dataframe["estimate_gb"].clip(lower=1e-3)
+
+        predictions = dict()
+        for key, group in dataframe.groupby(["interface", "name"]):
+            if len(group) < min_count:
+                continue
+            mem_gb_ratio = float(group["ratio"].quantile(quantile)) * headroom
+            n_procs = max(1, ceil(group["threads"].quantile(quantile) - 0.1))
+            predictions[key] = (mem_gb_ratio, n_procs)
+        return predictions
+
+    def runtimes(self, min_count=1):
+        """
+        :param min_count: minimum number of records needed for an estimate
+        :return: dict mapping profile_key to the mean recorded wall time in seconds
+        """
+        dataframe = self.load()
+        if dataframe.empty:
+            return dict()
+
+        runtimes = dict()
+        for key, group in dataframe.groupby(["interface", "name"]):
+            if len(group) < min_count:
+                continue
+            runtimes[key] = float(group["wall_s"].mean())
+        return runtimes
+
+    def output_sizes(self, min_count=1):
+        """
+        :param min_count: minimum number of records needed for an estimate
+        :return: dict mapping profile_key to the mean size of the outputs in bytes
+        """
+        dataframe = self.load()
+        if dataframe.empty or "output_gb" not in dataframe.columns:
+            return dict()
+        dataframe = dataframe.dropna(subset=["output_gb"])
+
+        output_sizes = dict()
+        for key, group in dataframe.groupby(["interface", "name"]):
+            if len(group) < min_count:
+                continue
+            output_sizes[key] = float(group["output_gb"].mean()) * 2 ** 30
+        return output_sizes
@@ -33,6 +33,12 @@ class ResultHook:
     def __exit__(self, *args):
         pass
 
+    def compact(self):
+        """
+        bring the report files up to date at the end of a run
+        """
+        pass
+
     def run(self, resultdict):
         entitytupls = [(k, resultdict[k]) for k in bold_entities if k in resultdict]
         if len(entitytupls) == 0:
@@ -74,14 +80,17 @@ class PreprocessedImgCopyOutResultHook(ResultHook):
         self.dictlistfile.__enter__()
 
     def __exit__(self, *args):
-        self.dictlistfile.to_table()
         self.dictlistfile.__exit__(*args)
 
+    def compact(self):
+        self.dictlistfile.compact(table=True)
+
     def init_dictlistfile(self, dictlist):
         with self:
             for statusdict in dictlist:
                 statusdict.update({"status": "missing"})
-                self.dictlistfile.put(statusdict)
+            self.dictlistfile.put_many(dictlist)
+        self.compact()
 
     def _run_hook(self, entitytupls, valuedict):
         if "preproc" not in valuedict:
@@ -108,9 +117,11 @@ class ReportValsResultHook(ResultHook):
         self.dictlistfile.__enter__()
 
     def __exit__(self, *args):
-        self.dictlistfile.to_table()
         self.dictlistfile.__exit__(*args)
 
+    def compact(self):
+        self.dictlistfile.compact(table=True)
+
     def _run_hook(self, entitytupls, valuedict):
         valuedict.update(entitytupls)
         self.dictlistfile.put(valuedict)
@@ -132,6 +143,9 @@ class ReportImgResultHook(ResultHook):
     def __exit__(self, *args):
         self.dictlistfile.__exit__(*args)
 
+    def compact(self):
+        self.dictlistfile.compact()
+
     def _run_hook(self, entitytupls, valuedict):
         if "report" not in valuedict:
             return
@@ -6,45 +6,133 @@ Nipype interfaces to calculate connectivity measures using nilearn.
 Adapted from https://github.com/Neurita/pypes
 """
 
+from functools import lru_cache
+
 import numpy as np
 import nibabel as nib
-
-from scipy.ndimage.measurements import mean
+from scipy import sparse
 
 from ..utils import nvol
 
 
-def img_to_signals(in_file, atlas_file, mask_file=None, background_label=0, min_n_voxels=50):
-    in_img = nib.load(in_file)
+class LabelIndicator:
+    """
+    sparse matrix that maps the voxels of a label image to the mean of each label
+
+    only voxels that belong to a label with enough voxels are kept, so
+    that the data that needs to be read can be restricted to them
+    """
+
+    def __init__(self, labels, nlabel, background_label=0, min_n_voxels=50, dtype=np.float64):
+        self.shape = labels.shape
+        self.nlabel = nlabel
+
+        labelvec = labels.ravel(order="F")  # nifti data is stored in fortran order
+
+        indices, counts = np.unique(labelvec, return_counts=True)
+        isvalid = np.logical_and(counts >= min_n_voxels, indices != background_label)
+        self.indices = indices[isvalid]
+
+        voxelmask = np.isin(labelvec, self.indices)
+        self.voxel_indices = np.flatnonzero(voxelmask)
+
+        voxellabels = labelvec[self.voxel_indices]
+        rows = np.searchsorted(self.indices, voxellabels)
+        weights = 1.0 / counts[isvalid][rows]
+
+        self.matrix = sparse.csr_matrix(
+            (weights.astype(dtype), (rows, np.arange(self.voxel_indices.size))),
+            shape=(self.indices.size, self.voxel_indices.size),
+        )
 
+    def __call__(self, voxeldata):
+        """
+        :param voxeldata: array of shape (n_voxels, n_volumes) in the order of voxel_indices
+        :return: array of shape (n_volumes, nlabel) with nan for missing labels
+        """
+        dtype = self.matrix.dtype
+        result = np.full((voxeldata.shape[1], self.nlabel), np.nan, dtype=dtype)
+        result[:, self.indices - 1] = (self.matrix @ voxeldata.astype(dtype, copy=False)).T
+        return result
+
+
+@lru_cache(maxsize=16)
+def load_label_indicator(
+    atlas_file, mask_file=None, background_label=0, min_n_voxels=50, dtype=np.float64
+):
     atlas_img = nib.load(atlas_file)
     assert nvol(atlas_img) == 1
-    assert atlas_img.shape[:3] == in_img.shape[:3]
-    assert np.allclose(atlas_img.affine, in_img.affine)
     labels = np.asanyarray(atlas_img.dataobj).astype(np.int32)
     nlabel = labels.max()
 
     if mask_file is not None:
         mask_img = nib.load(mask_file)
         assert nvol(mask_img) == 1
-        assert mask_img.shape[:3] == in_img.shape[:3]
-        assert np.allclose(mask_img.affine, in_img.affine)
-        mask_data = np.asanyarray(mask_img.dataobj).astype(np.bool)
+        assert mask_img.shape[:3] == atlas_img.shape[:3]
+        assert np.allclose(mask_img.affine, atlas_img.affine)
+        mask_data = np.asanyarray(mask_img.dataobj).astype(bool)
         labels[np.logical_not(mask_data)] = background_label
 
     assert np.all(labels >= 0)
 
-    indices, counts = np.unique(labels, return_counts=True)
-    indices = indices[counts >= min_n_voxels]
-    indices = np.setdiff1d(indices, [background_label])
+    return (
+        LabelIndicator(
+            labels.reshape(labels.shape[:3]),
+            nlabel,
+            background_label=background_label,
+            min_n_voxels=min_n_voxels,
+            dtype=dtype,
+        ),
+        atlas_img.affine,
+    )
+
+
+def iter_volume_chunks(in_img, chunk_size=None):
+    """
+    read a series in chunks of at most chunk_size volumes via the nibabel
+    array proxy, which memory-maps or seeks uncompressed files and only
+    decompresses up to the current chunk for compressed files
+
+    :param in_img: nibabel image
+    :param chunk_size: number of volumes per chunk, or None to read all at once
+    """
+    if len(in_img.shape) == 3:
+        yield np.asanyarray(in_img.dataobj)[:, :, :, np.newaxis]
+        return
+    assert len(in_img.shape) == 4
+
+    n_volumes = in_img.shape[3]
+    if chunk_size is None:
+        chunk_size = n_volumes
+    for start in range(0, n_volumes, chunk_size):
+        yield in_img.dataobj[:, :, :, start : start + chunk_size]
+
+
+def img_to_signals(
+    in_file,
+    atlas_file,
+    mask_file=None,
+    background_label=0,
+    min_n_voxels=50,
+    dtype=np.float64,
+    chunk_size=None,
+):
+    in_img = nib.load(in_file)
 
-    in_data = in_img.get_fdata()
-    if in_data.ndim == 3:
-        in_data = in_data[:, :, :, np.newaxis]
-    assert in_data.ndim == 4
+    indicator, atlas_affine = load_label_indicator(
+        atlas_file,
+        mask_file=mask_file,
+        background_label=background_label,
+        min_n_voxels=min_n_voxels,
+        dtype=np.dtype(dtype),
+    )
+    assert indicator.shape == in_img.shape[:3]
+    assert np.allclose(atlas_affine, in_img.affine)
 
-    result = np.full((in_data.shape[3], nlabel), np.nan)
-    for i, img in enumerate(np.moveaxis(in_data, 3, 0)):
-        result[i, indices - 1] = mean(img, labels=labels, index=indices)
+    results = []
+    for in_data in iter_volume_chunks(in_img, chunk_size=chunk_size):
+        voxeldata = in_data.reshape((-1, in_data.shape[3]), order="F")[indicator.voxel_indices, :]
+        del in_data  # only keep the masked voxels of the current chunk
+        results.append(indicator(voxeldata))
 
-    return result
+    return np.concatenate(results, axis=0)
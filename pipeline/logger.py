@@ -11,7 +11,6 @@ import fasteners
 
 from .io import IndexedFile
 
-
 fmt = "[{asctime},{msecs:04.0f}] [{name:16}] [{levelname:7}] {message}"
 datefmt = "%Y-%m-%d %H:%M:%S"
 
@@ -90,6 +89,11 @@ class FileHandler(logging.FileHandler):
 
 
 class JSReportHandler(logging.Handler):
+    """
+    set the status of each node in reportexec.js from the log messages of nipype, for
+    the plugins that do not emit execution events
+    """
+
     def __init__(self, filename, level=logging.INFO):
         super(JSReportHandler, self).__init__(level=level)
         self.filename = filename
@@ -109,13 +113,9 @@ class JSReportHandler(logging.Handler):
         if record.msg == '[Node] Setting-up "%s" in "%s".':
             self.cur_nodename = record.args[0]
             nodestatus = "RUNNING"
-        elif record.msg == '[Node] Cached "%s" - collecting precomputed outputs':
-            pass
         elif record.msg == '[Node] "%s" found cached%s.':
             nodeisdone = True
-            # nodestatus = "SUCCESS"
-        elif record.msg.startswith("[Node] Running"):
-            pass
+            nodestatus = "CACHED"
         elif record.msg == '[Node] Finished "%s".':
             nodeisdone = True
             nodestatus = "SUCCESS"
@@ -129,7 +129,7 @@ class JSReportHandler(logging.Handler):
             and nodestatus is not None
         ):
             if self.indexed_file_obj is None:
-                logging.getLogger("pipeline").warning(f"Missing indexed_file_obj to log nodestatus")
+                logging.getLogger("pipeline").warning("Missing indexed_file_obj to log nodestatus")
             else:
                 self.indexed_file_obj.set(self.cur_nodename, nodestatus)
 
@@ -216,6 +216,11 @@ class Logger:
 
         logging.getLogger("pipeline.ui").removeHandler(stdout_handler)  # only log to file
 
+    def add_jsreport_handler(workdir):
+        """
+        fallback for the stock nipype plugins, which run the nodes in processes that
+        are forked from this one, so that they inherit the handler
+        """
         logging.getLogger("nipype.workflow").addHandler(
             JSReportHandler(op.join(workdir, "reports", "reportexec.js"))
         )
@@ -2,6 +2,7 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+from .linear import LinearPlugin
 from .multiproc import MultiProcPlugin
 
-__all__ = [MultiProcPlugin]
+__all__ = [LinearPlugin, MultiProcPlugin]
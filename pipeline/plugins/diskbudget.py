@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+admit subjects to the MultiProc plugin only while the predicted size of the workdir
+fits a budget
+
+"""
+
+from collections import Counter
+import logging
+
+from ..io.profile import profile_key
+
+logger = logging.getLogger("nipype.workflow")
+
+
+def subject_of(node):
+    hierarchy = node._hierarchy
+    if hierarchy is None or not hierarchy.startswith("nipype.subjectlevel."):
+        return None
+    return hierarchy.split(".")[2]
+
+
+class DiskBudget:
+    """
+    :param max_bytes: budget for the outputs in the workdir
+    :param output_sizes: dict mapping profile_key to the size of the outputs in bytes
+        from previous runs, which is updated with the sizes from this run
+    """
+
+    def __init__(self, max_bytes, output_sizes=None):
+        self.max_bytes = max_bytes
+
+        self.output_sizes = dict()  # profile_key -> (count, mean size in bytes)
+        if output_sizes is not None:
+            for key, size in output_sizes.items():
+                self.output_sizes[key] = (1, size)
+
+        self.usage = 0  # bytes of outputs in node directories that were not removed
+        self.produced = Counter()  # bytes per node directory, across execgraphs
+
+        self.subjects = list()  # subject of each job
+        self.keys = list()  # profile_key of each job
+        self.expected = list()  # expected bytes of each job
+        self.subjectjobs = dict()
+        self.unfinished = Counter()  # number of unfinished jobs per subject
+        self.remaining = Counter()  # expected bytes of unfinished jobs per subject
+        self.admitted = set()
+
+    def reset(self, procs):
+        """
+        :param procs: the jobs of the execgraph, without mapnode subnodes
+        """
+        self.subjects = [subject_of(node) for node in procs]
+        self.keys = [profile_key(node) for node in procs]
+        self.expected = [0] * len(procs)  # set on admission, when more sizes are known
+
+        self.subjectjobs = dict()
+        self.unfinished.clear()
+        self.remaining.clear()
+        self.admitted.clear()
+        for jobid, subject in enumerate(self.subjects):
+            if subject is not None:
+                self.subjectjobs.setdefault(subject, list()).append(jobid)
+                self.unfinished[subject] += 1
+
+    def estimates(self, subject):
+        """
+        :return: predicted size in bytes of the outputs of each job of the subject, or
+            None if no sizes are known yet
+        """
+        if len(self.output_sizes) == 0:
+            return None
+        # unknown nodes are assumed to be average
+        default = sum(size for _, size in self.output_sizes.values()) / len(self.output_sizes)
+        return {
+            jobid: self.output_sizes.get(self.keys[jobid], (0, default))[1]
+            for jobid in self.subjectjobs[subject]
+        }
+
+    def footprint(self, subject):
+        estimates = self.estimates(subject)
+        if estimates is None:
+            return None
+        return sum(estimates.values())
+
+    def projected(self):
+        """
+        :return: current usage plus the expected bytes of the unfinished jobs of the
+            subjects that were admitted
+        """
+        return self.usage + sum(
+            self.remaining[subject] for subject in self.admitted if self.unfinished[subject] > 0
+        )
+
+    def admit(self, subject):
+        estimates = self.estimates(subject) or dict()
+        for jobid, size in estimates.items():
+            self.expected[jobid] = size
+        footprint = sum(estimates.values())
+        self.remaining[subject] = footprint
+        self.admitted.add(subject)
+        logger.info(
+            "[MultiProc] Admitting subject %s (%0.2fGB predicted, "
+            "projected workdir usage %0.2fGB of %0.2fGB)",
+            subject,
+            footprint / 2 ** 30,
+            self.projected() / 2 ** 30,
+            self.max_bytes / 2 ** 30,
+        )
+
+    def filter(self, jobids, parentids, n_running):
+        """
+        admit new subjects in the order of priority of their ready jobs, as long as
+        their predicted footprint fits. a subject is always admitted if nothing else
+        can run, so that the workflow can finish even if the budget is too small
+
+        :param jobids: ready jobs in order of priority
+        :param parentids: parent mapnode of each job, or the job itself
+        :param n_running: number of jobs that are running
+        :return: the jobs of admitted subjects and of nodes outside of subjects
+        """
+        selected = set()
+        candidates = list()
+        for jobid, parentid in zip(jobids, parentids):
+            subject = self.subjects[parentid]
+            if subject is None or subject in self.admitted:
+                selected.add(jobid)
+            else:
+                candidates.append((jobid, subject))
+
+        idle = len(selected) == 0 and n_running == 0
+        active = any(self.unfinished[subject] > 0 for subject in self.admitted)
+        full = False  # later subjects wait for the first one that does not fit
+        for jobid, subject in candidates:
+            if subject not in self.admitted:
+                if full:
+                    continue
+                if idle or not active:
+                    pass  # nothing else can run
+                else:
+                    footprint = self.footprint(subject)
+                    if footprint is None or self.projected() + footprint > self.max_bytes:
+                        full = True
+                        continue
+                self.admit(subject)
+                idle, active = False, True
+            selected.add(jobid)
+
+        return [jobid for jobid in jobids if jobid in selected]
+
+    def finished(self, jobid, parentid, outdir, size, key=None):
+        """
+        :param jobid: the job that finished
+        :param parentid: the parent mapnode of the job, or the job itself
+        :param outdir: the node directory of the parent, as mapnode subnodes are
+            stored in the directory of the parent
+        :param size: bytes of outputs that the job produced in its directory
+        :param key: profile_key to update the output size estimates with
+        """
+        self.usage += size
+        self.produced[outdir] += size
+
+        if key is not None:
+            count, mean = self.output_sizes.get(key, (0, 0.0))
+            self.output_sizes[key] = (count + 1, mean + (size - mean) / (count + 1))
+
+        if jobid == parentid:
+            subject = self.subjects[parentid]
+            if subject is not None:
+                self.unfinished[subject] -= 1
+                self.remaining[subject] = max(0, self.remaining[subject] - self.expected[jobid])
+
+    def removed(self, outdir):
+        self.usage -= self.produced.pop(outdir, 0)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+structured node execution events that are emitted by the plugins
+
+"""
+
+import os
+from os import path as op
+import json
+import logging
+import socket
+import time
+
+from ..io import IndexedFile
+
+logger = logging.getLogger("pipeline")
+
+hostname = socket.gethostname()
+
+transitions = {  # event -> states of the node that it can follow
+    "queued": (None,),
+    "started": (None, "queued"),
+    "finished": ("started",),
+    "failed": (None, "queued", "started"),
+    "cached": (None,),
+}
+
+
+class ReportExecSink:
+    """
+    set the status of each node in reportexec.js
+    """
+
+    statuses = {
+        "queued": "QUEUED",
+        "started": "RUNNING",
+        "finished": "SUCCESS",
+        "failed": "FAILED",
+        "cached": "CACHED",
+    }
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.indexed_file_obj = None
+
+    def put(self, event):
+        name = event["node"]
+        if name.startswith("_"):
+            return  # mapnode subnodes are not in the report
+        if self.indexed_file_obj is None:
+            if not op.isfile(self.filename):
+                return
+            self.indexed_file_obj = IndexedFile(self.filename)
+        self.indexed_file_obj.set(name, self.statuses[event["event"]])
+
+    def flush(self):
+        if self.indexed_file_obj is not None:
+            self.indexed_file_obj.flush()
+
+    def close(self):
+        if self.indexed_file_obj is not None:
+            self.indexed_file_obj.close()
+        self.indexed_file_obj = None
+
+
+class JSONLSink:
+    """
+    append each event as a line of json
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+
+    def put(self, event):
+        if self.fp is None:
+            self.fp = open(self.filename, "a", buffering=1)  # line buffered for tail -f
+        self.fp.write(json.dumps(event))
+        self.fp.write("\n")
+
+    def flush(self):
+        if self.fp is not None:
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+        self.fp = None
+
+
+class ChromeTraceSink:
+    """
+    write a timeline in the chrome trace event format that can be opened in
+    chrome://tracing or https://ui.perfetto.dev
+
+    the closing bracket of the json array is optional in this format, so events from
+    consecutive runs can be appended to the same file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+
+    def put(self, event):
+        if event["event"] not in ("finished", "failed", "cached"):
+            return  # one slice per node from its start to its end
+
+        if self.fp is None:
+            isnew = not op.isfile(self.filename) or op.getsize(self.filename) == 0
+            self.fp = open(self.filename, "a")
+            if isnew:
+                self.fp.write("[\n")
+
+        duration = event.get("duration_s") or 0.0
+        args = {key: value for key, value in event.items() if key not in ("time", "node")}
+        traceevent = dict(
+            name=event["node"].split(".")[-1],
+            cat=event["event"],
+            ph="X",
+            ts=(event["time"] - duration) * 1e6,
+            dur=duration * 1e6,
+            pid=event["pid"],
+            tid=event["pid"],
+            args=dict(node=event["node"], **args),
+        )
+        self.fp.write(json.dumps(traceevent))
+        self.fp.write(",\n")
+
+    def flush(self):
+        if self.fp is not None:
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+        self.fp = None
+
+
+class ExecutionEvents:
+    """
+    track the state of each node and emit every state transition once to all sinks
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self.states = dict()
+
+    def state(self, name):
+        return self.states.get(name)
+
+    def emit(self, name, event, **kwargs):
+        """
+        :param name: fullname of the node
+        :param event: one of queued, started, finished, failed or cached
+        :param kwargs: override the defaults for time, host and pid, or add fields
+            such as duration_s and peak_gb
+        :return: True if the event was emitted
+        """
+        if self.states.get(name) not in transitions[event]:
+            return False
+        self.states[name] = event
+
+        record = dict(event=event, node=name, time=time.time(), host=hostname, pid=os.getpid())
+        record.update(kwargs)
+        for sink in self.sinks:
+            try:
+                sink.put(record)
+            except Exception as e:
+                logger.warning(f'Could not write event to "{sink.filename}": %s', e)
+        return True
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def reset(self):
+        self.flush()
+        self.states.clear()
+
+    def close(self):
+        self.reset()
+        for sink in self.sinks:
+            sink.close()
+
+
+def init_events(plugin_args):
+    """
+    :param plugin_args: uses workdir, and the list of sinks from events
+    :return: ExecutionEvents
+    """
+    workdir = plugin_args.get("workdir", os.getcwd())
+    sinknames = plugin_args.get("events", ["reportexec"])
+
+    sinks = list()
+    for sinkname in sinknames:
+        if sinkname == "reportexec":
+            sinks.append(ReportExecSink(op.join(workdir, "reports", "reportexec.js")))
+        elif sinkname == "jsonl":
+            sinks.append(JSONLSink(op.join(workdir, "exec.jsonl")))
+        elif sinkname == "chrome":
+            sinks.append(ChromeTraceSink(op.join(workdir, "exec.trace.json")))
+        else:
+            raise ValueError(f'Unknown event sink "{sinkname}"')
+    return ExecutionEvents(sinks)
+
+
+def runtime_fields(result):
+    """
+    :param result: the dict returned by run_node_profiled
+    :return: dict of event fields that were measured in the worker process
+    """
+    if result is None:
+        return dict()
+    fields = dict(result.get("runtime", dict()))
+    profile = result.get("profile")
+    if profile is not None:
+        fields.update(peak_gb=profile["peak_gb"])
+    return fields
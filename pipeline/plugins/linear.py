@@ -5,15 +5,39 @@
 """
 
 import os
+from time import time
+
 from nipype.pipeline import plugins as nip
-from nipype.engine.base import logger, report_crash, report_nodes_not_run, str2bool
-from nipype.engine.utils import topological_sort
+from nipype.pipeline.plugins.base import logger, str2bool
+from nipype.pipeline.plugins.tools import report_crash, report_nodes_not_run
+from nipype.pipeline.engine.utils import topological_sort
+
+from .events import init_events
+
+
+def is_cached(node):
+    """
+    same check as in DistributedPluginBase._local_hash_check
+    """
+    if not str2bool(node.config["execution"]["local_hash_check"]):
+        return False
+    try:
+        cached, updated = node.is_cached()
+    except Exception:
+        return False  # the node will be run and fail
+    overwrite = node.overwrite
+    always_run = node.interface.always_run
+    return cached and updated and (overwrite is False or overwrite is None and not always_run)
 
 
 class LinearPlugin(nip.LinearPlugin):
     """Execute workflow in series
     """
 
+    def __init__(self, plugin_args=None):
+        super(LinearPlugin, self).__init__(plugin_args=plugin_args)
+        self._events = init_events(self.plugin_args)
+
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline in a serial order.
         Parameters
@@ -35,33 +59,44 @@ class LinearPlugin(nip.LinearPlugin):
         notrun = []
         donotrun = []
         nodes, _ = topological_sort(graph)
-        for node in nodes:
-            endstatus = "end"
-            try:
-                if node in donotrun:
-                    continue
-                if self._status_callback:
-                    self._status_callback(node, "start")
-                node.run(updatehash=updatehash)
-            except Exception:
-                endstatus = "exception"
-                # bare except, but i really don't know where a
-                # node might fail
-                crashfile = report_crash(node)
-                if str2bool(config["execution"]["stop_on_first_crash"]):
-                    raise
-                # remove dependencies from queue
-                subnodes = [s for s in dfs_preorder(graph, node)]
-                notrun.append({"node": node, "dependents": subnodes, "crashfile": crashfile})
-                donotrun.extend(subnodes)
-                # Delay raising the crash until we cleaned the house
-                if str2bool(config["execution"]["stop_on_first_crash"]):
-                    os.chdir(old_wd)  # Return wherever we were before
-                    report_nodes_not_run(notrun)  # report before raising
-                    raise
-            finally:
-                if self._status_callback:
-                    self._status_callback(node, endstatus)
+        try:
+            for node in nodes:
+                endstatus = "end"
+                start = time()
+                try:
+                    if node in donotrun:
+                        continue
+                    if self._status_callback:
+                        self._status_callback(node, "start")
+                    if is_cached(node):
+                        node.run(updatehash=updatehash)  # only collects the outputs
+                        self._events.emit(node.fullname, "cached")
+                        continue
+                    self._events.emit(node.fullname, "started", time=start)
+                    node.run(updatehash=updatehash)
+                    self._events.emit(node.fullname, "finished", duration_s=time() - start)
+                except Exception:
+                    endstatus = "exception"
+                    self._events.emit(node.fullname, "failed", duration_s=time() - start)
+                    # bare except, but i really don't know where a
+                    # node might fail
+                    crashfile = report_crash(node)
+                    if str2bool(config["execution"]["stop_on_first_crash"]):
+                        raise
+                    # remove dependencies from queue
+                    subnodes = [s for s in dfs_preorder(graph, node)]
+                    notrun.append({"node": node, "dependents": subnodes, "crashfile": crashfile})
+                    donotrun.extend(subnodes)
+                    # Delay raising the crash until we cleaned the house
+                    if str2bool(config["execution"]["stop_on_first_crash"]):
+                        os.chdir(old_wd)  # Return wherever we were before
+                        report_nodes_not_run(notrun)  # report before raising
+                        raise
+                finally:
+                    if self._status_callback:
+                        self._status_callback(node, endstatus)
+        finally:
+            self._events.close()  # the sinks are opened again by the next run
 
         os.chdir(old_wd)  # Return wherever we were before
         report_nodes_not_run(notrun)
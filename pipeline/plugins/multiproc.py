@@ -3,27 +3,38 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
 import os
+import queue
 import multiprocessing as mp
 from concurrent.futures import ProcessPoolExecutor
 import logging
-import shutil
+from time import time
 
 import numpy as np
 
 from nipype.pipeline import plugins as nip
+from nipype.pipeline.engine import MapNode
 from nipype.utils.profiler import get_system_total_memory_gb
 
+from .diskbudget import DiskBudget
+from .events import init_events, runtime_fields
+from .profiler import start_sampler_daemon, set_started_queue, run_node_profiled
 from .refcount import ReferenceCounter
+from .scheduler import cheap_interfaces, critical_path_lengths
+from .trash import Trash
+from ..io.profile import ProfileStore, profile_key
 from ..logger import Logger
 from ..watchdog import start_watchdog_daemon
 
 logger = logging.getLogger("nipype.workflow")
 
 
-def initializer(workdir, debug, verbose, watchdog):
+def initializer(workdir, debug, verbose, watchdog, profile, started_queue):
     Logger.setup(workdir, debug=debug, verbose=verbose)
+    set_started_queue(started_queue)
     if watchdog is True:
         start_watchdog_daemon()
+    if profile is True:
+        start_sampler_daemon()
 
     os.chdir(workdir)
 
@@ -59,25 +70,231 @@ class MultiProcPlugin(nip.MultiProcPlugin):
         debug = plugin_args.get("debug", False)
         verbose = plugin_args.get("verbose", False)
         watchdog = plugin_args.get("watchdog", False)
+        profile = plugin_args.get("profile", False)
 
         mp_context = mp.get_context("forkserver")  # force forkserver
+        self._started = mp_context.Queue()
         self.pool = ProcessPoolExecutor(
             max_workers=self.processors,
             initializer=initializer,
-            initargs=(self._cwd, debug, verbose, watchdog),
+            initargs=(self._cwd, debug, verbose, watchdog, profile, self._started),
             mp_context=mp_context,
         )
 
         self._stats = None
         self._keep = plugin_args.get("keep", "all")
+        self._trash = None
+        if self._keep != "all":
+            self._trash = Trash(self._cwd)
+
+        # run cheap nodes in the scheduler process instead of the pool
+        self._inline = plugin_args.get("inline", False)
+        self._inline_max_mem_gb = plugin_args.get("inline_max_mem_gb", 0.5)
+        self._n_submitted = 0
+        self._n_inline = 0
+
+        self._critical_path = None
+
+        self._profile_store = None
+        if profile is True:
+            self._profile_store = ProfileStore(self._cwd)
+        self._profile_records = []
+        self._output_bytes = dict()
+
+        # admit subjects only while their outputs are predicted to fit the budget
+        self._budget = None
+        max_workdir_gb = plugin_args.get("max_workdir_gb")
+        if max_workdir_gb is not None:
+            output_sizes = ProfileStore(self._cwd).output_sizes()
+            self._budget = DiskBudget(max_workdir_gb * 2 ** 30, output_sizes=output_sizes)
+
+        self._events = init_events(plugin_args)
+        self._task_names = dict()
+
+    def _generate_dependency_list(self, graph):
+        super(MultiProcPlugin, self)._generate_dependency_list(graph)
+        if self.plugin_args.get("scheduler") == "critical-path":
+            runtimes = ProfileStore(self._cwd).runtimes()  # from previous runs
+            lengths = critical_path_lengths(graph, runtimes=runtimes)
+            self._critical_path = np.array([lengths[proc] for proc in self.procs])
+        if self._budget is not None:
+            self._budget.reset(self.procs)
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        if scheduler != "critical-path":
+            jobids = super(MultiProcPlugin, self)._sort_jobs(jobids, scheduler=scheduler)
+        else:
+
+            def key(jobid):
+                node = self.procs[jobid]
+                parentid = self.mapnodesubids.get(jobid, jobid)  # subnodes inherit priority
+                return (-self._critical_path[parentid], -node.mem_gb, -node.n_procs)
+
+            # longest remaining chain first, and within that largest jobs first, so that
+            # the first-fit allocation in _send_procs_to_workers packs memory and threads
+            # as a first-fit decreasing bin packing
+            jobids = sorted(jobids, key=key)
+
+        if self._budget is not None:
+            parentids = [self.mapnodesubids.get(jobid, jobid) for jobid in jobids]
+            jobids = self._budget.filter(jobids, parentids, len(self.pending_tasks))
+        return jobids
+
+    def _is_cheap(self, node):
+        if not isinstance(node.interface, cheap_interfaces):
+            return False
+        return node.n_procs <= 1 and node.mem_gb <= self._inline_max_mem_gb
+
+    def _submit_job(self, node, updatehash=False):
+        self._events.emit(node.fullname, "queued")
+
+        if self._inline and self._is_cheap(node):
+            self._taskid += 1
+            self._task_names[self._taskid] = node.fullname
+            self._events.emit(node.fullname, "started")
+            # result will be picked up by the next iteration of the scheduler loop
+            self._taskresult[self._taskid] = run_node_profiled(node, updatehash, self._taskid)
+            self._n_inline += 1
+            logger.debug(
+                "[MultiProc] Ran task %s inline (taskid=%d).", node.fullname, self._taskid
+            )
+            return self._taskid
+
+        self._n_submitted += 1
+        self._taskid += 1
+        self._task_names[self._taskid] = node.fullname
+
+        # Don't allow streaming outputs
+        if getattr(node.interface, "terminal_output", "") == "stream":
+            node.interface.terminal_output = "allatonce"
+
+        result_future = self.pool.submit(run_node_profiled, node, updatehash, self._taskid)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+
+        logger.debug("[MultiProc] Submitted task %s (taskid=%d).", node.fullname, self._taskid)
+        return self._taskid
+
+    def _get_result(self, taskid):
+        self._emit_started()
+        return self._taskresult.get(taskid)
+
+    def _emit_started(self):
+        # the workers report the time and process of each task when it starts
+        while not self._started.empty():
+            try:
+                startedtaskid, fields = self._started.get_nowait()
+            except queue.Empty:
+                break
+            name = self._task_names.get(startedtaskid)
+            if name is not None:
+                self._events.emit(name, "started", **fields)
+
+    def _clear_task(self, taskid):
+        self._task_obj.pop(taskid, None)
+        result = self._taskresult.pop(taskid, None)
+        name = self._task_names.pop(taskid, None)
+        if result is not None and result.get("traceback") is None and name is not None:
+            self._emit_finished(name, runtime_fields(result))
+        if result is not None and result.get("traceback") is None and "profile" in result:
+            if name in self._output_bytes:
+                result["profile"]["output_gb"] = self._output_bytes.pop(name) / 2 ** 30
+            self._profile_records.append(result["profile"])
+            if len(self._profile_records) >= 64:
+                self._flush_profile_records()
+
+    def _flush_profile_records(self):
+        if self._profile_store is not None:
+            self._profile_store.put_many(self._profile_records)
+        self._profile_records = []
+
+    def _postrun_check(self):
+        # keep the pool alive so that it can be re-used for the next execgraph
+        n_total = self._n_submitted + self._n_inline
+        if n_total > 0:
+            logger.info(
+                "[MultiProc] Submitted %d of %d tasks to the process pool, "
+                "ran %d inline (avoided submissions)",
+                self._n_submitted,
+                n_total,
+                self._n_inline,
+            )
+        self._n_submitted = 0
+        self._n_inline = 0
+
+        self._flush_profile_records()
+
+        if self._trash is not None:
+            self._log_trash_stats()
+
+        self._events.close()  # opened again by the next run, with a re-initialized index
+        self._task_names.clear()
+        self._output_bytes.clear()
+
+    def shutdown(self):
+        """
+        write out everything that is buffered and stop the worker processes, also
+        when the last run did not finish
+        """
+        try:
+            self._flush_profile_records()
+            self._events.close()
+            if self._trash is not None:
+                self._trash.drain()
+                self._log_trash_stats()
+        finally:
+            self.pool.shutdown()
+            self._started.close()
+
+    def _log_trash_stats(self):
+        stats = self._trash.stats()
+        logger.info(
+            "[MultiProc] Deleted %d directories (%0.2fGB at %0.3fGB/s), "
+            "%d directories (%0.2fGB) are pending deletion",
+            stats["removed_count"],
+            stats["removed_gb"],
+            stats["throughput_gb_s"],
+            stats["pending_count"],
+            stats["pending_gb"],
+        )
+
+    def _emit_finished(self, name, fields):
+        # the task may have finished between two polls, so that started was not emitted yet
+        started = {key: fields[key] for key in ("host", "pid") if key in fields}
+        if "duration_s" in fields:
+            started.update(time=fields["time"] - fields["duration_s"])
+        self._events.emit(name, "started", **started)
+        self._events.emit(name, "finished", **fields)
 
     def _task_finished_cb(self, jobid, cached=False):
+        node = self.procs[jobid]
+        name = node.fullname
         try:
-            self._rc.put(self.procs[jobid].result, jobid=jobid)
+            result = node.result
+            size = self._rc.put(result, jobid=jobid, outdir=node.output_dir())
         except Exception:
-            pass  # node doesn't have a result
+            result, size = None, 0  # node doesn't have a result
+        if self._profile_store is not None:
+            self._output_bytes[name] = size
+        if self._budget is not None:
+            parentid = self.mapnodesubids.get(jobid, jobid)
+            key = None if isinstance(node, MapNode) else profile_key(node)  # subnodes have it
+            outdir = self.procs[parentid].output_dir()  # subnodes are in the parent directory
+            self._budget.finished(jobid, parentid, outdir, size, key=key)
+        if cached:
+            self._events.emit(name, "cached")
+        elif self._events.state(name) is None:  # was run on the master thread
+            fields = dict()
+            duration = getattr(getattr(result, "runtime", None), "duration", None)
+            if duration is not None:
+                fields.update(time=time(), duration_s=duration)
+            self._emit_finished(name, fields)
         super(MultiProcPlugin, self)._task_finished_cb(jobid, cached=cached)
 
+    def _clean_queue(self, jobid, graph, result=None):
+        self._events.emit(self.procs[jobid].fullname, "failed", **runtime_fields(result))
+        return super(MultiProcPlugin, self)._clean_queue(jobid, graph, result=result)
+
     def _async_callback(self, args):
         try:
             result = args.result()
@@ -109,4 +326,6 @@ class MultiProcPlugin(nip.MultiProcPlugin):
                     ("[node dependencies finished] " "removing node: %s from directory %s")
                     % (self.procs[idx]._id, outdir)
                 )
-                shutil.rmtree(outdir, ignore_errors=True)
+                self._trash.put(outdir)  # deleted in the background
+                if self._budget is not None:
+                    self._budget.removed(outdir)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+sample the resource usage of worker processes
+
+"""
+
+import os
+import time
+import threading
+
+import psutil
+from nipype.pipeline.plugins.multiproc import run_node
+
+from .events import hostname
+from ..io.profile import profile_key
+from ..utils import findpaths
+
+sampler = None  # one per worker process
+started_queue = None  # to tell the scheduler when and where each task started
+
+
+class ResourceSampler:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.lock = threading.Lock()
+
+    def rss(self):
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):  # command line tools
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass  # child has exited
+        return rss
+
+    def reset(self):
+        with self.lock:
+            self.peak_rss = self.rss()
+
+    def sample(self):
+        rss = self.rss()
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def cpu_time(self):
+        cpu_times = self.process.cpu_times()
+        return (
+            cpu_times.user + cpu_times.system + cpu_times.children_user + cpu_times.children_system
+        )
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except psutil.Error:
+                pass
+
+
+def start_sampler_daemon(interval=0.5):
+    global sampler
+    sampler = ResourceSampler(interval=interval)
+
+    samplerthread = threading.Thread(target=sampler.run, daemon=True, name="sampler")
+    samplerthread.start()
+
+
+def set_started_queue(queue):
+    global started_queue
+    started_queue = queue
+
+
+def put_started(taskid, wall_start):
+    if started_queue is not None:
+        started_queue.put((taskid, dict(time=wall_start, host=hostname, pid=os.getpid())))
+
+
+def input_size_gb(node):
+    size = 0
+    for path in findpaths(node.inputs.get()):
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+    return size / 2 ** 30
+
+
+def run_node_profiled(node, updatehash, taskid):
+    wall_start = time.time()
+    if sampler is None:
+        put_started(taskid, wall_start)
+        result = run_node(node, updatehash, taskid)
+        result["runtime"] = runtime_record(wall_start)
+        return result
+
+    interface, name = profile_key(node)
+    record = dict(
+        interface=interface,
+        name=name,
+        input_gb=input_size_gb(node),
+        estimate_gb=getattr(node, "estimate_gb", node.mem_gb),
+        mem_gb=node.mem_gb,
+        n_procs=node.n_procs,
+    )
+
+    sampler.reset()
+    cpu_start, wall_start = sampler.cpu_time(), time.time()
+    put_started(taskid, wall_start)
+
+    result = run_node(node, updatehash, taskid)
+
+    sampler.sample()
+    record.update(
+        peak_gb=sampler.peak_rss / 2 ** 30,
+        cpu_s=sampler.cpu_time() - cpu_start,
+        wall_s=time.time() - wall_start,
+    )
+    result["profile"] = record
+    result["runtime"] = runtime_record(wall_start)
+
+    return result
+
+
+def runtime_record(wall_start):
+    """
+    where and when a node was run, for the execution events
+    """
+    wall_end = time.time()
+    return dict(time=wall_end, duration_s=wall_end - wall_start, host=hostname, pid=os.getpid())
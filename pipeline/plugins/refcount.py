@@ -2,63 +2,163 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
-from pathlib import Path
+from functools import lru_cache
+import os
+from os import path as op
 
 from ..utils import findpaths
 
 
-def iterpath(path):
-    for parent in reversed(path.parents):
-        if len(parent.name) > 0:
-            yield parent.name
-    yield path.name
+def splitpath(path):
+    return [elem for elem in path.split(os.sep) if len(elem) > 0]
+
+
+@lru_cache(maxsize=4096)
+def _realdir(path):
+    return op.realpath(path)
+
+
+def realpath(path):
+    """
+    resolve a path, caching the resolved parent directories, as most of the paths
+    in results are in the same few node directories
+    """
+    head, tail = op.split(op.abspath(path))
+    path = op.join(_realdir(head), tail)
+    if op.islink(path):
+        return op.realpath(path)
+    return path
+
+
+def iterfiles(path):
+    """
+    recursively list the files in a directory. the directory needs to be resolved
+    already, so that only symbolic links need to be resolved on the way
+    """
+    stack = [path]
+    while len(stack) > 0:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        entrypath = op.realpath(entry.path)
+                        if op.isdir(entrypath):
+                            stack.append(entrypath)
+                        else:
+                            yield entrypath
+                    elif entry.is_dir():
+                        stack.append(entry.path)
+                    else:
+                        yield entry.path
+        except NotADirectoryError:
+            yield path
+
+
+class PathNode:
+    """
+    node of the path trie. count is the number of referenced files below the node
+    """
+
+    __slots__ = ("name", "parent", "children", "count", "jobids")
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = dict()
+        self.count = 0
+        self.jobids = None  # set of the jobs that reference the file, if a file
 
 
 class ReferenceCounter:
+    """
+    track which files are referenced by the results of jobs whose dependents have not
+    all finished, so that node directories can be deleted safely
+
+    every file is a leaf of a path trie, and every trie node counts the referenced
+    files below it. the jobids index maps a job to the leaves it references, so that
+    popping a job only touches those leaves and their parents
+    """
+
     def __init__(self):
-        self.files = {}
-        self.sets = []
+        self.root = PathNode()
+        self.jobids = dict()  # reverse index of jobid to leaves
 
     def addpath(self, path, jobid):
-        curfiles = self.files
-        for elem in iterpath(path.resolve()):
-            if elem not in curfiles:
-                curfiles[elem] = {}
-            curfiles = curfiles[elem]
-        if 0 not in curfiles or not isinstance(curfiles[0], set):
-            curfiles[0] = set()
-            self.sets.append(curfiles[0])
-        curfiles[0].add(jobid)
-
-    def put(self, result, jobid=0):
-        paths = findpaths(result)
-        while len(paths) > 0:
-            path = Path(paths.pop())
-            if path.is_dir():
-                paths.extend(path.iterdir())
+        """
+        :return: True if the file was not referenced before
+        """
+        node = self.root
+        for elem in splitpath(path):
+            child = node.children.get(elem)
+            if child is None:
+                child = PathNode(elem, node)
+                node.children[elem] = child
+            node = child
+
+        isnew = node.jobids is None
+        if isnew:
+            node.jobids = set()
+        if jobid in node.jobids:
+            return isnew
+        if len(node.jobids) == 0:
+            parent = node
+            while parent is not None:  # file becomes referenced
+                parent.count += 1
+                parent = parent.parent
+        node.jobids.add(jobid)
+
+        if jobid not in self.jobids:
+            self.jobids[jobid] = list()
+        self.jobids[jobid].append(node)
+        return isnew
+
+    def put(self, result, jobid=0, outdir=None):
+        """
+        :param outdir: only count the size of the files in this directory
+        :return: size in bytes of the files that were not referenced before, which
+            approximates the size of the outputs that were produced by the job
+        """
+        prefix = None
+        if outdir is not None:
+            prefix = op.join(op.realpath(outdir), "")
+
+        size = 0
+        for path in findpaths(result):
+            path = realpath(path)
+            if op.isdir(path):
+                filepaths = iterfiles(path)
             else:
-                self.addpath(path, jobid)
+                filepaths = [path]
+            for filepath in filepaths:
+                if self.addpath(filepath, jobid):
+                    if prefix is not None and not filepath.startswith(prefix):
+                        continue  # input files and outputs of other jobs
+                    try:
+                        size += op.getsize(filepath)
+                    except OSError:
+                        pass
+        return size
 
     def pop(self, jobid):
-        for s in self.sets:
-            if jobid in s:
-                s.remove(jobid)
+        for node in self.jobids.pop(jobid, list()):
+            node.jobids.discard(jobid)
+            if len(node.jobids) > 0:
+                continue
+
+            parent = node
+            while parent is not None:  # file is no longer referenced
+                parent.count -= 1
+                parent = parent.parent
+
+            while node.parent is not None and node.count == 0 and len(node.children) == 0:
+                del node.parent.children[node.name]  # prune
+                node = node.parent
 
     def can_delete(self, path):
-        if not isinstance(path, Path):
-            path = Path(path)
-        curfiles = self.files
-        for elem in iterpath(path):
-            if elem not in curfiles:
+        node = self.root
+        for elem in splitpath(op.normpath(path)):
+            node = node.children.get(elem)
+            if node is None:
                 return True
-            curfiles = curfiles[elem]
-        filesstack = [curfiles]
-        while len(filesstack) > 0:
-            files = filesstack.pop()
-            for k, v in files.items():
-                if k == 0:
-                    if len(v) > 0:
-                        return False
-                else:
-                    filesstack.append(v)
-        return True
+        return node.count == 0
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+job prioritization for the MultiProc plugin
+
+"""
+
+import networkx as nx
+from nipype.interfaces import utility as niu
+
+from ..interface import (
+    MakeResultdicts,
+    FilterResultdicts,
+    AggregateResultdicts,
+    ExtractFromResultdict,
+    FilterList,
+    SelectColumnsTSV,
+)
+from ..io.profile import profile_key
+
+cheap_interfaces = (
+    niu.IdentityInterface,
+    niu.Merge,
+    niu.Select,
+    MakeResultdicts,
+    FilterResultdicts,
+    AggregateResultdicts,
+    ExtractFromResultdict,
+    FilterList,
+    SelectColumnsTSV,
+)  # pure python interfaces that are faster to run than to send to a worker
+
+cheap_runtime = 0.1
+default_runtime = 10.0
+runtime_model = {  # rough runtime estimates in seconds by interface class name
+    "ReconAll": 36000.0,
+    "Registration": 1800.0,
+    "RobustMNINormalizationRPT": 1800.0,
+    "ICA_AROMA": 600.0,
+    "MELODIC": 600.0,
+    "SafeFLAMEO": 600.0,
+    "BBRegisterRPT": 300.0,
+    "FLIRTRPT": 60.0,
+    "MCFLIRT": 120.0,
+    "FixInputApplyTransforms": 120.0,
+    "MultiApplyTransforms": 120.0,
+    "ApplyTransforms": 120.0,
+    "ImageGLM": 120.0,
+    "ResampleIfNeeded": 60.0,
+    "ConnectivityMeasure": 30.0,
+    "MatrixGLM": 30.0,
+    "SafeMerge": 30.0,
+    "SafeMaskMerge": 30.0,
+    "PlotEpi": 20.0,
+    "PlotRegistration": 20.0,
+}
+
+
+def estimate_runtime(node, runtimes=None):
+    """
+    :param runtimes: dict mapping profile_key to the recorded runtime in seconds, as
+        returned by ProfileStore.runtimes. the runtime model is used for nodes that have
+        no recorded runtime
+    """
+    if runtimes is not None:
+        runtime = runtimes.get(profile_key(node))
+        if runtime is not None:
+            return runtime
+    interface = node.interface
+    if isinstance(interface, cheap_interfaces):
+        return cheap_runtime
+    return runtime_model.get(type(interface).__name__, default_runtime)
+
+
+def critical_path_lengths(graph, runtimes=None):
+    """
+    estimated runtime of the longest chain of nodes that starts at each node,
+    including the node itself
+
+    :param graph: execgraph
+    :param runtimes: recorded runtimes, see estimate_runtime
+    :return: dict mapping each node to its critical path length
+    """
+    lengths = {}
+    for node in reversed(list(nx.topological_sort(graph))):
+        downstream = max((lengths[s] for s in graph.successors(node)), default=0.0)
+        lengths[node] = estimate_runtime(node, runtimes) + downstream
+    return lengths
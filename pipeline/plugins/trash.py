@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+delete node directories in the background
+
+"""
+
+import os
+from os import path as op
+import logging
+import queue
+import shutil
+import threading
+import time
+from multiprocessing.util import Finalize
+from uuid import uuid4
+
+logger = logging.getLogger("pipeline")
+
+
+def disk_usage(path):
+    size = 0
+    stack = [path]
+    while len(stack) > 0:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return size
+
+
+class Trash:
+    """
+    directories are moved into a trash directory with an atomic rename, so that the
+    scheduler does not wait for them to be deleted. a thread deletes the contents
+    of the trash directory, and anything that is left over from a previous run
+
+    :param workdir: the trash directory is created here, on the same file system as
+        the node directories
+    :param maxsize: number of directories that can be waiting to be deleted before
+        put blocks
+    """
+
+    def __init__(self, workdir, maxsize=256):
+        self.trashdir = op.join(workdir, ".trash")
+        os.makedirs(self.trashdir, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+        self.pending_bytes = 0
+        self.removed_count = 0
+        self.removed_bytes = 0
+        self.removed_seconds = 0.0
+
+        self.thread = threading.Thread(target=self.run, daemon=True, name="trash")
+        self.thread.start()
+
+        for name in os.listdir(self.trashdir):  # left over from a run that was killed
+            self.queue.put(op.join(self.trashdir, name))
+
+        Finalize(self, self.drain, exitpriority=10)
+
+    def put(self, path):
+        trashpath = op.join(self.trashdir, f"{uuid4().hex[:8]}.{op.basename(path)}")
+        try:
+            os.rename(path, trashpath)
+        except FileNotFoundError:
+            return
+        except OSError:  # different file system
+            trashpath = path
+        self.queue.put(trashpath)
+
+    def run(self):
+        while True:
+            paths = [self.queue.get()]
+            while True:
+                try:
+                    paths.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            sizes = [disk_usage(path) for path in paths]
+            with self.lock:
+                self.pending_bytes += sum(sizes)
+
+            for path, size in zip(paths, sizes):
+                start = time.time()
+                shutil.rmtree(path, ignore_errors=True)
+                with self.lock:
+                    self.pending_bytes -= size
+                    self.removed_count += 1
+                    self.removed_bytes += size
+                    self.removed_seconds += time.time() - start
+                self.queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                pending_count=self.queue.unfinished_tasks,
+                pending_gb=self.pending_bytes / 2 ** 30,
+                removed_count=self.removed_count,
+                removed_gb=self.removed_bytes / 2 ** 30,
+                throughput_gb_s=self.removed_bytes / 2 ** 30 / max(self.removed_seconds, 1e-3),
+            )
+
+    def drain(self):
+        """
+        wait until all directories in the trash are deleted
+        """
+        if self.queue.unfinished_tasks > 0:
+            logger.info(
+                "Waiting for %d directories to be deleted", self.queue.unfinished_tasks,
+            )
+        self.queue.join()
@@ -44,6 +44,18 @@ def _main():
     basegroup.add_argument("--debug", action="store_true", default=False)
     basegroup.add_argument("--verbose", action="store_true", default=False)
     basegroup.add_argument("--watchdog", action="store_true", default=False)
+    basegroup.add_argument(
+        "--profile-summary",
+        action="store_true",
+        default=False,
+        help="print statistics of the recorded resource usage of nodes and exit",
+    )
+    basegroup.add_argument(
+        "--cache-codec",
+        choices=["zstd", "lz4", "pickle", "xz"],
+        help="file format for cached workflows and execgraphs, "
+        "by default the fastest one that is installed",
+    )
 
     stepgroup = ap.add_argument_group("steps", "")
     steps = ["spec-ui", "workflow", "execgraph", "run", "run-subjectlevel", "run-grouplevel"]
@@ -65,6 +77,30 @@ def _main():
     )
     workflowgroup.add_argument("--no-compose-transforms", action="store_true", default=False)
     workflowgroup.add_argument("--freesurfer", action="store_true", default=False)
+    workflowgroup.add_argument(
+        "--connectivity-output-format",
+        choices=["txt", "npy"],
+        default="txt",
+        help="file format for connectivity matrices and time series",
+    )
+    workflowgroup.add_argument(
+        "--connectivity-output-float32",
+        action="store_true",
+        default=False,
+        help="store binary connectivity matrices and time series as float32",
+    )
+    workflowgroup.add_argument(
+        "--higherlevel-engine",
+        choices=["flameo", "native"],
+        default="flameo",
+        help="fit fixed effects and intercept-only models with FSL FLAMEO or in-process",
+    )
+    workflowgroup.add_argument(
+        "--workflow-n-procs",
+        type=int,
+        default=1,
+        help="number of processes to build the workflow templates in",
+    )
 
     execgraphgroup = ap.add_argument_group("execgraph", "")
     execgraphgroup.add_argument("--workflow-file", type=str, help="manually select workflow file")
@@ -78,6 +114,13 @@ def _main():
         default=False,
         help="generate one subject-level workflow per subject",
     )
+    execgraphgroup.add_argument(
+        "--chunk-strategy",
+        choices=["equal", "balanced"],
+        default="equal",
+        help="split subjects into chunks of equal size, "
+        "or of equal estimated runtime based on the recorded resource usage",
+    )
 
     rungroup = ap.add_argument_group("run", "")
     rungroup.add_argument("--execgraph-file", type=str, help="manually select execgraph file")
@@ -91,6 +134,38 @@ def _main():
         default="some",
         help="choose which intermediate files to keep",
     )
+    rungroup.add_argument(
+        "--scheduler",
+        choices=["tsort", "mem_thread", "critical-path"],
+        default="tsort",
+        help="order in which ready jobs are submitted by the MultiProc plugin",
+    )
+    rungroup.add_argument(
+        "--no-profile",
+        action="store_true",
+        default=False,
+        help="do not record the resource usage of nodes",
+    )
+    rungroup.add_argument(
+        "--inline-cheap-nodes",
+        action="store_true",
+        default=False,
+        help="run cheap pure python nodes in the scheduler instead of a worker process",
+    )
+    rungroup.add_argument(
+        "--max-workdir-gb",
+        type=float,
+        help="start new subjects only while the predicted size of the workdir fits, "
+        "which requires that intermediate files are deleted with --keep some or none",
+    )
+    rungroup.add_argument(
+        "--exec-trace",
+        choices=["jsonl", "chrome"],
+        nargs="*",
+        default=[],
+        help="also write node execution events to exec.jsonl or to a chrome/perfetto "
+        "timeline in exec.trace.json",
+    )
 
     ap.add_argument(
         "-v",
@@ -106,6 +181,9 @@ def _main():
     config.execution.debug = debug
     verbose = args.verbose
 
+    if args.cache_codec is not None:  # also applies to the worker processes
+        os.environ["PIPELINE_CACHE_CODEC"] = args.cache_codec
+
     if args.version is True:
         sys.stdout.write(f"{__version__}\n")
         sys.exit(0)
@@ -142,6 +220,14 @@ def _main():
             abspath = op.normpath(args.fs_root + abspath)
         workdir = abspath
 
+    if args.profile_summary is True:
+        assert workdir is not None, "Missing working directory"
+        from .io import ProfileStore
+
+        sys.stdout.write(ProfileStore(workdir).summary_table())
+        sys.stdout.write("\n")
+        sys.exit(0)
+
     if should_run["spec-ui"]:
         from .ui import init_spec_ui
         from calamities.config import config as calamities_config
@@ -192,6 +278,10 @@ def _main():
             no_compose_transforms=args.no_compose_transforms,
             freesurfer=args.freesurfer,
             skull_strip_algorithm=args.skull_strip_algorithm,
+            connectivity_output_format=args.connectivity_output_format,
+            connectivity_output_float32=args.connectivity_output_float32,
+            higherlevel_engine=args.higherlevel_engine,
+            n_procs=args.workflow_n_procs,
         )
 
     execgraphs = None
@@ -203,18 +293,22 @@ def _main():
         from .execgraph import init_execgraph
 
         if workflow is None:
-            from .utils import loadpicklelzma
+            from .utils import loadpickle
 
             assert (
                 args.workflow_file is not None
             ), "Missing required --workflow-file input for step execgraph"
-            workflow = loadpicklelzma(args.workflow_file)
+            workflow = loadpickle(args.workflow_file)
             logger.info(f'Using workflow defined in file "{args.workflow_file}"')
         else:
             logger.info(f"Using workflow from previous step")
 
         execgraphs = init_execgraph(
-            workdir, workflow, n_chunks=args.n_chunks, subject_chunks=args.subject_chunks
+            workdir,
+            workflow,
+            n_chunks=args.n_chunks,
+            subject_chunks=args.subject_chunks,
+            chunk_strategy=args.chunk_strategy,
         )
 
     if (
@@ -226,13 +320,17 @@ def _main():
     else:
         logger.info(f"Running step: run")
         if execgraphs is None:
-            from .utils import loadpicklelzma
+            from .utils import loadpickle
 
             assert (
                 args.execgraph_file is not None
             ), "Missing required --execgraph-file input for step run"
-            execgraphs = loadpicklelzma(args.execgraph_file)
-            if not isinstance(execgraphs, list):
+            from .execgraph import ExecgraphChunks
+
+            execgraphs = loadpickle(args.execgraph_file)
+            if isinstance(execgraphs, ExecgraphChunks):  # chunks are stored next to it
+                execgraphs.workdir = op.dirname(op.abspath(args.execgraph_file))
+            elif not isinstance(execgraphs, list):
                 execgraphs = [execgraphs]
             logger.info(f'Using execgraphs defined in file "{args.execgraph_file}"')
         else:
@@ -249,11 +347,19 @@ def _main():
             "stop_on_first_crash": debug,
             "raise_insufficient": False,
             "keep": args.keep,
+            "inline": args.inline_cheap_nodes,
+            "scheduler": args.scheduler,
+            "profile": not args.no_profile,
+            "events": ["reportexec", *args.exec_trace],
         }
         if args.nipype_n_procs is not None:
             plugin_args["n_procs"] = args.nipype_n_procs
         if args.nipype_memory_gb is not None:
             plugin_args["memory_gb"] = args.nipype_memory_gb
+        if args.max_workdir_gb is not None:
+            if args.keep == "all":  # usage would never decrease
+                raise ValueError("Cannot use max_workdir_gb when all intermediate files are kept")
+            plugin_args["max_workdir_gb"] = args.max_workdir_gb
 
         runnername = f"{args.nipype_run_plugin}Plugin"
         if hasattr(ppp, runnername):
@@ -262,11 +368,12 @@ def _main():
         elif hasattr(nip, runnername):
             logger.warning(f'Using unsupported nipype_run_plugin "{runnername}"')
             runnercls = getattr(nip, runnername)
+            Logger.add_jsreport_handler(workdir)  # does not emit execution events
         else:
             raise ValueError(f'Unknown nipype_run_plugin "{runnername}"')
         runner = runnercls(plugin_args=plugin_args)
 
-        execgraphstorun = []
+        execgraphindicestorun = []  # chunks are loaded one at a time below
         if len(execgraphs) > 1:
             n_subjectlevel_chunks = len(execgraphs) - 1
             if not should_run["run-subjectlevel"]:
@@ -277,30 +384,53 @@ def _main():
                 logger.info(
                     f"Will run subjectlevel chunk {args.chunk_index} of {n_subjectlevel_chunks}"
                 )
-                execgraphstorun.append(execgraphs[zerobasedchunkindex])
+                execgraphindicestorun.append(zerobasedchunkindex)
             else:
                 logger.info(f"Will run all {n_subjectlevel_chunks} subjectlevel chunks")
-                execgraphstorun.extend(execgraphs[:-1])
+                execgraphindicestorun.extend(range(n_subjectlevel_chunks))
 
             if not should_run["run-grouplevel"]:
                 logger.info(f"Will not run grouplevel chunk")
             else:
                 logger.info(f"Will run grouplevel chunk")
-                execgraphstorun.append(execgraphs[-1])
+                execgraphindicestorun.append(n_subjectlevel_chunks)
         elif len(execgraphs) == 1:
-            execgraphstorun.append(execgraphs[0])
+            execgraphindicestorun.append(0)
         else:
             raise ValueError("No execgraphs")
 
-        n_execgraphstorun = len(execgraphstorun)
-        for i, execgraph in enumerate(execgraphstorun):
-            from .utils import first
-
-            if len(execgraphs) > 1:
-                logger.info(f"Running chunk {i+1} of {n_execgraphstorun}")
-            runner.run(execgraph, updatehash=False, config=first(execgraph.nodes()).config)
-            if len(execgraphs) > 1:
-                logger.info(f"Completed chunk {i+1} of {n_execgraphstorun}")
+        from .io import ProfileStore, apply_predictions
+
+        predictions = ProfileStore(workdir).predict()
+
+        n_execgraphstorun = len(execgraphindicestorun)
+        try:
+            for i, execgraphindex in enumerate(execgraphindicestorun):
+                from .utils import first
+
+                execgraph = execgraphs[execgraphindex]
+                n_nodes = apply_predictions(execgraph.nodes(), predictions)
+                logger.info(f"Using recorded resource usage for {n_nodes} nodes")
+                if len(execgraphs) > 1:
+                    logger.info(f"Running chunk {i+1} of {n_execgraphstorun}")
+                runner.run(execgraph, updatehash=False, config=first(execgraph.nodes()).config)
+                if len(execgraphs) > 1:
+                    logger.info(f"Completed chunk {i+1} of {n_execgraphstorun}")
+                    if (
+                        hasattr(execgraphs, "put_results")
+                        and execgraphindex < len(execgraphs) - 1
+                    ):
+                        execgraphs.put_results(execgraphindex)
+                del execgraph
+        finally:
+            from .io import get_resulthooks
+
+            try:
+                for resulthook in get_resulthooks(workdir):  # also after failed nodes
+                    resulthook.compact()
+            finally:
+                if hasattr(runner, "shutdown"):
+                    runner.shutdown()
 
 
 def main():
@@ -574,11 +574,7 @@ class GroupLevelAnalysisAggregateStep(Step):
         firstlevel_analysis_objs = []
         for obj in ctx.spec.analyses:
             if obj.name in input:
-                if (
-                    obj.level == "first"
-                    and obj.type != "atlas_based_connectivity"
-                    and obj.type != "image_output"
-                ):
+                if obj.level == "first" and obj.type != "image_output":
                     firstlevel_analysis_objs.append(obj)
 
         entities_by_analysis = {
@@ -697,11 +693,7 @@ class GroupLevelAnalysisInputStep(Step):
         namesset = set()
         for analysis in ctx.spec.analyses:
             assert analysis.level is not None
-            if (
-                analysis.level == "first"
-                and analysis.type != "atlas_based_connectivity"
-                and analysis.type != "image_output"
-            ):
+            if analysis.level == "first" and analysis.type != "image_output":
                 namesset.add(analysis.name)
         names = list(namesset)
         self.input_view = MultipleChoiceInputView(names, checked=names)
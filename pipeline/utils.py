@@ -2,9 +2,13 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+import os
+import io
 import logging
 import lzma
 import pickle
+import struct
+import importlib.util
 from pathlib import Path
 
 from nipype.interfaces.base.support import InterfaceResult
@@ -161,36 +165,224 @@ def savepicklelzma(filepath, obj):
         pass
 
 
+class PickleCodec:
+    """
+    uncompressed pickle protocol 5, with large buffers such as numpy arrays stored
+    out-of-band so that they are not copied on save and load
+    """
+
+    name = "pickle"
+    suffix = ".pickle"
+    magic = b"PKL5"
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def save(self, filepath, obj):
+        buffers = []
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        else:  # python 3.7
+            data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        views = [memoryview(data), *(buffer.raw() for buffer in buffers)]
+        with open(filepath, "wb") as fptr:
+            fptr.write(self.magic)
+            fptr.write(
+                struct.pack(f"<{len(views) + 1}Q", len(buffers), *(v.nbytes for v in views))
+            )
+            for view in views:
+                fptr.write(view)
+
+    def load(self, filepath):
+        with open(filepath, "rb") as fptr:
+            magic = fptr.read(len(self.magic))
+            assert magic == self.magic, f'Invalid pickle file "{filepath}"'
+            (nbuffers,) = struct.unpack("<Q", fptr.read(8))
+            sizes = struct.unpack(f"<{nbuffers + 1}Q", fptr.read(8 * (nbuffers + 1)))
+            data = fptr.read(sizes[0])
+            buffers = []
+            for size in sizes[1:]:
+                buffer = bytearray(size)  # writable, so that arrays can be modified in place
+                assert fptr.readinto(buffer) == size, f'Truncated pickle file "{filepath}"'
+                buffers.append(buffer)
+        if len(buffers) == 0:
+            return pickle.loads(data)
+        return pickle.loads(data, buffers=buffers)
+
+
+class LzmaPickleCodec(PickleCodec):
+    name = "xz"
+    suffix = ".pickle.xz"
+
+    def save(self, filepath, obj):
+        savepicklelzma(filepath, obj)
+
+    def load(self, filepath):
+        return loadpicklelzma(filepath)
+
+
+class ZstdPickleCodec(PickleCodec):
+    name = "zstd"
+    suffix = ".pickle.zst"
+
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec("zstandard") is not None
+
+    def save(self, filepath, obj):
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+        with open(filepath, "wb") as fptr:
+            with compressor.stream_writer(fptr) as writer:
+                pickle.dump(obj, writer, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, filepath):
+        import zstandard
+
+        with open(filepath, "rb") as fptr:
+            with zstandard.ZstdDecompressor().stream_reader(fptr) as reader:
+                return pickle.load(io.BufferedReader(reader, buffer_size=2 ** 20))
+
+
+class Lz4PickleCodec(PickleCodec):
+    name = "lz4"
+    suffix = ".pickle.lz4"
+
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec("lz4") is not None
+
+    def save(self, filepath, obj):
+        import lz4.frame
+
+        with lz4.frame.open(filepath, "wb") as fptr:
+            pickle.dump(obj, fptr, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, filepath):
+        import lz4.frame
+
+        with lz4.frame.open(filepath, "rb") as fptr:
+            return pickle.load(fptr)
+
+
+picklecodecs = [ZstdPickleCodec, Lz4PickleCodec, PickleCodec, LzmaPickleCodec]  # by preference
+
+
+def get_picklecodec(name=None):
+    """
+    :param name: codec name, or None to use the environment variable PIPELINE_CACHE_CODEC
+        or else the first available codec
+    """
+    if name is None:
+        name = os.environ.get("PIPELINE_CACHE_CODEC")
+    for codec in picklecodecs:
+        if name is not None and codec.name != name:
+            continue
+        if codec.is_available():
+            return codec()
+    raise ValueError(f'Cache codec "{name}" is not available')
+
+
+def picklecodec_for_path(filepath):
+    filepath = str(filepath)
+    for codec in sorted(picklecodecs, key=lambda codec: -len(codec.suffix)):
+        if filepath.endswith(codec.suffix):
+            return codec()
+    raise ValueError(f'Unknown pickle file type for "{filepath}"')
+
+
+def loadpickle(filepath):
+    """
+    load a pickle file that was saved with any of the codecs, based on its suffix
+    """
+    return picklecodec_for_path(filepath).load(filepath)
+
+
+def savepickle(stem, obj, codec=None):
+    """
+    save to a temporary file first, so that concurrent readers never see a partial file
+
+    :param stem: file path without suffix
+    :return: the path that was written
+    """
+    if codec is None:
+        codec = get_picklecodec()
+    path = Path(f"{stem}{codec.suffix}")
+    tmppath = path.parent / f".{path.name}.{os.getpid()}.tmp"
+    codec.save(tmppath, obj)
+    os.replace(tmppath, path)
+    return path
+
+
+def findpickle(stem):
+    """
+    :param stem: file path without suffix
+    :return: the most recently written file for the stem with any of the codec suffixes,
+        or None if there is none
+    """
+    paths = [Path(f"{stem}{codec.suffix}") for codec in picklecodecs]
+    paths = [path for path in paths if path.is_file()]
+    if len(paths) == 0:
+        return
+    return max(paths, key=lambda path: path.stat().st_mtime_ns)
+
+
+def _cachestem(workdir, typestr, uuid):
+    if uuid is not None:
+        uuidstr = str(uuid)[:8]
+        return Path(workdir) / f"{typestr}.{uuidstr}"
+    return Path(workdir) / typestr
+
+
 def uncacheobj(workdir, typestr, uuid, typedisplaystr=None):
     if typedisplaystr is None:
         typedisplaystr = typestr
+    path = findpickle(_cachestem(workdir, typestr, uuid))
+    if path is None:
+        return
+    obj = loadpickle(path)
     if uuid is not None:
-        uuidstr = str(uuid)[:8]
-        path = Path(workdir) / f"{typestr}.{uuidstr}.pickle.xz"
-        if path.exists():
-            obj = loadpicklelzma(path)
-            if hasattr(obj, "uuid"):
-                objuuid = getattr(obj, "uuid")
-                if objuuid is None or objuuid != uuid:
-                    return
-            logging.getLogger("pipeline").info(f"Using cached {typedisplaystr} from {path}")
-            return obj
-    else:
-        path = Path(workdir) / f"{typestr}.pickle.xz"
-        return loadpicklelzma(path)
+        if hasattr(obj, "uuid"):
+            objuuid = getattr(obj, "uuid")
+            if objuuid is None or objuuid != uuid:
+                return
+        logging.getLogger("pipeline").info(f"Using cached {typedisplaystr} from {path}")
+    return obj
 
 
 def cacheobj(workdir, typestr, obj, uuid=None):
     if uuid is None:
         uuid = getattr(obj, "uuid", None)
-    if uuid is not None:
-        uuidstr = str(uuid)[:8]
-        path = Path(workdir) / f"{typestr}.{uuidstr}.pickle.xz"
-    else:
-        path = Path(workdir) / f"{typestr}.pickle.xz"
-    if path.exists():
-        logging.getLogger("pipeline").warn(f"Overwrite {path}")
-    savepicklelzma(path, obj)
+    stem = _cachestem(workdir, typestr, uuid)
+    oldpath = findpickle(stem)
+    if oldpath is not None:
+        logging.getLogger("pipeline").warn(f"Overwrite {oldpath}")
+    path = savepickle(stem, obj)
+    for codec in picklecodecs:  # remove copies that were written with other codecs
+        otherpath = Path(f"{stem}{codec.suffix}")
+        if otherpath != path and otherpath.is_file():
+            otherpath.unlink()
+    return path
+
+
+def prunecache(workdir, typestr, uuids):
+    """
+    remove the cached objects of a type that are not for one of the uuids
+
+    :return: number of files that were removed
+    """
+    keep = set()
+    for uuid in uuids:
+        stem = _cachestem(workdir, typestr, uuid)
+        keep.update(f"{stem.name}{codec.suffix}" for codec in picklecodecs)
+    n_removed = 0
+    for path in Path(workdir).glob(f"{typestr}.*"):
+        if path.name not in keep and path.is_file():
+            path.unlink()
+            n_removed += 1
+    return n_removed
 
 
 def readtsv(in_file):
@@ -219,6 +411,22 @@ def readtsv(in_file):
         raise
 
 
+def loadmatrix(in_file, mmap_mode=None):
+    """
+    load a matrix from a numpy text, .npy or .npz file
+    """
+    import numpy as np
+    from pipeline.utils import readtsv, first
+
+    suffix = Path(in_file).suffix
+    if suffix == ".npy":
+        return np.load(in_file, mmap_mode=mmap_mode)
+    elif suffix == ".npz":
+        with np.load(in_file) as npzfile:
+            return npzfile[first(npzfile.files)]
+    return readtsv(in_file)
+
+
 def ncol(in_file):
     from pipeline.utils import readtsv
 
@@ -5,12 +5,15 @@
 import logging
 from uuid import uuid5
 import pickle
+from collections import namedtuple
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
 
 from calamities.pattern import get_entities_in_path
 from ..database import Database
 from ..spec import loadspec, study_entities, bold_entities
 from ..utils import cacheobj, uncacheobj
-from ..io import get_repetition_time, PreprocessedImgCopyOutResultHook
+from ..io import PreprocessedImgCopyOutResultHook
 from .utils import make_resultdict_datasink
 
 from nipype.pipeline import engine as pe
@@ -23,7 +26,7 @@ from .fmriprepwrapper import (
     get_fmaps,
 )
 from .firstlevel import init_firstlevel_analysis_wf, connect_firstlevel_analysis_extra_args
-from .higherlevel import init_higherlevel_analysis_wf
+from .higherlevel import init_higherlevel_analysis_wf, init_higherlevel_connectivity_wf
 from .filt import (
     init_bold_filt_wf,
     make_variant_bold_filt_wf_name,
@@ -38,7 +41,11 @@ from .report import (
     connect_func_report_wf_attrs_from_func_preproc_wf,
     connect_func_report_wf_attrs_from_filt_wf,
 )
-from .memory import memcalc_from_database
+from .memory import (
+    memcalcs_from_database,
+    load_bold_headers,
+    repetition_time_from_header,
+)
 
 analysisoutattr = "outputnode.resultdicts"
 
@@ -60,21 +67,369 @@ class Cache:
             self._cache[key] = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
         return pickle.loads(self._cache[key])
 
+    def dump(self, shared):
+        """
+        :param shared: objects in the keys that only compare equal to themselves, such
+            as the analyses of the spec. they are replaced by their index, which refers to
+            the same objects in a process that was forked from the same parent
+        :return: picklable list of keys and pickled objects
+        """
+        indices = {id(obj): i for i, obj in enumerate(shared)}
+        entries = []
+        for key, data in self._cache.items():
+            if isinstance(key, tuple):
+                funcrepr, argtuples = key
+                argtuples = tuple(
+                    (name, _SharedRef(indices[id(value)]) if id(value) in indices else value)
+                    for name, value in argtuples
+                )
+                key = (funcrepr, argtuples)
+            entries.append((key, data))
+        return entries
+
+    def load(self, entries, shared):
+        """
+        add objects that were built in another process, see dump
+        """
+        for key, data in entries:
+            if isinstance(key, tuple):
+                funcrepr, argtuples = key
+                argtuples = tuple(
+                    (name, shared[value.index] if isinstance(value, _SharedRef) else value)
+                    for name, value in argtuples
+                )
+                key = (funcrepr, argtuples)
+            self._cache.setdefault(key, data)
+
+
+_SharedRef = namedtuple("_SharedRef", "index")
+
+_subject_kwargs = None  # set before forking the worker processes
+
+
+def _build_templates_in_worker(subjects):
+    cache = Cache()
+    for subject in subjects:
+        init_subject_wf(subject, cache, **_subject_kwargs)
+    return cache.dump(_subject_kwargs["analyses"])  # not the subject workflows
+
+
+def init_subject_wf(
+    subject,
+    cache,
+    workdir,
+    database,
+    analyses,
+    firstlevel_analyses,
+    firstlevel_analysis_tagdicts,
+    subjectlevel_analyses,
+    memcalc,
+    boldfilememcalcs,
+    boldfileheaders,
+    freesurfer,
+    no_compose_transforms,
+    skull_strip_algorithm,
+    connectivity_output_format,
+    connectivity_output_float32,
+    higherlevel_engine,
+):
+    """
+    initialize the workflow for a single subject
+
+    :return: None if the subject has no BOLD files, otherwise the subject workflow and
+        two dicts mapping analysis names to endpoint attrs relative to the subjectlevel workflow
+    """
+
+    logger = logging.getLogger("pipeline")
+
+    subjectmetadata = {"subject": subject}
+
+    subjectfiles = database.get(subject=subject)
+    boldfiles = database.filter(subjectfiles, datatype="func", suffix="bold")
+
+    nboldfiles = len(boldfiles)
+    if nboldfiles == 0:
+        logger.warn(f'Found {nboldfiles} BOLD files for subject "{subject}", skipping')
+        return
+
+    subjectworkflow = pe.Workflow(name=f"subject_{subject}")
+    subjectanalysisendpoints = {analysis.name: [] for analysis in analyses}
+    subjectconnectivityendpoints = {analysis.name: [] for analysis in analyses}
+
+    t1wfiles = database.filter(subjectfiles, datatype="anat", suffix="T1w")
+    nt1wfiles = len(t1wfiles)
+    if nt1wfiles == 0:
+        logger.warn(f'Found {nt1wfiles} T1w files for subject "{subject}", skipping')
+        return subjectworkflow, dict(), dict()
+
+    t1wfile = t1wfiles.pop()
+    if nt1wfiles > 1:
+        logger.warn(f'Found {nt1wfiles} T1w files for subject "{subject}", using "{t1wfile}"')
+    anat_preproc_wf = cache.get(
+        init_anat_preproc_wf,
+        argtuples=[
+            ("workdir", workdir),
+            ("no_compose_transforms", no_compose_transforms),
+            ("freesurfer", freesurfer),
+            ("skull_strip_algorithm", skull_strip_algorithm),
+        ],
+    )
+    anat_preproc_wf.get_node("inputnode").inputs.t1w = t1wfile
+    anat_preproc_wf.get_node("inputnode").inputs.metadata = subjectmetadata
+    subjectworkflow.add_nodes([anat_preproc_wf])
+
+    anat_report_wf = cache.get(
+        init_anat_report_wf, argtuples=[("workdir", workdir), ("memcalc", memcalc)]
+    )
+    anat_report_wf.get_node("inputnode").inputs.metadata = subjectmetadata
+    connect_anat_report_wf_attrs_from_anat_preproc_wf(
+        subjectworkflow, anat_preproc_wf, anat_report_wf,
+    )
+
+    if len(firstlevel_analyses) == 0:
+        return subjectworkflow, dict(), dict()
+
+    for boldfile in boldfiles:
+        # make name
+        boldfilemetadata = subjectmetadata.copy()
+        has_direction = True
+        if database.get_tagval(boldfile, "direction") is not None:
+            tmplstr = database.get_tmplstr(boldfile)
+            entities_in_path = get_entities_in_path(tmplstr)
+            has_direction = "direction" in entities_in_path
+        name = "bold"
+        for entity in study_entities:
+            value = database.get_tagval(boldfile, entity)
+            if value is not None and (entity != "direction" or has_direction):
+                name += "_"
+                name += f"{entity}_{value}"
+                boldfilemetadata[entity] = value
+        # workflow
+        boldfileworkflow = pe.Workflow(name=name)
+        fmap_type, fmaps, fmapmetadata = get_fmaps(boldfile, database)
+        boldfilemetadata.update(fmapmetadata)
+
+        repetition_time = database.get_tagval(boldfile, "repetition_time")
+        if repetition_time is None:
+            repetition_time = repetition_time_from_header(boldfileheaders[boldfile])
+        assert (
+            repetition_time > 0.01
+        ), f'Repetition time value "{repetition_time}" is too low for file "{boldfile}"'
+        boldfilemetadata["RepetitionTime"] = repetition_time
+
+        boldfilememcalc = boldfilememcalcs[boldfile]  # size jobs by this file's shape
+
+        func_preproc_wf = cache.get(
+            init_func_preproc_wf,
+            argtuples=[
+                ("workdir", workdir),
+                ("fmap_type", fmap_type),
+                ("memcalc", boldfilememcalc),
+            ],
+        )
+        boldfileworkflow.add_nodes([func_preproc_wf])
+        func_preproc_inputnode = func_preproc_wf.get_node("inputnode")
+        func_preproc_inputnode.inputs.bold_file = boldfile
+        func_preproc_inputnode.inputs.fmaps = fmaps
+        func_preproc_inputnode.inputs.metadata = boldfilemetadata
+        connect_func_wf_attrs_from_anat_preproc_wf(
+            subjectworkflow,
+            anat_preproc_wf,
+            boldfileworkflow,
+            in_nodename=f"{func_preproc_wf.name}.inputnode",
+        )
+        func_report_wf = None
+        for analysis, tagdict in zip(firstlevel_analyses, firstlevel_analysis_tagdicts):
+            if not database.matches(boldfile, **tagdict):
+                continue
+            # get analysis workflow
+            analysisworkflow, boldfilevariants = cache.get(
+                init_firstlevel_analysis_wf,
+                argtuples=[
+                    ("analysis", analysis),
+                    ("memcalc", boldfilememcalc),
+                    ("connectivity_output_format", connectivity_output_format),
+                    ("connectivity_output_float32", connectivity_output_float32),
+                ],
+            )
+            # workflow input variants
+            bold_filt_wf = None
+            for attrnames, variant in boldfilevariants:
+                name = make_variant_bold_filt_wf_name(variant)
+                variant_bold_filt_wf = boldfileworkflow.get_node(name)
+                if variant_bold_filt_wf is None:
+                    variant_bold_filt_wf = cache.get(
+                        init_bold_filt_wf,
+                        argtuples=[("variant", variant), ("memcalc", boldfilememcalc)],
+                    )
+                    boldfileworkflow.add_nodes([variant_bold_filt_wf])
+                    variant_bold_filt_wf.get_node(
+                        "inputnode"
+                    ).inputs.metadata = boldfilemetadata
+                    connect_filt_wf_attrs_from_anat_preproc_wf(
+                        subjectworkflow,
+                        anat_preproc_wf,
+                        boldfileworkflow,
+                        in_nodename=f"{variant_bold_filt_wf.name}.inputnode",
+                    )
+                    connect_filt_wf_attrs_from_func_preproc_wf(
+                        boldfileworkflow, func_preproc_wf, variant_bold_filt_wf
+                    )
+                if bold_filt_wf is None:  # use first variant bold_filt_wf
+                    bold_filt_wf = variant_bold_filt_wf
+                for i, attrname in enumerate(attrnames):
+                    boldfileworkflow.connect(
+                        variant_bold_filt_wf,
+                        f"outputnode.out{i+1}",
+                        analysisworkflow,
+                        f"inputnode.{attrname}",
+                    )
+            boldfileworkflow.connect(
+                bold_filt_wf, "outputnode.mask_file", analysisworkflow, "inputnode.mask_file",
+            )
+            connect_firstlevel_analysis_extra_args(
+                analysisworkflow, analysis, database, boldfile
+            )
+            # use first variant to create func_report_wf
+            if func_report_wf is None:
+                func_report_wf = cache.get(
+                    init_func_report_wf,
+                    argtuples=[("workdir", workdir), ("memcalc", boldfilememcalc)],
+                )
+                func_report_wf.get_node("inputnode").inputs.metadata = boldfilemetadata
+                connect_func_report_wf_attrs_from_filt_wf(
+                    boldfileworkflow, bold_filt_wf, func_report_wf
+                )
+                connect_func_report_wf_attrs_from_func_preproc_wf(
+                    boldfileworkflow, func_preproc_wf, func_report_wf
+                )
+                connect_func_report_wf_attrs_from_anat_preproc_wf(
+                    subjectworkflow,
+                    anat_preproc_wf,
+                    boldfileworkflow,
+                    in_nodename=f"{func_report_wf.name}.inputnode",
+                )
+            boldfileworkflow.connect(
+                func_report_wf, "outputnode.metadata", analysisworkflow, "inputnode.metadata",
+            )
+            # sink outputs
+            endpoint = (boldfileworkflow, f"{analysisworkflow.name}.{analysisoutattr}")
+            make_resultdict_datasink(
+                boldfileworkflow,
+                workdir,
+                (analysisworkflow, analysisoutattr),
+                name=f"{analysisworkflow.name}_resultdictdatasink",
+            )
+            if analysis.type == "atlas_based_connectivity":
+                subjectconnectivityendpoints[analysis.name].append(endpoint)
+            elif analysis.type == "image_output":
+                pass
+            else:  # FIXME don't fail with zero copes
+                subjectanalysisendpoints[analysis.name].append(endpoint)
+    # subjectlevel aggregate
+    for analysis in subjectlevel_analyses:
+        endpoints = []
+        for inputanalysisname in analysis.input:
+            endpoints.extend(subjectanalysisendpoints[inputanalysisname])
+        if len(endpoints) > 0:
+            collectinputs = pe.Node(
+                niu.Merge(numinputs=len(endpoints)), name=f"collectinputs_{analysis.name}",
+            )
+            for i, endpoint in enumerate(endpoints):
+                subjectworkflow.connect(*endpoint, collectinputs, f"in{i+1}")
+            analysisworkflow = cache.get(
+                init_higherlevel_analysis_wf,
+                argtuples=[
+                    ("analysis", analysis),
+                    ("memcalc", memcalc),
+                    ("engine", higherlevel_engine),
+                ],
+            )
+            subjectworkflow.connect(collectinputs, "out", analysisworkflow, "inputnode.indicts")
+            endpoint = (subjectworkflow, f"{analysisworkflow.name}.{analysisoutattr}")
+            subjectanalysisendpoints[analysis.name].append(endpoint)
+            make_resultdict_datasink(
+                subjectworkflow,
+                workdir,
+                (analysisworkflow, analysisoutattr),
+                name=f"{analysisworkflow.name}_resultdictdatasink",
+            )
+
+        # connectivity matrices are aggregated by their own workflow, and the result
+        # is passed on as correlation matrices to the grouplevel
+        endpoints = []
+        for inputanalysisname in analysis.input:
+            endpoints.extend(subjectconnectivityendpoints[inputanalysisname])
+        if len(endpoints) > 0:
+            collectinputs = pe.Node(
+                niu.Merge(numinputs=len(endpoints)),
+                name=f"collectconnectivityinputs_{analysis.name}",
+            )
+            for i, endpoint in enumerate(endpoints):
+                subjectworkflow.connect(*endpoint, collectinputs, f"in{i+1}")
+            analysisworkflow = cache.get(
+                init_higherlevel_connectivity_wf,
+                argtuples=[
+                    ("analysis", analysis),
+                    ("memcalc", memcalc),
+                    ("output_format", connectivity_output_format),
+                    ("output_float32", connectivity_output_float32),
+                ],
+            )
+            subjectworkflow.connect(collectinputs, "out", analysisworkflow, "inputnode.indicts")
+            endpoint = (subjectworkflow, f"{analysisworkflow.name}.{analysisoutattr}")
+            subjectconnectivityendpoints[analysis.name].append(endpoint)
+            make_resultdict_datasink(
+                subjectworkflow,
+                workdir,
+                (analysisworkflow, analysisoutattr),
+                name=f"{analysisworkflow.name}_resultdictdatasink",
+            )
+    # endpoints relative to the subjectlevel workflow
+    for subjectendpoints in [subjectanalysisendpoints, subjectconnectivityendpoints]:
+        for analysisname, endpoints in subjectendpoints.items():
+            attrs = []
+            for node, attr in endpoints:
+                attr = f"{node.name}.{attr}"
+                if node is not subjectworkflow:
+                    attr = f"{subjectworkflow.name}.{attr}"
+                attrs.append(attr)
+            subjectendpoints[analysisname] = attrs
+
+    return subjectworkflow, subjectanalysisendpoints, subjectconnectivityendpoints
+
 
 def init_workflow(
-    workdir, freesurfer=False, no_compose_transforms=False, skull_strip_algorithm="ants"
+    workdir,
+    freesurfer=False,
+    no_compose_transforms=False,
+    skull_strip_algorithm="ants",
+    connectivity_output_format="txt",
+    connectivity_output_float32=False,
+    higherlevel_engine="flameo",
+    n_procs=1,
 ):
     """
     initialize nipype workflow
 
     :param spec
+    :param n_procs: number of processes to build the workflow templates in
     """
 
     logger = logging.getLogger("pipeline")
 
     spec = loadspec(workdir=workdir)
-    database = Database(files=spec.files)
-    uuid = uuid5(spec.uuid, database.sha1())
+    database = Database(files=spec.files, workdir=workdir)
+    # the options change the workflow, but are not stored in the spec
+    options = (
+        freesurfer,
+        no_compose_transforms,
+        skull_strip_algorithm,
+        connectivity_output_format,
+        connectivity_output_float32,
+        higherlevel_engine,
+    )
+    uuid = uuid5(uuid5(spec.uuid, database.sha1()), repr(options))
 
     workflow = uncacheobj(workdir, "workflow", uuid)
     if workflow is not None:
@@ -95,7 +450,12 @@ def init_workflow(
     )
 
     # helpers
-    memcalc = memcalc_from_database(database)
+    boldfileheaders = load_bold_headers(
+        sorted(database.get(datatype="func", suffix="bold")), workdir=workdir
+    )
+    memcalc, boldfilememcalcs = memcalcs_from_database(
+        database, workdir=workdir, headers=boldfileheaders
+    )
     cache = Cache()
 
     subjectlevelworkflow = pe.Workflow(name=f"subjectlevel")
@@ -119,209 +479,73 @@ def init_workflow(
     ]
 
     analysisendpoints = {analysis.name: [] for analysis in spec.analyses}
+    connectivityendpoints = {analysis.name: [] for analysis in spec.analyses}
+
+    global _subject_kwargs
+    _subject_kwargs = dict(
+        workdir=workdir,
+        database=database,
+        analyses=spec.analyses,
+        firstlevel_analyses=firstlevel_analyses,
+        firstlevel_analysis_tagdicts=firstlevel_analysis_tagdicts,
+        subjectlevel_analyses=subjectlevel_analyses,
+        memcalc=memcalc,
+        boldfilememcalcs=boldfilememcalcs,
+        boldfileheaders=boldfileheaders,
+        freesurfer=freesurfer,
+        no_compose_transforms=no_compose_transforms,
+        skull_strip_algorithm=skull_strip_algorithm,
+        connectivity_output_format=connectivity_output_format,
+        connectivity_output_float32=connectivity_output_float32,
+        higherlevel_engine=higherlevel_engine,
+    )
 
-    subjects = database.get_tagval_set("subject")
-    for subject in subjects:
-        subjectmetadata = {"subject": subject}
-
-        subjectfiles = database.get(subject=subject)
-        boldfiles = database.filter(subjectfiles, datatype="func", suffix="bold")
-
-        nboldfiles = len(boldfiles)
-        if nboldfiles == 0:
-            logger.warn(f'Found {nboldfiles} BOLD files for subject "{subject}", skipping')
-            continue
-
-        subjectworkflow = pe.Workflow(name=f"subject_{subject}")
-        subjectlevelworkflow.add_nodes([subjectworkflow])
-
-        t1wfiles = database.filter(subjectfiles, datatype="anat", suffix="T1w")
-        nt1wfiles = len(t1wfiles)
-        if nt1wfiles == 0:
-            logger.warn(f'Found {nt1wfiles} T1w files for subject "{subject}", skipping')
-            continue
-
-        t1wfile = t1wfiles.pop()
-        if nt1wfiles > 1:
-            logger.warn(f'Found {nt1wfiles} T1w files for subject "{subject}", using "{t1wfile}"')
-        anat_preproc_wf = cache.get(
-            init_anat_preproc_wf,
-            argtuples=[
-                ("workdir", workdir),
-                ("no_compose_transforms", no_compose_transforms),
-                ("freesurfer", freesurfer),
-                ("skull_strip_algorithm", skull_strip_algorithm),
-            ],
-        )
-        anat_preproc_wf.get_node("inputnode").inputs.t1w = t1wfile
-        anat_preproc_wf.get_node("inputnode").inputs.metadata = subjectmetadata
-        subjectworkflow.add_nodes([anat_preproc_wf])
+    subjects = sorted(database.get_tagval_set("subject"))
 
-        anat_report_wf = cache.get(
-            init_anat_report_wf, argtuples=[("workdir", workdir), ("memcalc", memcalc)]
-        )
-        anat_report_wf.get_node("inputnode").inputs.metadata = subjectmetadata
-        connect_anat_report_wf_attrs_from_anat_preproc_wf(
-            subjectworkflow, anat_preproc_wf, anat_report_wf,
+    # most of the time is spent building the templates for each combination of settings
+    # and bold file shape, while a subject workflow is built from them quickly. so the
+    # templates are built in worker processes for one subject per combination of shapes,
+    # but the subject workflows are built here, because unpickling them would take longer
+    # than building them. templates that are still missing are built when they are needed
+    representatives = dict()
+    for subject in subjects:
+        boldfiles = database.get(subject=subject, datatype="func", suffix="bold")
+        shapes = frozenset(boldfilememcalcs[boldfile] for boldfile in boldfiles)
+        representatives.setdefault(shapes, subject)
+    representatives = list(representatives.values())
+    if n_procs > 1 and len(representatives) > 1:
+        n_workers = min(n_procs, len(representatives))
+        logger.info(
+            f"Building workflow templates for {len(representatives)} subjects "
+            f"in {n_workers} processes"
         )
-
-        if len(firstlevel_analyses) == 0:
+        # fork so that the workers inherit the fmriprep config that was set up in the parent
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=get_context("fork")
+        ) as executor:
+            for entries in executor.map(
+                _build_templates_in_worker,
+                [representatives[i::n_workers] for i in range(n_workers)],
+            ):
+                cache.load(entries, spec.analyses)
+
+    results = [init_subject_wf(subject, cache, **_subject_kwargs) for subject in subjects]
+    _subject_kwargs = None
+
+    subjectworkflows = []
+    for result in results:
+        if result is None:
             continue
-
-        subjectanalysisendpoints = {analysis.name: [] for analysis in spec.analyses}
-        for boldfile in boldfiles:
-            # make name
-            boldfilemetadata = subjectmetadata.copy()
-            has_direction = True
-            if database.get_tagval(boldfile, "direction") is not None:
-                tmplstr = database.get_tmplstr(boldfile)
-                entities_in_path = get_entities_in_path(tmplstr)
-                has_direction = "direction" in entities_in_path
-            name = "bold"
-            for entity in study_entities:
-                value = database.get_tagval(boldfile, entity)
-                if value is not None and (entity != "direction" or has_direction):
-                    name += "_"
-                    name += f"{entity}_{value}"
-                    boldfilemetadata[entity] = value
-            # workflow
-            boldfileworkflow = pe.Workflow(name=name)
-            fmap_type, fmaps, fmapmetadata = get_fmaps(boldfile, database)
-            boldfilemetadata.update(fmapmetadata)
-
-            repetition_time = database.get_tagval(boldfile, "repetition_time")
-            if repetition_time is None:
-                repetition_time = get_repetition_time(boldfile)
-            assert (
-                repetition_time > 0.01
-            ), f'Repetition time value "{repetition_time}" is too low for file "{boldfile}"'
-            boldfilemetadata["RepetitionTime"] = repetition_time
-
-            func_preproc_wf = cache.get(
-                init_func_preproc_wf,
-                argtuples=[("workdir", workdir), ("fmap_type", fmap_type), ("memcalc", memcalc)],
-            )
-            boldfileworkflow.add_nodes([func_preproc_wf])
-            func_preproc_inputnode = func_preproc_wf.get_node("inputnode")
-            func_preproc_inputnode.inputs.bold_file = boldfile
-            func_preproc_inputnode.inputs.fmaps = fmaps
-            func_preproc_inputnode.inputs.metadata = boldfilemetadata
-            connect_func_wf_attrs_from_anat_preproc_wf(
-                subjectworkflow,
-                anat_preproc_wf,
-                boldfileworkflow,
-                in_nodename=f"{func_preproc_wf.name}.inputnode",
-            )
-            func_report_wf = None
-            for analysis, tagdict in zip(firstlevel_analyses, firstlevel_analysis_tagdicts):
-                if not database.matches(boldfile, **tagdict):
-                    continue
-                # get analysis workflow
-                analysisworkflow, boldfilevariants = cache.get(
-                    init_firstlevel_analysis_wf,
-                    argtuples=[("analysis", analysis), ("memcalc", memcalc)],
-                )
-                # workflow input variants
-                bold_filt_wf = None
-                for attrnames, variant in boldfilevariants:
-                    name = make_variant_bold_filt_wf_name(variant)
-                    variant_bold_filt_wf = boldfileworkflow.get_node(name)
-                    if variant_bold_filt_wf is None:
-                        variant_bold_filt_wf = cache.get(
-                            init_bold_filt_wf,
-                            argtuples=[("variant", variant), ("memcalc", memcalc)],
-                        )
-                        boldfileworkflow.add_nodes([variant_bold_filt_wf])
-                        variant_bold_filt_wf.get_node(
-                            "inputnode"
-                        ).inputs.metadata = boldfilemetadata
-                        connect_filt_wf_attrs_from_anat_preproc_wf(
-                            subjectworkflow,
-                            anat_preproc_wf,
-                            boldfileworkflow,
-                            in_nodename=f"{variant_bold_filt_wf.name}.inputnode",
-                        )
-                        connect_filt_wf_attrs_from_func_preproc_wf(
-                            boldfileworkflow, func_preproc_wf, variant_bold_filt_wf
-                        )
-                    if bold_filt_wf is None:  # use first variant bold_filt_wf
-                        bold_filt_wf = variant_bold_filt_wf
-                    for i, attrname in enumerate(attrnames):
-                        boldfileworkflow.connect(
-                            variant_bold_filt_wf,
-                            f"outputnode.out{i+1}",
-                            analysisworkflow,
-                            f"inputnode.{attrname}",
-                        )
-                boldfileworkflow.connect(
-                    bold_filt_wf, "outputnode.mask_file", analysisworkflow, "inputnode.mask_file",
-                )
-                connect_firstlevel_analysis_extra_args(
-                    analysisworkflow, analysis, database, boldfile
-                )
-                # use first variant to create func_report_wf
-                if func_report_wf is None:
-                    func_report_wf = cache.get(
-                        init_func_report_wf, argtuples=[("workdir", workdir), ("memcalc", memcalc)]
-                    )
-                    func_report_wf.get_node("inputnode").inputs.metadata = boldfilemetadata
-                    connect_func_report_wf_attrs_from_filt_wf(
-                        boldfileworkflow, bold_filt_wf, func_report_wf
-                    )
-                    connect_func_report_wf_attrs_from_func_preproc_wf(
-                        boldfileworkflow, func_preproc_wf, func_report_wf
-                    )
-                    connect_func_report_wf_attrs_from_anat_preproc_wf(
-                        subjectworkflow,
-                        anat_preproc_wf,
-                        boldfileworkflow,
-                        in_nodename=f"{func_report_wf.name}.inputnode",
-                    )
-                boldfileworkflow.connect(
-                    func_report_wf, "outputnode.metadata", analysisworkflow, "inputnode.metadata",
-                )
-                # sink outputs
-                endpoint = (boldfileworkflow, f"{analysisworkflow.name}.{analysisoutattr}")
-                make_resultdict_datasink(
-                    boldfileworkflow,
-                    workdir,
-                    (analysisworkflow, analysisoutattr),
-                    name=f"{analysisworkflow.name}_resultdictdatasink",
-                )
-                if analysis.type == "atlas_based_connectivity" or analysis.type == "image_output":
-                    pass
-                else:  # FIXME don't fail with zero copes
-                    subjectanalysisendpoints[analysis.name].append(endpoint)
-        # subjectlevel aggregate
-        for analysis in subjectlevel_analyses:
-            endpoints = []
-            for inputanalysisname in analysis.input:
-                endpoints.extend(subjectanalysisendpoints[inputanalysisname])
-            collectinputs = pe.Node(
-                niu.Merge(numinputs=len(endpoints)), name=f"collectinputs_{analysis.name}",
-            )
-            for i, endpoint in enumerate(endpoints):
-                subjectworkflow.connect(*endpoint, collectinputs, f"in{i+1}")
-            analysisworkflow = cache.get(
-                init_higherlevel_analysis_wf,
-                argtuples=[("analysis", analysis), ("memcalc", memcalc)],
-            )
-            subjectworkflow.connect(collectinputs, "out", analysisworkflow, "inputnode.indicts")
-            endpoint = (subjectworkflow, f"{analysisworkflow.name}.{analysisoutattr}")
-            subjectanalysisendpoints[analysis.name].append(endpoint)
-            make_resultdict_datasink(
-                subjectworkflow,
-                workdir,
-                (analysisworkflow, analysisoutattr),
-                name=f"{analysisworkflow.name}_resultdictdatasink",
-            )
-        for analysisname, endpoints in subjectanalysisendpoints.items():
-            for endpoint in endpoints:
-                node, attr = endpoint
-                attr = f"{node.name}.{attr}"
-                if node is not subjectworkflow:
-                    attr = f"{subjectworkflow.name}.{attr}"
-                analysisendpoints[analysisname].append((subjectlevelworkflow, attr))
+        subjectworkflow, subjectanalysisendpoints, subjectconnectivityendpoints = result
+        subjectworkflows.append(subjectworkflow)
+        for subjectendpoints, groupendpoints in [
+            (subjectanalysisendpoints, analysisendpoints),
+            (subjectconnectivityendpoints, connectivityendpoints),
+        ]:
+            for analysisname, attrs in subjectendpoints.items():
+                for attr in attrs:
+                    groupendpoints[analysisname].append((subjectlevelworkflow, attr))
+    subjectlevelworkflow.add_nodes(subjectworkflows)  # add all at once to check names once
 
     grouplevelworkflow = pe.Workflow(name=f"grouplevel")
 
@@ -338,7 +562,12 @@ def init_workflow(
         for i, endpoint in enumerate(endpoints):
             workflow.connect(*endpoint, grouplevelworkflow, f"{collectinputs.name}.in{i+1}")
         analysisworkflow = cache.get(
-            init_higherlevel_analysis_wf, argtuples=[("analysis", analysis), ("memcalc", memcalc)],
+            init_higherlevel_analysis_wf,
+            argtuples=[
+                ("analysis", analysis),
+                ("memcalc", memcalc),
+                ("engine", higherlevel_engine),
+            ],
         )
         grouplevelworkflow.connect(collectinputs, "out", analysisworkflow, "inputnode.indicts")
         endpoint = (grouplevelworkflow, f"{analysisworkflow.name}.{analysisoutattr}")
@@ -350,6 +579,36 @@ def init_workflow(
             name=f"{analysisworkflow.name}_resultdictdatasink",
         )
 
+    for analysis in grouplevel_analyses:
+        endpoints = []
+        for inputanalysisname in analysis.input:
+            endpoints.extend(connectivityendpoints[inputanalysisname])
+        if len(endpoints) == 0:
+            continue
+        collectinputs = pe.Node(
+            niu.Merge(numinputs=len(endpoints)),
+            name=f"collectconnectivityinputs_{analysis.name}",
+        )
+        grouplevelworkflow.add_nodes([collectinputs])
+        for i, endpoint in enumerate(endpoints):
+            workflow.connect(*endpoint, grouplevelworkflow, f"{collectinputs.name}.in{i+1}")
+        analysisworkflow = cache.get(
+            init_higherlevel_connectivity_wf,
+            argtuples=[
+                ("analysis", analysis),
+                ("memcalc", memcalc),
+                ("output_format", connectivity_output_format),
+                ("output_float32", connectivity_output_float32),
+            ],
+        )
+        grouplevelworkflow.connect(collectinputs, "out", analysisworkflow, "inputnode.indicts")
+        make_resultdict_datasink(
+            grouplevelworkflow,
+            workdir,
+            (analysisworkflow, analysisoutattr),
+            name=f"{analysisworkflow.name}_resultdictdatasink",
+        )
+
     cacheobj(workdir, "workflow", workflow)
 
     boldfiledicts = []
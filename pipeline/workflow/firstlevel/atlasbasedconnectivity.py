@@ -10,11 +10,18 @@ from ...interface import ConnectivityMeasure, ResampleIfNeeded, MakeResultdicts
 from ..memory import MemoryCalculator
 from ...spec import Tags, Analysis, BandPassFilteredTag, ConfoundsRemovedTag, GrandMeanScaledTag
 
+chunk_size = 64  # volumes to read at a time
 
-def init_atlasbasedconnectivity_wf(analysis, memcalc=MemoryCalculator()):
+
+def init_atlasbasedconnectivity_wf(
+    analysis, memcalc=MemoryCalculator(), output_format="txt", output_float32=False
+):
     """
     create workflow for brainatlas
 
+    :param output_format: "txt" for numpy text files or "npy" for binary files
+    :param output_float32: store binary files as float32
+
     """
     assert isinstance(analysis, Analysis)
     assert isinstance(analysis.tags, Tags)
@@ -54,10 +61,16 @@ def init_atlasbasedconnectivity_wf(analysis, memcalc=MemoryCalculator()):
     workflow.connect(inputnode, "bold_file", resampleifneeded, "ref_file")
 
     connectivitymeasure = pe.MapNode(
-        interface=ConnectivityMeasure(background_label=0, min_n_voxels=50),
+        interface=ConnectivityMeasure(
+            background_label=0,
+            min_n_voxels=50,
+            chunk_size=chunk_size,
+            output_format=output_format,
+            output_float32=output_float32,
+        ),
         name="connectivitymeasure",
         iterfield=["atlas_file"],
-        mem_gb=memcalc.series_std_gb,
+        mem_gb=memcalc.volume_std_gb * chunk_size * 3,  # raw, masked and converted chunk
     )
     workflow.connect(inputnode, "bold_file", connectivitymeasure, "in_file")
     workflow.connect(inputnode, "mask_file", connectivitymeasure, "mask_file")
@@ -14,7 +14,12 @@ from ..memory import MemoryCalculator
 from ...spec import Analysis
 
 
-def init_firstlevel_analysis_wf(analysis=None, memcalc=MemoryCalculator()):
+def init_firstlevel_analysis_wf(
+    analysis=None,
+    memcalc=MemoryCalculator(),
+    connectivity_output_format="txt",
+    connectivity_output_float32=False,
+):
     assert isinstance(analysis, Analysis)
 
     if analysis.type == "image_output":
@@ -26,7 +31,12 @@ def init_firstlevel_analysis_wf(analysis=None, memcalc=MemoryCalculator()):
     elif analysis.type == "dual_regression":
         return init_dualregression_wf(analysis=analysis, memcalc=memcalc)
     elif analysis.type == "atlas_based_connectivity":
-        return init_atlasbasedconnectivity_wf(analysis=analysis, memcalc=memcalc)
+        return init_atlasbasedconnectivity_wf(
+            analysis=analysis,
+            memcalc=memcalc,
+            output_format=connectivity_output_format,
+            output_float32=connectivity_output_float32,
+        )
     elif analysis.type == "reho":
         return init_reho_wf(analysis=analysis, memcalc=memcalc)
     elif analysis.type == "falff":
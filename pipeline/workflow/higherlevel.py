@@ -15,9 +15,13 @@ from ..interface import (
     FilterList,
     SafeMultipleRegressDesign,
     SafeFLAMEO,
+    ImageGLM,
     FilterResultdicts,
     AggregateResultdicts,
+    MergeMatrices,
+    MatrixGLM,
 )
+from ..interface.glm import batch_gb
 
 from ..utils import ravel, maplen
 from ..spec import Analysis
@@ -25,7 +29,14 @@ from ..spec import Analysis
 from .memory import MemoryCalculator
 
 
-def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator()):
+def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator(), engine="flameo"):
+    """
+    create workflow for higher level analysis of image features
+
+    :param engine: "flameo" to use FSL FLAMEO, or "native" to fit fixed effects and
+        intercept-only models in-process with ImageGLM
+
+    """
     assert isinstance(analysis, Analysis)
 
     workflow = pe.Workflow(name=analysis.name)
@@ -44,14 +55,14 @@ def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator()):
             FilterResultdicts(
                 filterobjs=analysis.filter, requireoneofkeys=["cope", "stat"], **kwargs
             ),
-            name=f"filterresultsdicts",
+            name="filterresultsdicts",
         )
         workflow.connect(*indictsendpoint, filterresultsdicts, "indicts")
         indictsendpoint = (filterresultsdicts, "resultdicts")
 
     aggregateresultdicts = pe.Node(
         AggregateResultdicts(numinputs=1, across=analysis.across),
-        name=f"aggregateresultdicts",
+        name="aggregateresultdicts",
     )
     workflow.connect(*indictsendpoint, aggregateresultdicts, "in1")
 
@@ -67,38 +78,6 @@ def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator()):
         [(aggregateresultdicts, extractfromresultdict, [(("resultdicts", ravel), "indict")])]
     )
 
-    maskmerge = pe.MapNode(
-        interface=SafeMaskMerge(),
-        name="maskmerge",
-        iterfield="in_files",
-        mem_gb=memcalc.volume_std_gb * 100,
-    )
-    workflow.connect(extractfromresultdict, "mask_file", maskmerge, "in_files")
-
-    copemerge = pe.MapNode(
-        interface=SafeMerge(dimension="t"),
-        name="copemerge",
-        iterfield="in_files",
-        mem_gb=memcalc.volume_std_gb * 100,
-    )
-    workflow.connect(extractfromresultdict, "cope", copemerge, "in_files")
-
-    varcopemerge = pe.MapNode(
-        interface=SafeMerge(dimension="t"),
-        name="varcopemerge",
-        iterfield="in_files",
-        mem_gb=memcalc.volume_std_gb * 100,
-    )
-    workflow.connect(extractfromresultdict, "varcope", varcopemerge, "in_files")
-
-    dofmerge = pe.MapNode(
-        interface=SafeMerge(dimension="t"),
-        name="dofmerge",
-        iterfield="in_files",
-        mem_gb=memcalc.volume_std_gb * 100,
-    )
-    workflow.connect(extractfromresultdict, "dof_file", dofmerge, "in_files")
-
     if analysis.type == "fixed_effects" or analysis.type == "intercept_only":
         model = pe.MapNode(
             interface=InterceptOnlyModel(),
@@ -129,48 +108,112 @@ def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator()):
         )
         workflow.connect([(extractfromresultdict, model, [("subject", "subjects")])])
 
-    multipleregressdesign = pe.MapNode(
-        interface=SafeMultipleRegressDesign(),
-        name="multipleregressdesign",
-        iterfield=["regressors", "contrasts"],
-        mem_gb=memcalc.min_gb,
-    )
-    workflow.connect(model, "regressors", multipleregressdesign, "regressors")
-    workflow.connect(model, "contrasts", multipleregressdesign, "contrasts")
-
-    flameo = pe.MapNode(
-        interface=SafeFLAMEO(run_mode=run_mode),
-        name="flameo",
-        mem_gb=memcalc.volume_std_gb * 100,
-        iterfield=[
-            "mask_file",
-            "cope_file",
-            "var_cope_file",
-            "dof_var_cope_file",
-            "design_file",
-            "t_con_file",
-            "f_con_file",
-            "cov_split_file",
-        ],
-    )
-    workflow.connect(
-        [
-            (maskmerge, flameo, [("merged_file", "mask_file")]),
-            (copemerge, flameo, [("merged_file", "cope_file")]),
-            (varcopemerge, flameo, [("merged_file", "var_cope_file")]),
-            (dofmerge, flameo, [("merged_file", "dof_var_cope_file")]),
-            (
-                multipleregressdesign,
-                flameo,
-                [
-                    ("design_mat", "design_file"),
-                    ("design_con", "t_con_file"),
-                    ("design_fts", "f_con_file"),
-                    ("design_grp", "cov_split_file"),
-                ],
-            ),
-        ]
-    )
+    if engine == "native" and analysis.type != "glm":
+        modelfit = pe.MapNode(
+            interface=ImageGLM(run_mode="fe" if run_mode == "fe" else "me"),
+            name="imageglm",
+            iterfield=[
+                "cope_files",
+                "var_cope_files",
+                "dof_files",
+                "mask_files",
+                "regressors",
+                "contrasts",
+            ],
+            mem_gb=memcalc.volume_std_gb * 10 + batch_gb,
+        )
+        workflow.connect(
+            [
+                (
+                    extractfromresultdict,
+                    modelfit,
+                    [
+                        ("cope", "cope_files"),
+                        ("varcope", "var_cope_files"),
+                        ("dof_file", "dof_files"),
+                        ("mask_file", "mask_files"),
+                    ],
+                ),
+                (model, modelfit, [("regressors", "regressors"), ("contrasts", "contrasts")]),
+            ]
+        )
+        maskendpoint = (modelfit, "mask_file")
+    else:
+        maskmerge = pe.MapNode(
+            interface=SafeMaskMerge(),
+            name="maskmerge",
+            iterfield="in_files",
+            mem_gb=memcalc.volume_std_gb * 100,
+        )
+        workflow.connect(extractfromresultdict, "mask_file", maskmerge, "in_files")
+        maskendpoint = (maskmerge, "merged_file")
+
+        copemerge = pe.MapNode(
+            interface=SafeMerge(dimension="t", streaming=True),
+            name="copemerge",
+            iterfield="in_files",
+            mem_gb=memcalc.volume_std_gb * 2,
+        )
+        workflow.connect(extractfromresultdict, "cope", copemerge, "in_files")
+
+        varcopemerge = pe.MapNode(
+            interface=SafeMerge(dimension="t", streaming=True),
+            name="varcopemerge",
+            iterfield="in_files",
+            mem_gb=memcalc.volume_std_gb * 2,
+        )
+        workflow.connect(extractfromresultdict, "varcope", varcopemerge, "in_files")
+
+        dofmerge = pe.MapNode(
+            interface=SafeMerge(dimension="t", streaming=True),
+            name="dofmerge",
+            iterfield="in_files",
+            mem_gb=memcalc.volume_std_gb * 2,
+        )
+        workflow.connect(extractfromresultdict, "dof_file", dofmerge, "in_files")
+
+        multipleregressdesign = pe.MapNode(
+            interface=SafeMultipleRegressDesign(),
+            name="multipleregressdesign",
+            iterfield=["regressors", "contrasts"],
+            mem_gb=memcalc.min_gb,
+        )
+        workflow.connect(model, "regressors", multipleregressdesign, "regressors")
+        workflow.connect(model, "contrasts", multipleregressdesign, "contrasts")
+
+        modelfit = pe.MapNode(
+            interface=SafeFLAMEO(run_mode=run_mode),
+            name="flameo",
+            mem_gb=memcalc.volume_std_gb * 100,
+            iterfield=[
+                "mask_file",
+                "cope_file",
+                "var_cope_file",
+                "dof_var_cope_file",
+                "design_file",
+                "t_con_file",
+                "f_con_file",
+                "cov_split_file",
+            ],
+        )
+        workflow.connect(
+            [
+                (maskmerge, modelfit, [("merged_file", "mask_file")]),
+                (copemerge, modelfit, [("merged_file", "cope_file")]),
+                (varcopemerge, modelfit, [("merged_file", "var_cope_file")]),
+                (dofmerge, modelfit, [("merged_file", "dof_var_cope_file")]),
+                (
+                    multipleregressdesign,
+                    modelfit,
+                    [
+                        ("design_mat", "design_file"),
+                        ("design_con", "t_con_file"),
+                        ("design_fts", "f_con_file"),
+                        ("design_grp", "cov_split_file"),
+                    ],
+                ),
+            ]
+        )
 
     outattrs = ["contrastname", "cope", "varcope", "zstat", "dof_file"]
     filtercons = pe.MapNode(
@@ -186,7 +229,7 @@ def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator()):
                 [("contrast_names", "contrastname"), ("contrast_names", "keys")],
             ),
             (
-                flameo,
+                modelfit,
                 filtercons,
                 [
                     ("copes", "cope"),
@@ -204,7 +247,142 @@ def init_higherlevel_analysis_wf(analysis, memcalc=MemoryCalculator()):
         name="makeresultdicts",
     )
     makeresultdicts.inputs.analysisname = analysis.name
-    workflow.connect(maskmerge, "merged_file", makeresultdicts, "mask_file")
+    workflow.connect(*maskendpoint, makeresultdicts, "mask_file")
+    workflow.connect(
+        [
+            (extractfromresultdict, makeresultdicts, [("remainder", "basedict")],),
+            (filtercons, makeresultdicts, [(attr, attr) for attr in outattrs],),
+        ]
+    )
+
+    outputnode = pe.Node(
+        interface=niu.IdentityInterface(fields=["resultdicts"]), name="outputnode"
+    )
+    workflow.connect(
+        [(makeresultdicts, outputnode, [(("resultdicts", ravel), "resultdicts")])]
+    )
+
+    return workflow
+
+
+def init_higherlevel_connectivity_wf(
+    analysis, memcalc=MemoryCalculator(), output_format="txt", output_float32=False
+):
+    """
+    create workflow that fits the group model to all edges of the
+    correlation matrices from atlas-based connectivity at once
+
+    when aggregating within subjects, the copes are also written as correlation
+    matrices, so that they can be the inputs of a further analysis
+
+    """
+    assert isinstance(analysis, Analysis)
+
+    is_subjectlevel = analysis.across != "subject"
+
+    workflow = pe.Workflow(name=f"{analysis.name}_connectivity")
+
+    inputnode = pe.Node(interface=niu.IdentityInterface(fields=["indicts"]), name="inputnode")
+
+    filterresultsdicts = pe.Node(
+        FilterResultdicts(filterobjs=[], requireoneofkeys=["correlation"]),
+        name="filterresultsdicts",
+    )
+    if analysis.filter is not None:
+        filterresultsdicts.inputs.filterobjs = analysis.filter
+        if analysis.spreadsheet is not None:
+            filterresultsdicts.inputs.spreadsheet = analysis.spreadsheet
+        if analysis.variables is not None:
+            filterresultsdicts.inputs.variableobjs = analysis.variables
+    workflow.connect(inputnode, "indicts", filterresultsdicts, "indicts")
+
+    aggregateresultdicts = pe.Node(
+        AggregateResultdicts(numinputs=1, across=analysis.across),
+        name="aggregateresultdicts",
+    )
+    workflow.connect(filterresultsdicts, "resultdicts", aggregateresultdicts, "in1")
+
+    extractfromresultdict = pe.MapNode(
+        interface=ExtractFromResultdict(keys=[analysis.across, "correlation"]),
+        iterfield="indict",
+        name="extractfromresultdict",
+    )
+    workflow.connect(
+        [(aggregateresultdicts, extractfromresultdict, [(("resultdicts", ravel), "indict")])]
+    )
+
+    matrixmerge = pe.MapNode(
+        interface=MergeMatrices(fisher_z=True, float32=output_float32),
+        name="matrixmerge",
+        iterfield="in_files",
+        mem_gb=memcalc.min_gb,
+    )
+    workflow.connect(extractfromresultdict, "correlation", matrixmerge, "in_files")
+
+    if analysis.type == "fixed_effects" or analysis.type == "intercept_only":
+        model = pe.MapNode(
+            interface=InterceptOnlyModel(),
+            name="model",
+            iterfield="n_copes",
+            mem_gb=memcalc.min_gb,
+        )
+        workflow.connect([(extractfromresultdict, model, [(("correlation", maplen), "n_copes")])])
+
+    if analysis.type == "glm":
+        assert analysis.across == "subject"
+
+        model = pe.MapNode(
+            interface=GroupModel(
+                spreadsheet=analysis.spreadsheet,
+                contrastobjs=analysis.contrasts,
+                variableobjs=analysis.variables,
+            ),
+            name="model",
+            iterfield="subjects",
+            mem_gb=memcalc.min_gb,
+        )
+        workflow.connect([(extractfromresultdict, model, [("subject", "subjects")])])
+
+    matrixglm = pe.MapNode(
+        interface=MatrixGLM(output_format=output_format, inverse_fisher_z=is_subjectlevel),
+        name="matrixglm",
+        iterfield=["merged_file", "regressors", "contrasts"],
+        mem_gb=memcalc.min_gb,
+    )
+    workflow.connect(
+        [
+            (matrixmerge, matrixglm, [("merged_file", "merged_file")]),
+            (model, matrixglm, [("regressors", "regressors"), ("contrasts", "contrasts")]),
+        ]
+    )
+
+    outattrs = ["contrastname", "cope", "varcope", "zstat", "dof_file"]
+    matrixglmoutattrs = ["copes", "var_copes", "zstats", "tdof"]
+    if is_subjectlevel:
+        outattrs.append("correlation")
+        matrixglmoutattrs.append("correlations")
+    filtercons = pe.MapNode(
+        interface=FilterList(fields=outattrs, pattern=r"^_"),
+        iterfield=[*outattrs, "keys"],
+        name="filtercons",
+    )
+    workflow.connect(
+        [
+            (
+                model,
+                filtercons,
+                [("contrast_names", "contrastname"), ("contrast_names", "keys")],
+            ),
+            (matrixglm, filtercons, list(zip(matrixglmoutattrs, outattrs[1:]))),
+        ]
+    )
+
+    makeresultdicts = pe.MapNode(
+        interface=MakeResultdicts(keys=["analysisname", *outattrs]),
+        iterfield=[*outattrs, "basedict"],
+        name="makeresultdicts",
+    )
+    makeresultdicts.inputs.analysisname = analysis.name
     workflow.connect(
         [
             (extractfromresultdict, makeresultdicts, [("remainder", "basedict")],),
@@ -2,19 +2,22 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import nibabel as nb
 
 from fmriprep.config import DEFAULT_MEMORY_MIN_GB
 
-from ..utils import first
+from ..utils import first, cacheobj, uncacheobj
 
 
 class MemoryCalculator:
     def __init__(self, bold_file=None, bold_shape=[72, 72, 72], bold_tlen=200):
         if bold_file:
             bold_shape = nb.load(bold_file).shape
-        self.volume_gb = np.product(bold_shape[:3]) * 8 / 2 ** 30
+        self.volume_gb = np.prod(bold_shape[:3]) * 8 / 2 ** 30
         bold_tlen = 1
         if len(bold_shape) > 3:
             bold_tlen = bold_shape[3]
@@ -22,7 +25,7 @@ class MemoryCalculator:
 
         std_bold_shape = [91, 109, 91, bold_tlen]  # template size
 
-        self.volume_std_gb = np.product(std_bold_shape[:-1]) * 8 / 2 ** 30
+        self.volume_std_gb = np.prod(std_bold_shape[:-1]) * 8 / 2 ** 30
         self.series_std_gb = self.volume_std_gb * bold_tlen
 
         self.min_gb = DEFAULT_MEMORY_MIN_GB
@@ -38,8 +41,96 @@ class MemoryCalculator:
             )
         )
 
+    def __eq__(self, other):
+        # so that workflows for bold files of the same shape are re-used from the cache
+        return isinstance(other, MemoryCalculator) and hash(self) == hash(other)
+
+
+def _load_bold_header(bold_file, cached=None):
+    stat = os.stat(bold_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    if cached is not None and cached[0] == key:
+        return cached
+    header = nb.load(bold_file).header  # only reads the header
+    shape = tuple(int(n) for n in header.get_data_shape())
+    zooms = tuple(float(z) for z in header.get_zooms())
+    return key, shape, zooms
+
+
+def load_bold_headers(bold_files, workdir=None, max_workers=16):
+    """
+    read the headers of many images in parallel, caching them in the working directory
+
+    :param bold_files: list of file paths
+    :param workdir: directory for the cache file, or None to not use a cache
+    :return: dict mapping each file path to a tuple of shape and zooms
+    """
+    cache = None
+    if workdir is not None:
+        cache = uncacheobj(workdir, "boldheaders", None)
+    if not isinstance(cache, dict):
+        cache = dict()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        entries = list(
+            executor.map(
+                _load_bold_header, bold_files, [cache.get(bold_file) for bold_file in bold_files]
+            )
+        )
+
+    is_dirty = False
+    for bold_file, entry in zip(bold_files, entries):
+        if cache.get(bold_file) != entry:
+            cache[bold_file] = entry
+            is_dirty = True
+    if is_dirty and workdir is not None:
+        cacheobj(workdir, "boldheaders", cache)
+
+    return {bold_file: (shape, zooms) for bold_file, (_, shape, zooms) in zip(bold_files, entries)}
+
+
+def load_bold_shapes(bold_files, workdir=None, max_workers=16):
+    headers = load_bold_headers(bold_files, workdir=workdir, max_workers=max_workers)
+    return {bold_file: shape for bold_file, (shape, _) in headers.items()}
+
+
+def repetition_time_from_header(header):
+    """
+    :param header: tuple of shape and zooms as returned by load_bold_headers
+    :return: repetition time, or None for single volume images
+    """
+    shape, zooms = header
+    if len(shape) < 4 or shape[3] < 2 or len(zooms) < 4:
+        return
+    return zooms[3]
+
+
+def memcalcs_from_database(database, workdir=None, headers=None):
+    """
+    :param headers: pre-loaded result of load_bold_headers, or None to load them here
+    :return: memory calculator for the first bold file, and dict mapping each bold file
+        to a memory calculator for its shape
+    """
+    bold_files = sorted(database.get(datatype="func", suffix="bold"))
+    if headers is None:
+        headers = load_bold_headers(bold_files, workdir=workdir)
+
+    memcalcs_by_shape = dict()
+    memcalcs = dict()
+    for bold_file in bold_files:
+        shape, _ = headers[bold_file]
+        if shape not in memcalcs_by_shape:
+            memcalcs_by_shape[shape] = MemoryCalculator(bold_shape=shape)
+        memcalcs[bold_file] = memcalcs_by_shape[shape]
+
+    bold_file = first(database.get(datatype="func", suffix="bold"))
+    memcalc = memcalcs.get(bold_file)
+    if memcalc is None:
+        memcalc = MemoryCalculator()
+
+    return memcalc, memcalcs
+
 
-def memcalc_from_database(database):
-    return MemoryCalculator(
-        bold_file=first(database.get(datatype="func", suffix="bold"))
-    )
+def memcalc_from_database(database, workdir=None):
+    memcalc, _ = memcalcs_from_database(database, workdir=workdir)
+    return memcalc
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+import pytest
+
+from pipeline.database import Database, _resolve
+from pipeline.spec import FileSchema, tagnames
+
+
+class DictOfSetsDatabase:
+    """
+    previous implementation, where each tag value mapped to the set of its filepaths
+    """
+
+    def __init__(self, database):
+        self.tags_by_filepaths = database.tags_by_filepaths
+        self.filepaths_by_tags = dict()
+        for filepath, tags_obj in self.tags_by_filepaths.items():
+            for tagname in tagnames:
+                tagval = getattr(tags_obj, tagname, None)
+                self.set_file_tag(filepath, tagname, tagval)
+
+    def set_file_tag(self, filepath, tagname, tagval):
+        if tagval is None:
+            return
+        if tagname not in self.filepaths_by_tags:
+            self.filepaths_by_tags[tagname] = dict()
+        tagvaldict = self.filepaths_by_tags[tagname]
+        if tagval not in tagvaldict:
+            tagvaldict[tagval] = set()
+        tagvaldict[tagval].add(filepath)
+
+    def get(self, **filters):
+        res = None
+        for tagname, tagval in filters.items():
+            tagname = _resolve(tagname)
+            if tagname in self.filepaths_by_tags and tagval in self.filepaths_by_tags[tagname]:
+                cur_set = self.filepaths_by_tags[tagname][tagval]
+                if res is not None:
+                    res &= cur_set
+                else:
+                    res = cur_set.copy()
+            else:
+                res = None
+                break
+        if res is None:
+            return set()
+        return res
+
+    def filter(self, filepaths, **filters):
+        res = set(filepaths)
+        for tagname, tagval in filters.items():
+            tagname = _resolve(tagname)
+            cur_set = self.filepaths_by_tags[tagname][tagval]
+            res &= cur_set
+        return res
+
+    def get_tagval_set(self, tagname, filepaths=None):
+        if not isinstance(tagname, str):
+            return
+        tagname = _resolve(tagname)
+        if tagname not in self.filepaths_by_tags:
+            return
+        if filepaths is not None:
+            if not isinstance(filepaths, set):
+                filepaths = set(filepaths)
+            return set(
+                tagval
+                for tagval, tagvalfilepaths in self.filepaths_by_tags[tagname].items()
+                if not filepaths.isdisjoint(tagvalfilepaths)
+            )
+        else:
+            return set(self.filepaths_by_tags[tagname].keys())
+
+    def get_multi_tagval_set(self, tagnames, filepaths=None, prune=True):
+        def prunefun(tn):
+            tagval_set = self.get_tagval_set(tn, filepaths=filepaths)
+            return tagval_set is not None and len(tagval_set) > 1
+
+        if prune:
+            tagnames = [tn for tn in tagnames if prunefun(tn)]
+        resolvedtagnames = [_resolve(tn) for tn in tagnames]
+
+        if filepaths is None:
+            filepaths = self.tags_by_filepaths.keys()
+
+        return (
+            tagnames,
+            set(
+                tuple(
+                    getattr(self.tags_by_filepaths[filepath], tn, None) for tn in resolvedtagnames
+                )
+                for filepath in filepaths
+                if filepath in self.tags_by_filepaths
+            ),
+        )
+
+
+@pytest.fixture(scope="module")
+def databases(tmp_path_factory):
+    """
+    a bids dataset where subjects are missing some tasks, runs and field maps, so that
+    tags have a single value for some subsets of the files
+    """
+    rng = np.random.default_rng(0)
+    base = tmp_path_factory.mktemp("bids")
+
+    for s in range(8):
+        subject = f"{s + 1:02d}"
+        directory = base / f"sub-{subject}"
+        for datatype in ["anat", "func", "fmap"]:
+            (directory / datatype).mkdir(parents=True)
+        (directory / "anat" / f"sub-{subject}_T1w.nii.gz").touch()
+        for task in ["rest", "faces"]:
+            if s > 0 and rng.random() < 0.3:
+                continue
+            n_runs = 3 if s == 0 else rng.integers(1, 4)
+            for run in range(1, n_runs + 1):
+                stem = f"sub-{subject}_task-{task}_run-{run}"
+                (directory / "func" / f"{stem}_bold.nii.gz").touch()
+                if task == "faces":
+                    extension = rng.choice(["tsv", "txt"])
+                    (directory / "func" / f"{stem}_events.{extension}").touch()
+        for direction in ["AP", "PA"]:
+            if s > 0 and rng.random() < 0.3:
+                continue
+            (directory / "fmap" / f"sub-{subject}_dir-{direction}_epi.nii.gz").touch()
+
+    schema = FileSchema()
+    files = [
+        schema.load(dict(path=str(base / path), tags=tags))
+        for path, tags in [
+            (
+                "sub-{subject}/anat/sub-{subject}_T1w.nii.gz",
+                dict(datatype="anat", suffix="T1w"),
+            ),
+            (
+                "sub-{subject}/func/sub-{subject}_task-{task}_run-{run}_bold.nii.gz",
+                dict(datatype="func", suffix="bold", repetition_time=2.0),
+            ),
+            (
+                "sub-{subject}/func/sub-{subject}_task-{task}_run-{run}_events.tsv",
+                dict(datatype="func", suffix="events", extension="tsv"),
+            ),
+            (
+                "sub-{subject}/func/sub-{subject}_task-{task}_run-{run}_events.txt",
+                dict(datatype="func", suffix="events", extension="txt", condition="faces"),
+            ),
+            (
+                "sub-{subject}/fmap/sub-{subject}_dir-{direction}_epi.nii.gz",
+                dict(datatype="fmap", suffix="epi"),
+            ),
+        ]
+    ]
+    database = Database(files=files)
+    return database, DictOfSetsDatabase(database)
+
+
+def filepath_subsets(database):
+    """
+    all files, the files of each subject and of each datatype, and random subsets with
+    paths that are not in the database
+    """
+    rng = np.random.default_rng(1)
+    filepaths = sorted(database.tags_by_filepaths.keys())
+    yield filepaths
+    for subject in sorted(database.get_tagval_set("subject")):
+        yield database.get(subject=subject)
+    for datatype in sorted(database.get_tagval_set("datatype")):
+        yield database.get(datatype=datatype)
+    for size in [1, 2, 5, 20]:
+        for _ in range(5):
+            subset = rng.choice(filepaths, size=size, replace=False).tolist()
+            yield [*subset, "/missing/sub-01_T1w.nii.gz"]
+    yield []
+
+
+def test_fixture(databases):
+    database, _ = databases
+    assert len(database.filepaths) > 50
+    assert database.get_tagval_set("extension") == {"tsv", "txt"}
+
+
+def test_get(databases):
+    database, previous = databases
+    queries = [
+        dict(),
+        dict(datatype="func"),
+        dict(datatype="func", suffix="bold"),
+        dict(datatype="func", suffix="events", task="faces"),
+        dict(subject="01", direction="ap"),
+        dict(subject="01", task="missing"),
+        dict(seed="missing"),
+    ]
+    for subject in database.get_tagval_set("subject"):
+        queries.append(dict(subject=subject, datatype="func", suffix="bold"))
+    for filters in queries:
+        assert database.get(**filters) == previous.get(**filters)
+
+
+def test_filter(databases):
+    database, previous = databases
+    queries = [
+        dict(),
+        dict(datatype="func", suffix="bold"),
+        dict(datatype="anat", suffix="T1w"),
+        dict(datatype="func", suffix="events", extension="txt"),
+        dict(task="rest"),
+        dict(direction="pa"),
+        dict(subject="01", run="1"),
+    ]
+    for filepaths in filepath_subsets(database):
+        for filters in queries:
+            assert database.filter(filepaths, **filters) == previous.filter(filepaths, **filters)
+
+
+def test_get_tagval_set(databases):
+    database, previous = databases
+    for tagname in [*tagnames, "direction", None]:
+        assert database.get_tagval_set(tagname) == previous.get_tagval_set(tagname)
+        for filepaths in filepath_subsets(database):
+            assert database.get_tagval_set(tagname, filepaths=filepaths) == (
+                previous.get_tagval_set(tagname, filepaths=filepaths)
+            )
+
+
+@pytest.mark.parametrize("prune", [True, False])
+def test_get_multi_tagval_set(databases, prune):
+    database, previous = databases
+    tagnames_list = [
+        ["subject", "session", "task", "run", "direction"],
+        ["datatype", "suffix", "extension", "condition"],
+        ["repetition_time", "seed"],  # one value, no values
+        tagnames,
+        [],
+    ]
+    for tagnames_ in tagnames_list:
+        for filepaths in [None, *filepath_subsets(database)]:
+            assert database.get_multi_tagval_set(
+                tagnames_, filepaths=filepaths, prune=prune
+            ) == previous.get_multi_tagval_set(tagnames_, filepaths=filepaths, prune=prune)
+
+
+def test_get_multi_tagval_set_prunes_by_filepaths(databases):
+    database, _ = databases
+    filepaths = database.get(subject="01", datatype="func", suffix="bold", task="rest")
+    assert len(filepaths) > 1
+    entities, tags_set = database.get_multi_tagval_set(
+        ["subject", "task", "run"], filepaths=filepaths
+    )
+    assert entities == ["run"]
+    assert tags_set == set((run,) for run in database.get_tagval_set("run", filepaths))
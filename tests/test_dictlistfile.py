@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import socket
+from multiprocessing import get_context
+
+import numpy as np
+import pytest
+
+from pipeline.io.dictlistfile import DictListFile, keykeys
+
+header, footer = "report('", "');"
+
+
+def rewrite_put(dictlist, indict):
+    """
+    previous implementation, where each writer read and rewrote the whole file under
+    a lock, and searched the list for an entry with the same entities
+    """
+    for i, curdict in enumerate(dictlist):
+        matches = all(
+            key in indict and indict[key] == value
+            for key, value in curdict.items()
+            if key in keykeys
+        )
+        if matches:
+            dictlist[i] = indict
+            return
+    dictlist.append(indict)
+
+
+def writer(conn, filename):
+    dictlistfile = DictListFile(filename, header, footer, compact_interval=3600.0)
+    for command, indicts in iter(conn.recv, None):
+        try:
+            if command == "put":
+                with dictlistfile:
+                    for indict in indicts[:1]:
+                        dictlistfile.put(indict)
+                    dictlistfile.put_many(indicts[1:])
+            elif command == "compact":
+                dictlistfile.compact()
+            conn.send(os.getpid())
+        except Exception as e:
+            conn.send(e)
+
+
+class Writer:
+    def __init__(self, filename):
+        self.conn, child_conn = get_context("fork").Pipe()
+        self.process = get_context("fork").Process(
+            target=writer, args=(child_conn, filename), daemon=True
+        )
+        self.process.start()
+
+    def __call__(self, command, indicts=None):
+        self.conn.send((command, indicts))
+        assert self.conn.poll(60.0)
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+        self.process.join()
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_interleaved_writers(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    filename = tmp_path / "reportvals.js"
+    logdirectory = tmp_path / "reportvals.js.log"
+
+    expected = []
+    writers = [Writer(filename) for _ in range(3)]
+    try:
+        for step in range(60):
+            i = rng.integers(len(writers))
+            action = rng.choice(["put", "put", "put", "compact", "restart"])
+            if action == "put":
+                indicts = [
+                    dict(
+                        subject=f"{rng.integers(4):02d}",
+                        task=str(rng.choice(["rest", "faces"])),
+                        desc=str(rng.choice(["confounds", "tsnr"])),
+                        value=f"{step}.{j}",
+                    )
+                    for j in range(rng.integers(1, 5))
+                ]
+                writers[i]("put", indicts)
+                for indict in indicts:
+                    rewrite_put(expected, indict)
+            elif action == "compact":
+                pid = writers[i]("compact")
+                logfilename = logdirectory / f"{socket.gethostname()}.{pid}.jsonl"
+                if logfilename.is_file():  # the log of the writer is truncated
+                    assert logfilename.stat().st_size == 0
+            else:
+                writers[i].close()
+                writers[i] = Writer(filename)
+
+        dictlistfile = DictListFile(filename, header, footer)
+        dictlistfile.compact()
+        assert dictlistfile._read() == expected
+    finally:
+        for w in writers:
+            w.close()
+
+    dictlistfile.compact()
+    assert dictlistfile._read() == expected
+    assert len(list(logdirectory.glob("*.jsonl"))) == 0  # all writers have exited
+    assert dictlistfile._read_state()["offsets"] == dict()
+
+
+def test_put_many_updates_by_key(tmp_path):
+    filename = tmp_path / "reportvals.js"
+    dictlistfile = DictListFile(filename, header, footer)
+    indicts = [dict(subject=f"{i:02d}", task="rest", value=i) for i in range(5)]
+    with dictlistfile:
+        dictlistfile.put_many(indicts)
+        dictlistfile.put(dict(subject="02", task="rest", value="updated"))
+    dictlistfile.compact()
+
+    dictlist = dictlistfile._read()
+    assert [indict["subject"] for indict in dictlist] == ["00", "01", "02", "03", "04"]
+    assert dictlist[2]["value"] == "updated"
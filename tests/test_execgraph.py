@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+
+from pipeline.execgraph import _subject_key, _expand
+from pipeline.io import apply_predictions, profile_key
+
+
+def make_workflow(tmp_path):
+    workflow = pe.Workflow(name="nipype", base_dir=str(tmp_path))
+    subjectworkflow = pe.Workflow(name="single_subject_01_wf")
+    a = pe.Node(niu.Merge(1), name="a", mem_gb=1.0)
+    a.inputs.in1 = [1, 2]
+    b = pe.MapNode(niu.Merge(1), iterfield="in1", name="b", mem_gb=2.0)
+    subjectworkflow.connect(a, "out", b, "in1")
+    workflow.add_nodes([subjectworkflow])
+    return workflow, subjectworkflow
+
+
+def test_apply_predictions(tmp_path):
+    workflow, _ = make_workflow(tmp_path)
+    a, b = sorted(workflow._get_all_nodes(), key=lambda node: node.name)
+    predictions = {profile_key(a): (3.0, 2), profile_key(b): (0.5, 1)}
+
+    for _ in range(2):  # does not compound
+        assert apply_predictions([a, b], predictions) == 2
+        assert a.mem_gb == 3.0 and a.n_procs == 2
+        assert b.mem_gb == 2.0 and b.n_procs == 1  # only raised
+
+    assert apply_predictions([a, b], dict()) == 0
+    assert a.mem_gb == 1.0 and a.n_procs == 1
+
+
+def test_subject_key_is_independent_of_predictions(tmp_path):
+    workflow, subjectworkflow = make_workflow(tmp_path)
+    key = _subject_key(workflow, subjectworkflow)
+
+    execgraph = _expand(workflow, [subjectworkflow])
+    predictions = {profile_key(node): (4.0, 3) for node in execgraph.nodes()}
+    assert apply_predictions(execgraph.nodes(), predictions) > 0
+
+    assert _subject_key(workflow, subjectworkflow) == key
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+from pipeline.interface.glm import wls
+
+
+def flame1_energy(logtausq, design, data, variances):
+    """
+    negative log marginal likelihood of the between-input variance that FLAMEO
+    minimizes for FLAME1, with the regression coefficients integrated out
+    """
+    weights = 1.0 / (variances + np.exp(logtausq))
+    xtwx = design.T @ (weights[:, None] * design)
+    beta = np.linalg.solve(xtwx, design.T @ (weights * data))
+    residuals = data - design @ beta
+    return 0.5 * (
+        -np.sum(np.log(weights)) + np.linalg.slogdet(xtwx)[1] + np.sum(weights * residuals ** 2)
+    )
+
+
+def test_wls_mixed_effects_matches_flame1():
+    rng = np.random.default_rng(0)
+    n_observations, n_columns = 20, 50
+    design = np.column_stack([np.ones(n_observations), rng.normal(size=n_observations)])
+    contrastmats = [("intercept", "T", np.array([[1.0, 0.0]]))]
+    variances = rng.uniform(0.5, 2.0, size=(n_observations, n_columns))
+    tausq = rng.uniform(0.0, 3.0, size=n_columns)
+    data = 1.0 + rng.normal(size=(n_observations, n_columns)) * np.sqrt(variances + tausq)
+
+    ((cope, varcope, t),) = wls(design, contrastmats, data, variances, mixed_effects=True)
+
+    for i in range(n_columns):
+        result = minimize_scalar(
+            flame1_energy,
+            bounds=(-20, 5),
+            args=(design, data[:, i], variances[:, i]),
+            method="bounded",
+            options=dict(xatol=1e-10),
+        )
+        weights = 1.0 / (variances[:, i] + np.exp(result.x))
+        covbeta = np.linalg.inv(design.T @ (weights[:, None] * design))
+        beta = covbeta @ design.T @ (weights * data[:, i])
+
+        assert np.isclose(cope[i], beta[0], rtol=1e-5, atol=1e-6)
+        assert np.isclose(varcope[i], covbeta[0, 0], rtol=1e-5)
+        assert np.isclose(t[i], beta[0] / np.sqrt(covbeta[0, 0]), rtol=1e-5, atol=1e-6)
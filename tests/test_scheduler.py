@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import networkx as nx
+from nipype.pipeline import engine as pe
+from nipype.interfaces import fsl
+
+from pipeline.io import profile_key
+from pipeline.plugins.scheduler import critical_path_lengths, runtime_model, default_runtime
+
+
+def test_critical_path_lengths_use_recorded_runtimes():
+    mcflirt = pe.Node(fsl.MCFLIRT(), name="mcflirt")
+    bet = pe.Node(fsl.BET(), name="bet")  # not in the runtime model
+    graph = nx.DiGraph([(mcflirt, bet)])
+
+    lengths = critical_path_lengths(graph)
+    assert lengths[bet] == default_runtime
+    assert lengths[mcflirt] == runtime_model["MCFLIRT"] + default_runtime
+
+    runtimes = {profile_key(bet): 500.0}
+    lengths = critical_path_lengths(graph, runtimes=runtimes)
+    assert lengths[bet] == 500.0
+    assert lengths[mcflirt] == runtime_model["MCFLIRT"] + 500.0  # falls back to the model
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy.ndimage import mean
+
+from pipeline.io.signals import img_to_signals, load_label_indicator
+
+
+def dense_img_to_signals(in_file, atlas_file, mask_file=None, background_label=0, min_n_voxels=50):
+    """
+    previous implementation, which reads the whole series and takes the mean per volume
+    """
+    in_data = nib.load(in_file).get_fdata()
+    labels = np.asanyarray(nib.load(atlas_file).dataobj).astype(np.int32)
+    nlabel = labels.max()
+    if mask_file is not None:
+        mask_data = np.asanyarray(nib.load(mask_file).dataobj).astype(bool)
+        labels[np.logical_not(mask_data)] = background_label
+
+    indices, counts = np.unique(labels, return_counts=True)
+    indices = indices[counts >= min_n_voxels]
+    indices = np.setdiff1d(indices, [background_label])
+
+    if in_data.ndim == 3:
+        in_data = in_data[:, :, :, np.newaxis]
+    result = np.full((in_data.shape[3], nlabel), np.nan)
+    for i, img in enumerate(np.moveaxis(in_data, 3, 0)):
+        result[i, indices - 1] = mean(img, labels=labels, index=indices)
+    return result
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (12, 10, 8)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    labels = rng.integers(0, 6, size=shape).astype(np.int16)
+    labels[:2, :, :] = 0
+    labels[labels == 4] = 0
+    labels[0, 0, 0] = 7  # below min_n_voxels
+    atlas_file = str(tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(labels, affine), atlas_file)
+
+    mask = np.ones(shape, dtype=np.uint8)
+    mask[:, :, :2] = 0
+    mask_file = str(tmp_path / "mask.nii.gz")
+    nib.save(nib.Nifti1Image(mask, affine), mask_file)
+
+    data = rng.normal(100, 10, size=(*shape, 11)).astype(np.float32)
+    in_files = dict()
+    for ext in ["nii", "nii.gz"]:
+        in_files[ext] = str(tmp_path / f"bold.{ext}")
+        nib.save(nib.Nifti1Image(data, affine), in_files[ext])
+    in_files["3d"] = str(tmp_path / "volume.nii.gz")
+    nib.save(nib.Nifti1Image(data[..., 0], affine), in_files["3d"])
+
+    return in_files, atlas_file, mask_file
+
+
+@pytest.mark.parametrize("key", ["nii", "nii.gz", "3d"])
+@pytest.mark.parametrize("chunk_size", [None, 1, 4])
+@pytest.mark.parametrize("use_mask", [False, True])
+def test_img_to_signals(images, key, chunk_size, use_mask):
+    in_files, atlas_file, mask_file = images
+    if not use_mask:
+        mask_file = None
+    kwargs = dict(mask_file=mask_file, min_n_voxels=5)
+
+    expected = dense_img_to_signals(in_files[key], atlas_file, **kwargs)
+    result = img_to_signals(in_files[key], atlas_file, chunk_size=chunk_size, **kwargs)
+
+    assert result.shape == expected.shape == (expected.shape[0], 7)
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    assert np.allclose(result, expected, equal_nan=True)
+
+    indicator, _ = load_label_indicator(atlas_file, mask_file=mask_file, min_n_voxels=5)
+    assert set(indicator.indices) == {1, 2, 3, 5}
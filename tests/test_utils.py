@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+import pytest
+
+from pipeline.utils import picklecodecs, savepickle, loadpickle, cacheobj, uncacheobj, prunecache
+
+
+@pytest.mark.parametrize("codec", [codec() for codec in picklecodecs if codec.is_available()])
+def test_picklecodec_roundtrip(tmp_path, codec):
+    obj = dict(
+        arr=np.arange(2 ** 16, dtype=np.float64).reshape(256, 256),
+        small=np.array([1, 2, 3]),
+        text="abc",
+    )
+    path = savepickle(tmp_path / "obj", obj, codec=codec)
+    assert str(path).endswith(codec.suffix)
+
+    loaded = loadpickle(path)
+    assert loaded["text"] == "abc"
+    for key in ["arr", "small"]:
+        assert np.array_equal(loaded[key], obj[key])
+        assert loaded[key].flags.writeable
+    loaded["arr"] += 1  # in place
+    loaded["small"][...] = 0
+    assert loaded["arr"][0, 0] == 1
+
+
+def test_prunecache(tmp_path):
+    uuids = ["00000000-aaaa", "11111111-bbbb", "22222222-cccc"]
+    for uuid in uuids:
+        cacheobj(tmp_path, "execgraph", dict(uuid=uuid), uuid=uuid)
+    (tmp_path / "other").touch()
+
+    assert prunecache(tmp_path, "execgraph", uuids[:1]) == 2
+    assert uncacheobj(tmp_path, "execgraph", uuids[0]) is not None
+    assert uncacheobj(tmp_path, "execgraph", uuids[1]) is None
+    assert (tmp_path / "other").is_file()